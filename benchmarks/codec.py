@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""Размер кадров и скорость кодеков сообщений (JSON и MessagePack).
+
+Пример::
+
+    python benchmarks/codec.py --count 20000
+
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+os.environ.setdefault('ROOT_PATH_FOR_DYNACONF', str(ROOT.joinpath('talkative_server', 'talkative_server')))
+sys.path.insert(0, str(ROOT.joinpath('talkative_server')))
+
+from talkative_server.jim_mes import Message, dispatcher  # noqa: E402
+
+WORDS = (
+    'привет как дела что нового созвонимся вечером отправил файл посмотри '
+    'hello ok thanks see you tomorrow meeting at 10 lunch today'
+).split()
+
+
+def messages(count):
+    rnd = random.Random(1)
+    return [Message(**{
+        'action': 'message',
+        'from': f'user{rnd.randrange(50)}',
+        'to': 'user0',
+        'chat': None,
+        'mess_text': ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 12))),
+    }) for _ in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Кодеки сообщений JIM')
+    parser.add_argument('--count', type=int, default=20000)
+    args = parser.parse_args()
+
+    corpus = messages(args.count)
+    print(f'{"кодек":<10}{"байт/кадр":>12}{"кодирование мкс":>18}{"разбор мкс":>14}')
+    for codec in ('json', 'msgpack'):
+        if codec not in dispatcher.get_objects():
+            print(f'{codec:<10} не установлен')
+            continue
+        begin = time.perf_counter()
+        frames = [msg.encode(codec) for msg in corpus]
+        packed = time.perf_counter() - begin
+        begin = time.perf_counter()
+        for frame in frames:
+            Message(frame)
+        unpacked = time.perf_counter() - begin
+        size = sum(map(len, frames)) / len(frames)
+        print(f'{codec:<10}{size:>12.1f}{packed / len(frames) * 1e6:>18.2f}{unpacked / len(frames) * 1e6:>14.2f}')
+
+
+if __name__ == '__main__':
+    main()
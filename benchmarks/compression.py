@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""Размер трафика и затраты CPU на сжатие кадров.
+
+Прогоняет типовой сеанс (вход, списки, переписка, смена аватаров) через
+кодек кадров без сжатия, с независимым сжатием каждого кадра и с
+потоковым сжатием подключения со словарем ZDICT (режим протокола).
+
+Пример::
+
+    python benchmarks/compression.py --messages 1000 --users 50
+
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import sys
+import time
+import zlib
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+os.environ.setdefault('ROOT_PATH_FOR_DYNACONF', str(ROOT.joinpath('talkative_server', 'talkative_server')))
+sys.path.insert(0, str(ROOT.joinpath('talkative_server')))
+
+from talkative_server.jim_mes import Deflater, FrameDecoder  # noqa: E402
+from talkative_server.jim_mes.frame import ZDICT, encode  # noqa: E402
+
+WORDS = (
+    'привет как дела что нового созвонимся вечером отправил файл посмотри '
+    'hello ok thanks see you tomorrow meeting at 10 lunch today'
+).split()
+
+
+def dumps(data):
+    return (json.dumps(data) + '\r\n').encode()
+
+
+def session(users, messages, avatar_size):
+    """Кадры типового сеанса в порядке отправки сервером."""
+    rnd = random.Random(1)
+    names = [f'user{i}' for i in range(users)]
+    stamp = '2019-09-01 12:00:00'
+    avatars = [[n, base64.b64encode(os.urandom(avatar_size)).decode('ascii')] for n in names]
+    frames = [
+        dumps({'response': 511, 'action': 'auth', 'bin': os.urandom(64).hex(), 'time': stamp}),
+        dumps({'response': 212, 'action': 'auth', 'time': stamp}),
+        dumps({'response': 202, 'data_list': avatars, 'time': stamp}),
+        dumps({'response': 202, 'data_list': [[n, [names[0], n]] for n in names[:20]], 'time': stamp}),
+    ]
+    for num in range(messages):
+        frames.append(dumps({
+            'action': 'message',
+            'from': rnd.choice(names),
+            'to': names[0],
+            'chat': None,
+            'mess_text': ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 12))),
+            'time': stamp,
+        }))
+        if num % 100 == 99:
+            frames.append(dumps({'response': 205, 'time': stamp}))
+            frames.append(dumps({'response': 202, 'data_list': avatars, 'time': stamp}))
+    return frames
+
+
+def measure(name, frames, make_deflater, make_decoder):
+    deflater = make_deflater()
+    begin = time.perf_counter()
+    stream = [b''.join(encode(frame, deflater)) for frame in frames]
+    packed = time.perf_counter() - begin
+    decoder = make_decoder()
+    begin = time.perf_counter()
+    out = [f for chunk in stream for f in decoder.feed(chunk)]
+    unpacked = time.perf_counter() - begin
+    assert [bytes(f) for f in out] == frames
+    return name, sum(map(len, stream)), packed, unpacked
+
+
+class PerFrame(object):
+    """Независимое сжатие каждого кадра (для сравнения)."""
+
+    def __init__(self, zdict=None):
+        self.zdict = zdict
+
+    def __call__(self, data):
+        stream = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS, **({'zdict': self.zdict} if self.zdict else {}))
+        return (stream.compress(data) + stream.flush(zlib.Z_SYNC_FLUSH))[:-4]
+
+
+class PerFrameDecoder(FrameDecoder):
+
+    def __init__(self, zdict=None):
+        super().__init__()
+        self.zdict = zdict
+
+    def inflate(self, data):
+        stream = zlib.decompressobj(-zlib.MAX_WBITS, **({'zdict': self.zdict} if self.zdict else {}))
+        return stream.decompress(bytes(data) + b'\x00\x00\xff\xff')
+
+
+def compressed_decoder():
+    decoder = FrameDecoder()
+    decoder.enable_compression()
+    return decoder
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сжатие кадров JIM')
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--avatar', type=int, default=3000, help='размер аватара в байтах (PNG, несжимаемый)')
+    args = parser.parse_args()
+
+    frames = session(args.users, args.messages, args.avatar)
+    chat = [f for f in frames if f.startswith(b'{"action": "message"')]
+    for title, corpus in (('весь сеанс', frames), ('только сообщения чата', chat)):
+        raw = sum(map(len, corpus)) + 4 * len(corpus)
+        print(f'{title}: кадров {len(corpus)}, без сжатия {raw} байт')
+        print(f'{"режим":<28}{"байт":>10}{"доля":>8}{"сжатие мкс/кадр":>18}{"распаковка мкс/кадр":>22}')
+        results = [
+            measure('без сжатия', corpus, lambda: None, FrameDecoder),
+            measure('каждый кадр отдельно', corpus, PerFrame, PerFrameDecoder),
+            measure('каждый кадр + словарь', corpus, lambda: PerFrame(ZDICT), lambda: PerFrameDecoder(ZDICT)),
+            measure('поток + словарь (протокол)', corpus, Deflater, compressed_decoder),
+        ]
+        for name, size, packed, unpacked in results:
+            print(f'{name:<28}{size:>10}{size / raw:>8.2f}{packed / len(corpus) * 1e6:>18.1f}{unpacked / len(corpus) * 1e6:>22.1f}')
+        print()
+
+
+if __name__ == '__main__':
+    main()
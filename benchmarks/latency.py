@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Замер задержки ping/pong одного подключения.
+
+Клиент отправляет серверу ping и ждет pong, RTT замеряется для каждой
+пары. По умолчанию заголовок кадра и данные пишутся двумя вызовами
+send, как это делает наивный клиент, - именно в таком случае без
+TCP_NODELAY вторая часть кадра ждет подтверждения первой (алгоритм
+Нейгла вместе с отложенным ACK).
+
+Пример::
+
+    python benchmarks/latency.py --count 200 --nodelay on
+    python benchmarks/latency.py --count 200 --nodelay off
+
+"""
+import argparse
+import json
+import socket
+import statistics
+import struct
+import time
+
+HEADER = struct.Struct('>I')
+
+
+def read_frame(sock):
+    head = sock.recv(HEADER.size, socket.MSG_WAITALL)
+    if len(head) < HEADER.size:
+        raise ConnectionError('Сервер закрыл соединение')
+    return json.loads(sock.recv(HEADER.unpack(head)[0], socket.MSG_WAITALL))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Замер задержки ping/pong')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7777)
+    parser.add_argument('--count', type=int, default=200)
+    parser.add_argument('--interval', type=float, default=0.025, help='пауза между ping (лимит частоты запросов сервера)')
+    parser.add_argument('--nodelay', choices=('on', 'off'), default='on', help='TCP_NODELAY на сокете клиента')
+    parser.add_argument('--whole', action='store_true', help='писать кадр одним вызовом send')
+    args = parser.parse_args()
+
+    sock = socket.create_connection((args.host, args.port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(args.nodelay == 'on'))
+    rtt = []
+    for num in range(args.count):
+        payload = (json.dumps({'action': 'ping', 'bin': num}) + '\r\n').encode()
+        begin = time.perf_counter()
+        if args.whole:
+            sock.sendall(HEADER.pack(len(payload)) + payload)
+        else:
+            sock.sendall(HEADER.pack(len(payload)))
+            sock.sendall(payload)
+        while read_frame(sock).get('action') != 'pong':
+            pass
+        rtt.append(time.perf_counter() - begin)
+        time.sleep(args.interval)
+    sock.close()
+
+    rtt.sort()
+    print(f'nodelay: {args.nodelay}, split: {not args.whole}, pings: {len(rtt)}')
+    print(f'rtt ms: median {statistics.median(rtt) * 1000:.2f}, '
+          f'p99 {rtt[int(len(rtt) * 0.99) - 1] * 1000:.2f}, max {rtt[-1] * 1000:.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""Нагрузочный тест маршрутизации сообщений.
+
+N клиентов авторизуются на сервере, после чего клиент i отправляет M
+сообщений клиенту (i + 1) % N без ожидания ответов. Замеряется время
+доставки всех сообщений и задержка доставки каждого.
+
+Клиенты могут быть разнесены по нескольким процессам (--processes),
+что бы генератор нагрузки не упирался в одно ядро.
+
+Пример::
+
+    python benchmarks/load.py --create-users --clients 200 --messages 500 --processes 4
+
+"""
+import argparse
+import asyncio
+import binascii
+import hashlib
+import hmac
+import json
+import multiprocessing
+import os
+import statistics
+import struct
+import sys
+import time
+from pathlib import Path
+
+HEADER = struct.Struct('>I')
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def auth_key(username, password):
+    return binascii.hexlify(hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'), username.encode('utf-8'), 10000))
+
+
+def create_users(names, password):
+    """Создание пользователей теста напрямую в БД сервера."""
+    os.environ.setdefault('ROOT_PATH_FOR_DYNACONF', str(ROOT.joinpath('talkative_server', 'talkative_server')))
+    sys.path.insert(0, str(ROOT.joinpath('talkative_server')))
+    from talkative_server.db import DBManager
+    db = DBManager('server')
+    for name in names:
+        if not db.User.by_name(name):
+            db.User.objects.create(username=name, password=password, auth_key=auth_key(name, password))
+
+
+def frame(data):
+    payload = (json.dumps(data) + '\r\n').encode()
+    return HEADER.pack(len(payload)) + payload
+
+
+async def read(reader):
+    size = HEADER.unpack(await reader.readexactly(HEADER.size))[0]
+    return json.loads(await reader.readexactly(size))
+
+
+class Client(object):
+    """Клиент теста."""
+
+    def __init__(self, name, peer, password):
+        self.name = name
+        self.peer = peer
+        self.password = password
+        self.latency = []
+
+    async def login(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(frame({'action': 'presence', 'type': 'status', 'user': self.name}))
+        challenge = await read(self.reader)
+        if challenge.get('response') != 511:
+            raise RuntimeError(f'{self.name}: {challenge}')
+        digest = hmac.new(auth_key(self.name, self.password), challenge['bin'].encode('utf-8'), 'md5').digest()
+        self.writer.write(frame({
+            'action': 'auth',
+            'response': 511,
+            'bin': binascii.b2a_base64(digest).decode('ascii'),
+            'user': self.name,
+        }))
+        answer = await read(self.reader)
+        if answer.get('response') != 212:
+            raise RuntimeError(f'{self.name}: {answer}')
+
+    async def send(self, count, size):
+        filler = 'x' * size
+        for num in range(count):
+            self.writer.write(frame({
+                'action': 'message',
+                'from': self.name,
+                'to': self.peer,
+                'chat': None,
+                'mess_text': f'{time.perf_counter()}|{filler}',
+            }))
+            if num % 100 == 99:
+                await self.writer.drain()
+        await self.writer.drain()
+
+    async def receive(self, count):
+        while len(self.latency) < count:
+            mes = await read(self.reader)
+            if mes.get('action') == 'message':
+                sent = float(mes['mess_text'].split('|', 1)[0])
+                self.latency.append(time.perf_counter() - sent)
+
+    def close(self):
+        self.writer.close()
+
+
+async def run_clients(names, peers, args, ready, start):
+    clients = [Client(n, p, args.password) for n, p in zip(names, peers)]
+    await asyncio.gather(*(c.login(args.host, args.port) for c in clients))
+    ready.put(len(clients))
+    await asyncio.get_running_loop().run_in_executor(None, start.wait)
+    begin = time.perf_counter()
+    receivers = [asyncio.ensure_future(c.receive(args.messages)) for c in clients]
+    await asyncio.gather(*(c.send(args.messages, args.size) for c in clients))
+    await asyncio.wait_for(asyncio.gather(*receivers), args.timeout)
+    elapsed = time.perf_counter() - begin
+    for c in clients:
+        c.close()
+    return elapsed, [lat for c in clients for lat in c.latency]
+
+
+def worker(names, peers, args, ready, start, results):
+    if args.loop == 'uvloop':
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    results.put(asyncio.run(run_clients(names, peers, args, ready, start)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест маршрутизации сообщений')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7777)
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=100, help='сообщений от каждого клиента')
+    parser.add_argument('--size', type=int, default=100, help='размер текста сообщения')
+    parser.add_argument('--processes', type=int, default=1, help='процессов генератора нагрузки')
+    parser.add_argument('--loop', choices=('asyncio', 'uvloop'), default='asyncio', help='цикл событий генератора нагрузки')
+    parser.add_argument('--password', default='bench')
+    parser.add_argument('--prefix', default='bench')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--create-users', action='store_true', help='создать пользователей в БД сервера')
+    args = parser.parse_args()
+
+    names = [f'{args.prefix}{i}' for i in range(args.clients)]
+    peers = names[1:] + names[:1]
+    if args.create_users:
+        create_users(names, args.password)
+
+    ready, start, results = multiprocessing.Queue(), multiprocessing.Event(), multiprocessing.Queue()
+    procs = []
+    for num in range(args.processes):
+        proc = multiprocessing.Process(target=worker, args=(names[num::args.processes], peers[num::args.processes], args, ready, start, results))
+        proc.start()
+        procs.append(proc)
+    logged = sum(ready.get() for _ in procs)
+    start.set()
+    out = [results.get() for _ in procs]
+    for proc in procs:
+        proc.join()
+
+    elapsed = max(e for e, _ in out)
+    latency = sorted(lat for _, lats in out for lat in lats)
+    total = len(latency)
+    print(f'clients: {logged}, messages: {total}, time: {elapsed:.3f} s')
+    print(f'throughput: {total / elapsed:.0f} msg/s')
+    print(f'latency ms: median {statistics.median(latency) * 1000:.2f}, '
+          f'p99 {latency[int(total * 0.99) - 1] * 1000:.2f}, max {latency[-1] * 1000:.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""Микробенчмарки объекта сообщения.
+
+Замеряет путь сообщения через сервер: разбор кадра, чтение полей для
+маршрутизации и кодирование для получателя, а также отдельно создание
+сообщения и доступ к полям.
+
+Пример::
+
+    python benchmarks/message.py --count 50000
+
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+os.environ.setdefault('ROOT_PATH_FOR_DYNACONF', str(ROOT.joinpath('talkative_server', 'talkative_server')))
+sys.path.insert(0, str(ROOT.joinpath('talkative_server')))
+
+from talkative_server.jim_mes import Message  # noqa: E402
+
+
+def route(frames):
+    for frame in frames:
+        msg = Message(frame)
+        if msg.action == 'message' and msg.to and getattr(msg, 'from'):
+            bytes(msg)
+
+
+def bench(name, func, count):
+    begin = time.perf_counter()
+    func()
+    print(f'{name:<36}{(time.perf_counter() - begin) / count * 1e6:>10.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Микробенчмарки Message')
+    parser.add_argument('--count', type=int, default=50000)
+    args = parser.parse_args()
+    count = args.count
+
+    frames = [(json.dumps({
+        'action': 'message', 'from': 'alice', 'to': 'bob', 'chat': None,
+        'mess_text': f'сообщение {num}', 'time': '2019-09-01 12:00:00',
+    }) + '\r\n').encode() for num in range(count)]
+    msgs = [Message(frame) for frame in frames]
+
+    print(f'{"операция":<36}{"мкс/сообщение":>10}')
+    bench('разбор кадра', lambda: [Message(frame) for frame in frames], count)
+    bench('создание из полей', lambda: [Message(action='message', to='bob', mess_text='x') for _ in range(count)], count)
+    bench('чтение 4 полей', lambda: [(m.action, m.to, m.chat, m.mess_text) for m in msgs], count)
+    bench('кодирование', lambda: [bytes(m) for m in msgs], count)
+    bench('разбор -> маршрут -> кодирование', lambda: route(frames), count)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,8 +13,26 @@ DEBUG_SQL = False
 PORT = 7777
 HOST = '127.0.0.1'
 MAX_CONNECTIONS = 5
-MAX_PACKAGE_LENGTH = 1024
+MAX_PACKAGE_LENGTH = 16 * 1024 * 1024  # списки пользователей содержат аватары
+COMPRESSION = False  # запрашивать сжатие кадров у сервера
+PREFERRED_CODEC = 'msgpack'  # кодек вместо JSON (None - только JSON)
 ENCODING = 'utf-8'
+REQUEST_TIMEOUT = 5  # сек ожидания ответа на запрос
+AVATAR_CACHE = 'cache/avatars'  # каталог кэша аватаров, файл - хеш содержимого
+AVATARS_BATCH = 50  # хешей в одном запросе get_avatar
+MESSAGES_BATCH = 200  # недоставленных сообщений в одном кадре
+USERS_PAGE = 20  # пользователей в ответе на поиск нового контакта
+PING_INTERVAL = 30  # сек между замерами RTT
+LOOP = 'uvloop'  # цикл событий: 'uvloop' или 'asyncio' (если uvloop не установлен)
+
+# Профиль сокетов (None - значение ОС по умолчанию)
+TCP_NODELAY = True  # без задержки Нейгла для мелких кадров
+SO_KEEPALIVE = True
+TCP_KEEPIDLE = 60  # сек
+TCP_KEEPINTVL = 10  # сек
+TCP_KEEPCNT = 5
+SO_SNDBUF = None
+SO_RCVBUF = None
 
 # log
 LOGGING_LEVEL = logging.CRITICAL
@@ -29,10 +47,20 @@ SENDER = 'from'
 TIME = 'time'
 USER = 'user'
 
+# Номера ключей для двоичного кодека, порядок не менять - только дописывать
+BINARY_KEYS = [
+    'action', 'response', 'time', 'from', 'to', 'mess_text', 'chat', 'user',
+    'bin', 'data_list', 'error', 'account_name', 'pubkey', 'type', 'compress',
+    'codec', 'retry_after', 'id', 'query', 'limit', 'cursor', 'avatars',
+    'since', 'version', 'deleted',
+]
+
 # Прочие ключи, используемые в протоколе
 ADD_CONTACT = 'add'
 ADD_CHAT = 'add_chat'
 AVA_INFO = 'edit_ava'
+AVATARS = 'avatars'
+GET_AVATAR = 'get_avatar'
 EDIT_CHAT = 'edit_chat'
 DEL_CHAT = 'del_chat'
 AUTH = 'auth'
@@ -45,6 +73,18 @@ GET_MESSAGES = 'get_messages'
 LIST_INFO = 'data_list'
 MESSAGE = 'message'
 MESSAGE_TEXT = 'mess_text'
+MESSAGE_ID = 'id'
+QUERY = 'query'
+LIMIT = 'limit'
+CURSOR = 'cursor'
+SINCE = 'since'
+VERSION = 'version'
+DELETED = 'deleted'
+PING = 'ping'
+PONG = 'pong'
+COMPRESS = 'compress'
+CODEC = 'codec'
+RETRY_AFTER = 'retry_after'
 PRESENCE = 'presence'
 PUBLIC_KEY = 'pubkey'
 PUBLIC_KEY_REQUEST = 'pubkey_need'
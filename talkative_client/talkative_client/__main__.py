@@ -43,6 +43,7 @@ def arg_parser():
     parser.add_argument('-a', '--host', nargs='?', help=f'IP (default "{settings.get("HOST")}")')
     parser.add_argument('-p', '--port', nargs='?', help=f'Port (default "{settings.get("PORT")}")')
     parser.add_argument('--no-async', dest='no_async', action='store_true', help='Start do not async client')
+    parser.add_argument('--loop', choices=('uvloop', 'asyncio'), help=f'Event loop (default "{settings.get("LOOP")}")')
     parser.set_defaults(no_async=False)
     parser.add_argument(
         '-v',
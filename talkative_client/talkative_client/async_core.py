@@ -9,24 +9,44 @@ import binascii
 import hashlib
 import hmac
 import logging
-import struct
 
 from Cryptodome.Cipher import PKCS1_OAEP
 from Cryptodome.PublicKey import RSA
 from dynaconf import settings
 from PyQt5.QtCore import QByteArray, QObject, pyqtSignal
 
-from .db import Chat, DBManager, User
+from .avatars import AvatarCache
+from .db import Chat, DBManager, SyncState, User
 from .db import database_lock as db_lock
 from .descriptors import PortDescr
-from .errors import ContactExists
-from .jim_mes import Message
+from .errors import ContactExists, NotFoundContact
+from .jim_mes import Deflater, FrameDecoder, FrameError, Message, dispatcher
+from .jim_mes.frame import encode
+from .sockets import tune_socket
 # from .metaclasses import ClientVerifier
 
 app_name = 'client'
 logger = logging.getLogger(app_name)
 
 
+def loop_policy():
+    """Политика цикла событий из настройки LOOP.
+
+    Returns:
+        Политика uvloop если она выбрана и установлена, иначе стандартная
+        asyncio.AbstractEventLoopPolicy
+
+    """
+    if settings.get('LOOP', 'asyncio') == 'uvloop':
+        try:
+            import uvloop
+        except ImportError:
+            logger.warning('uvloop не установлен, используется стандартный цикл asyncio')
+        else:
+            return uvloop.EventLoopPolicy()
+    return asyncio.DefaultEventLoopPolicy()
+
+
 class ClientTransport(QObject):
     """[summary].
 
@@ -44,6 +64,8 @@ class ClientTransport(QObject):
         self.auth = {}
         self.transport = None
         self.protocol = None
+        self.pending = {}
+        self.rtt = None
         self.router = router.init(self)
         self.decrypter = PKCS1_OAEP.new(RSA.import_key(settings.get('USER_KEY')))
 
@@ -55,6 +77,7 @@ class ClientTransport(QObject):
             settings.get('HOST'),
             settings.as_int('PORT'),
         )
+        heartbeat = self.loop.create_task(self.ping_loop())
 
         # Wait until the protocol signals that the connection
         # is lost and close the transport.
@@ -65,17 +88,87 @@ class ClientTransport(QObject):
         except Exception as error:
             logger.error(error, exc_info=True)
         finally:
+            heartbeat.cancel()
             logger.debug('stoped')
             self.transport.close()
 
+    async def ping_loop(self):
+        """Периодический ping сервера для замера RTT."""
+        while True:
+            self.protocol.write(Message(**{settings.ACTION: settings.PING, settings.DATA: self.loop.time()}))
+            await asyncio.sleep(settings.as_float('PING_INTERVAL'))
+
     def run(self):
         self.database = DBManager(app_name)
         self.notify('init_db')
+        asyncio.set_event_loop_policy(loop_policy())
         asyncio.run(self.async_start())
 
     def is_alive(self):
         return self.started
 
+    async def request(self, timeout=None, **kwargs):
+        """Запрос к серверу с ожиданием ответа.
+
+        Ответ сопоставляется с запросом по id, поэтому несколько запросов
+        могут выполняться одновременно по одному подключению. Ответ
+        также проходит обычную обработку командами.
+
+        Args:
+            timeout: время ожидания в секундах (default: {REQUEST_TIMEOUT})
+            **kwargs: параметры запроса
+
+        Returns:
+            Ответ сервера
+            Message
+
+        Raises:
+            asyncio.TimeoutError: ответ не получен за timeout
+
+        """
+        msg = Message.request(**kwargs)
+        msg_id = getattr(msg, settings.MESSAGE_ID)
+        future = self.pending[msg_id] = self.loop.create_future()
+        try:
+            self.protocol.write(msg)
+            return await asyncio.wait_for(future, timeout or settings.as_float('REQUEST_TIMEOUT'))
+        finally:
+            self.pending.pop(msg_id, None)
+
+    async def request_keys(self, names, timeout=None):
+        """Одновременный запрос публичных ключей пользователей.
+
+        Ключи сохраняет :py:class:`RequestKeyCommand`.
+
+        Args:
+            names: имена пользователей
+            timeout: время ожидания в секундах (default: {REQUEST_TIMEOUT})
+
+        Returns:
+            Ответы сервера
+            list
+
+        """
+        return await asyncio.gather(*(self.request(timeout, **{
+            settings.ACTION: settings.PUBLIC_KEY_REQUEST,
+            settings.SENDER: settings.USER_NAME,
+            settings.DESTINATION: name,
+        }) for name in names))
+
+    def call(self, coro, timeout=None):
+        """Выполнение корутины в цикле клиента из другого потока.
+
+        Args:
+            coro: корутина, например :py:meth:`request`
+            timeout: предельное время ожидания результата (default: {None})
+
+        Returns:
+            Результат корутины
+            object
+
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
     def notify(self, event, proto=None, msg=None, **kwargs):
         logger.info(f'Свершилось событие {event}')
         obs = self._observers.get(event, []) or []
@@ -101,23 +194,32 @@ class ClientTransport(QObject):
         logger.info(f'{observer} отписался от события {event}')
 
     def run_command(self, proto, mes):
-        action = getattr(mes, settings.ACTION, None) or getattr(mes, settings.RESPONSE, None)
+        code = getattr(mes, settings.RESPONSE, None)
+        # 429 несет action запроса, но обработчик действия принял бы его
+        # за повод сразу повторить запрос
+        action = code if code == 429 else getattr(mes, settings.ACTION, None) or code
         if action:
             self.notify(action, proto, mes)
         else:
             logger.debug(f'Пустая команда {action}')
+        future = self.pending.get(getattr(mes, settings.MESSAGE_ID, None))
+        if future is not None and not future.done() and getattr(mes, settings.RESPONSE, None) is not None:
+            future.set_result(mes)
 
 
 class AsyncClientProtocol(asyncio.Protocol):
 
-    CHUNK_SIZE = 4
-
     def __init__(self, thread, *args, **kwargs):
         self._thread = thread
+        # сжатые кадры сразу за ответом 511 ждут включения сжатия
+        self.decoder = FrameDecoder(settings.as_int('MAX_PACKAGE_LENGTH'), hold=True)
+        self.deflater = None
+        self.codec = None
         super().__init__(*args, **kwargs)
 
     def connection_made(self, transport):
         self.transport = transport
+        tune_socket(transport.get_extra_info('socket'))
         user = User.by_name(settings.USER_NAME)
         hash_ = binascii.hexlify(hashlib.pbkdf2_hmac(
             'sha512',
@@ -135,30 +237,37 @@ class AsyncClientProtocol(asyncio.Protocol):
             user.save()
         logger.debug('Установлено соединение с сервером.')
 
-        self.write(Message.presence())
-        self.def_size, self.transport.max_size, self.cur_size = self.transport.max_size, self.CHUNK_SIZE, self.CHUNK_SIZE
+        options = {}
+        if settings.get('COMPRESSION'):
+            options[settings.COMPRESS] = 'zlib'
+        codec = settings.get('PREFERRED_CODEC')
+        if codec and codec in dispatcher.get_objects():
+            options[settings.CODEC] = codec
+        self.write(Message.presence(**options))
         self._thread.notify('new_connect')
-        self.long_data = b''
 
     def data_received(self, data):
-        if len(data) == self.CHUNK_SIZE:
-            self.cur_size = struct.unpack('>I', data)[0]
-            self.transport.max_size = min(self.cur_size, self.def_size)
-            return
-        self.long_data += data
-
-        if self.cur_size > len(self.long_data):
+        try:
+            frames = self.decoder.feed(data)
+        except FrameError as error:
+            logger.error(f'{error}. Соединение будет закрыто.')
+            self.transport.close()
             return
 
-        self.transport.max_size = self.cur_size = self.CHUNK_SIZE
-        if len(self.long_data) < 1024:
-            logger.debug(f'Server say: {self.long_data.decode(settings.get("encoding", "utf-8"))}')
-        else:
-            logger.debug(f'Server say message len {len(self.long_data)}')
-
-        mes = Message(self.long_data)
-        self.long_data = b''
-        self._thread.run_command(self, mes)
+        while frames:
+            for frame in frames:
+                if logger.isEnabledFor(logging.DEBUG):
+                    if len(frame) < 1024:
+                        logger.debug(f'Server say: {bytes(frame).decode(settings.get("encoding", "utf-8"), "replace")}')
+                    else:
+                        logger.debug(f'Server say message len {len(frame)}')
+                self._thread.run_command(self, Message(frame))
+            try:
+                frames = self.decoder.resume()
+            except FrameError as error:
+                logger.error(f'{error}. Соединение будет закрыто.')
+                self.transport.close()
+                return
 
     def connection_lost(self, exc):
         print('The server closed the connection')
@@ -167,14 +276,18 @@ class AsyncClientProtocol(asyncio.Protocol):
     def write(self, msg, transport=None):
         transport = transport or self.transport
         if not isinstance(msg, bytes):
-            msg = bytes(msg)
+            msg = msg.encode(self.codec)
         try:
-            msg = struct.pack('>I', len(msg)) + msg
-            transport.write(msg)
+            transport.writelines(encode(msg, self.deflater))
             logger.info(f'send {msg}')
         except BrokenPipeError:
             transport.close()
 
+    def enable_compression(self):
+        """Включение сжатия кадров в обе стороны после ответа сервера."""
+        self.decoder.enable_compression()
+        self.deflater = Deflater()
+
     def close(self):
         self._thread.on_con_lost.set_result(True)
 
@@ -228,6 +341,9 @@ class ClientAuth:
         ans_data = getattr(msg, settings.DATA, '')
         code = getattr(msg, settings.RESPONSE, '')
         if code == 511:
+            if getattr(msg, settings.COMPRESS, None) == 'zlib':
+                proto.enable_compression()
+            proto.codec = getattr(msg, settings.CODEC, None)
             digest = hmac.new(user.auth_key, ans_data.encode('utf-8')).digest()
             proto.write(Message(response=511, **{
                 settings.ACTION: settings.AUTH,
@@ -253,32 +369,159 @@ class ClientError:
         # proto.close()
 
 
+class SlowDownCommand:
+    """Превышен лимит запросов.
+
+    Запросы списков повторяются через ``retry_after`` секунд из ответа,
+    остальные действия только логируются.
+    """
+
+    name = 429
+    RETRY = (settings.USERS_REQUEST, settings.GET_CONTACTS, settings.GET_CHATS, settings.GET_MESSAGES)
+
+    def __init__(self):
+        super().__init__()
+        self.waiting = set()
+
+    def update(self, proto, msg, *args, **kwargs):
+        action = getattr(msg, settings.ACTION, None)
+        retry_after = getattr(msg, settings.RETRY_AFTER, None) or 1
+        logger.warning(f'Лимит запросов {action}, повтор через {retry_after} сек')
+        if action in self.RETRY and action not in self.waiting:
+            self.waiting.add(action)
+            proto._thread.loop.call_later(retry_after, self.retry, proto, action)
+
+    def retry(self, proto, action):
+        self.waiting.discard(action)
+        proto.notify(action)
+
+
 class GetAllUsers:
+    """Список пользователей.
+
+    Вместо аватаров сервер присылает хеши их содержимого. Аватары
+    которых нет в кэше запрашивает :py:class:`GetAvatarCommand`.
+    """
+
     name = settings.USERS_REQUEST
 
     def update(self, proto, msg=None, **kwargs):
         code = getattr(msg, settings.RESPONSE, '')
         if code == 202:
+            cache = GetAvatarCommand.cache()
             lst = []
-            for username, ava in getattr(msg, settings.LIST_INFO, []):
+            changed = []
+            missing = {}
+            for username, hash_ in getattr(msg, settings.LIST_INFO, []):
                 user = User.by_name(username=username)
-                if user:
-                    if ava:
-                        user.avatar = QByteArray.fromBase64(base64.b64decode(ava))
-                else:
-                    user = User(username=username, password='placeholder', avatar=QByteArray.fromBase64(base64.b64decode(ava)) if ava else None)
+                if not user:
+                    user = User(username=username, password='placeholder')
+                if hash_:
+                    ava = cache.get(hash_)
+                    if ava is None:
+                        missing.setdefault(hash_, []).append(username)
+                    elif bytes(user.avatar or b'') != ava:
+                        user.avatar = QByteArray(ava)
+                        changed.append(user)
                 lst.append(user)
             with db_lock:
                 User.save_all(lst)
+                User.delete_names(getattr(msg, settings.DELETED, None) or [])
+            Chat.refresh_avatars(changed)
+            version = getattr(msg, settings.VERSION, None)
+            if version is not None:
+                SyncState.set_version(self.name, version)
             proto.notify(f'done_{self.name}')
+            if missing:
+                proto.notify(settings.GET_AVATAR, waiting=missing)
         else:
-            proto.write(Message(**{
+            request = {
                 settings.ACTION: settings.USERS_REQUEST,
                 settings.USER: settings.USER_NAME,
-            }))
+                settings.AVATARS: 'hash',
+            }
+            if kwargs.get('query') is not None:
+                # поиск нового контакта: только первая страница совпадений
+                request[settings.QUERY] = kwargs['query']
+                request[settings.LIMIT] = settings.as_int('USERS_PAGE')
+            else:
+                request[settings.SINCE] = SyncState.get_version(self.name)
+            proto.write(Message.request(**request))
             proto.notify(f'send_{self.name}')
 
 
+class GetAvatarCommand:
+    """Загрузка аватаров которых нет в кэше."""
+
+    name = settings.GET_AVATAR
+    _cache = None
+
+    def __init__(self):
+        super().__init__()
+        self.waiting = {}
+
+    @classmethod
+    def cache(cls):
+        if cls._cache is None:
+            cls._cache = AvatarCache()
+        return cls._cache
+
+    def update(self, proto, msg=None, *args, **kwargs):
+        code = getattr(msg, settings.RESPONSE, '')
+        if code == 202:
+            cache = self.cache()
+            lst = []
+            for hash_, ava in getattr(msg, settings.LIST_INFO, None) or []:
+                data = QByteArray.fromBase64(base64.b64decode(ava))
+                cache.put(hash_, bytes(data))
+                for username in self.waiting.pop(hash_, []):
+                    user = User.by_name(username=username)
+                    if user:
+                        user.avatar = data
+                        lst.append(user)
+            if lst:
+                with db_lock:
+                    User.save_all(lst)
+                Chat.refresh_avatars(lst)
+                proto.notify(f'done_{settings.USERS_REQUEST}')
+        elif not msg:
+            waiting = kwargs.get('waiting') or {}
+            for hash_, usernames in waiting.items():
+                self.waiting.setdefault(hash_, []).extend(usernames)
+            if waiting:
+                proto._thread.loop.create_task(self.fetch(proto._thread, list(waiting)))
+            proto.notify(f'send_{self.name}')
+
+    async def fetch(self, client, hashes):
+        """Запрос аватаров пачками по одной.
+
+        Следующая пачка запрашивается после ответа на предыдущую, так что
+        запросы не упираются в лимит частоты сервера. Отказ по лимиту
+        (429) повторяется через ``retry_after``. Аватары из ответов 202
+        сохраняет :py:meth:`update`.
+
+        Args:
+            client: клиент с :py:meth:`request`
+            hashes: хеши аватаров
+
+        """
+        batch = settings.as_int('AVATARS_BATCH')
+        pos = 0
+        while pos < len(hashes):
+            try:
+                answer = await client.request(**{
+                    settings.ACTION: self.name,
+                    settings.LIST_INFO: hashes[pos:pos + batch],
+                })
+            except asyncio.TimeoutError:
+                logger.warning(f'Нет ответа на запрос аватаров, пропущено {len(hashes[pos:pos + batch])}')
+                answer = None
+            if getattr(answer, settings.RESPONSE, None) == 429:
+                await asyncio.sleep(getattr(answer, settings.RETRY_AFTER, None) or 1)
+                continue
+            pos += batch
+
+
 class GetContacts:
     name = settings.GET_CONTACTS
 
@@ -292,11 +535,21 @@ class GetContacts:
                         user.add_contact(contact)
                 except ContactExists:
                     pass
+            for contact in getattr(msg, settings.DELETED, None) or []:
+                try:
+                    with db_lock:
+                        user.del_contact(contact)
+                except NotFoundContact:
+                    pass
+            version = getattr(msg, settings.VERSION, None)
+            if version is not None:
+                SyncState.set_version(self.name, version)
             proto.notify(f'done_{self.name}')
         else:
-            proto.write(Message(**{
+            proto.write(Message.request(**{
                 settings.ACTION: settings.GET_CONTACTS,
                 settings.USER: settings.USER_NAME,
+                settings.SINCE: SyncState.get_version(self.name),
             }))
             proto.notify(f'send_{self.name}')
 
@@ -307,38 +560,78 @@ class GetChatsCommand:
     def update(self, proto, msg=None, *args, **kwargs):
         code = getattr(msg, settings.RESPONSE, '')
         if code == 202:
-            Chat.chats_merge(getattr(msg, settings.LIST_INFO, []))
+            # без списка удаленных пришли все чаты
+            Chat.chats_merge(getattr(msg, settings.LIST_INFO, []), getattr(msg, settings.DELETED, None))
+            version = getattr(msg, settings.VERSION, None)
+            if version is not None:
+                SyncState.set_version(self.name, version)
             proto.notify(f'done_{self.name}')
         else:
-            proto.write(Message(**{
+            proto.write(Message.request(**{
                 settings.ACTION: settings.GET_CHATS,
                 settings.USER: settings.USER_NAME,
+                settings.SINCE: SyncState.get_version(self.name),
             }))
             proto.notify(f'send_{self.name}')
 
 
 class GetMessagesCommand:
+    """Получение недоставленных сообщений пачками."""
+
     name = settings.GET_MESSAGES
 
     def update(self, proto, msg=None, *args, **kwargs):
-        proto.write(Message(**{
-            settings.ACTION: self.name,
-            settings.USER: settings.USER_NAME,
-        }))
-        proto.notify(f'send_{self.name}')
+        code = getattr(msg, settings.RESPONSE, '')
+        if code == 202:
+            items = getattr(msg, settings.LIST_INFO, None) or []
+            last = {}
+            for item in items:
+                mes = Message(**item)
+                if MessageCommand.receive(proto, mes):
+                    last[(getattr(mes, settings.SENDER, None), mes.chat)] = mes
+            # интерфейс обновляется один раз на чат, а не на каждое сообщение
+            for mes in last.values():
+                proto.notify(f'new_{settings.MESSAGE}', mes)
+            if not items:
+                # пустая пачка - выдача закончена
+                proto.notify(f'done_{self.name}')
+        else:
+            proto.write(Message.request(**{
+                settings.ACTION: self.name,
+                settings.USER: settings.USER_NAME,
+                settings.LIMIT: settings.as_int('MESSAGES_BATCH'),
+            }))
+            proto.notify(f'send_{self.name}')
 
 
 class MessageCommand:
     name = settings.MESSAGE
 
     def update(self, proto, msg=None, *args, **kwargs):
-        if isinstance(msg, Message) and msg.is_valid():
-            sender = getattr(msg, settings.SENDER, None)
-            mes_ecrypted = base64.b64decode(str(msg))
-            decrypted_message = proto.decrypter.decrypt(mes_ecrypted)
-            Chat.create_msg(msg, text=decrypted_message.decode('utf8'))
+        if self.receive(proto, msg):
             proto.notify(f'new_{self.name}', msg)
-            logger.info(f'Получено сообщение от пользователя {sender}')
+
+    @staticmethod
+    def receive(proto, msg):
+        """Расшифровка и сохранение входящего сообщения.
+
+        Args:
+            proto: подключение
+            msg: сообщение
+
+        Returns:
+            Признак того что сообщение принято
+            bool
+
+        """
+        if not isinstance(msg, Message) or not msg.is_valid():
+            return False
+        sender = getattr(msg, settings.SENDER, None)
+        mes_ecrypted = base64.b64decode(str(msg))
+        decrypted_message = proto.decrypter.decrypt(mes_ecrypted)
+        Chat.create_msg(msg, text=decrypted_message.decode('utf8'))
+        logger.info(f'Получено сообщение от пользователя {sender}')
+        return True
 
 
 class SendMessageCommand:
@@ -359,7 +652,7 @@ class RequestKeyCommand:
             if not dest:
                 logger.info('Не указан контакт чей ключ нужно получить')
                 return
-            proto.write(Message(**{
+            proto.write(Message.request(**{
                 settings.ACTION: settings.PUBLIC_KEY_REQUEST,
                 settings.SENDER: settings.USER_NAME,
                 settings.DESTINATION: dest,
@@ -374,15 +667,47 @@ class RequestKeyCommand:
             proto.notify(f'done_{self.name}')
 
 
+class PingCommand:
+    """Ответ на ping сервера."""
+
+    name = settings.PING
+
+    def update(self, proto, msg, *args, **kwargs):
+        proto.write(Message(**{settings.ACTION: settings.PONG}))
+
+
+class PongCommand:
+    """Замер RTT по ответу сервера на ping.
+
+    Результат сохраняется в ``ClientTransport.rtt`` и рассылается
+    подписчикам события ``rtt``.
+    """
+
+    name = settings.PONG
+
+    def update(self, proto, msg, *args, **kwargs):
+        sent = getattr(msg, settings.DATA, None)
+        if sent is None:
+            return
+        rtt = proto._thread.loop.time() - float(sent)
+        proto._thread.rtt = rtt
+        proto.notify('rtt', rtt=rtt)
+
+
 router.reg_command(ClientAuth)
 router.reg_command(ClientError)
 router.reg_command(GetAllUsers)
+router.reg_command(GetAvatarCommand)
 router.reg_command(GetChatsCommand)
 router.reg_command(GetAllUsers, f'done_{settings.AUTH}')
 router.reg_command(GetChatsCommand, f'done_{settings.AUTH}')
+router.reg_command(GetMessagesCommand)
 router.reg_command(GetMessagesCommand, f'done_{settings.GET_CHATS}')
 router.reg_command(GetAllUsers, 205)
 router.reg_command(GetChatsCommand, 206)
 router.reg_command(MessageCommand)
 router.reg_command(RequestKeyCommand)
 router.reg_command(SendMessageCommand)
+router.reg_command(SlowDownCommand)
+router.reg_command(PingCommand)
+router.reg_command(PongCommand)
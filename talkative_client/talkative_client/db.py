@@ -12,8 +12,7 @@ import sqlalchemy as sa
 from dynaconf import settings
 from sqlalchemy import desc, func, or_
 from sqlalchemy.engine import Engine
-from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.ext.declarative.api import as_declarative
+from sqlalchemy.ext.declarative import as_declarative, declared_attr
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import backref, relationship, scoped_session, sessionmaker
 from sqlalchemy_utils import PasswordType
@@ -324,6 +323,20 @@ class User(Core):
         """Возвращает объект пользователя по его имени."""
         return cls.query().filter(func.lower(cls.username) == username.lower()).first()
 
+    @classmethod
+    def delete_names(cls, names):
+        """Удаление пользователей, удаленных на сервере.
+
+        Текущий пользователь не удаляется.
+
+        Args:
+            names: имена пользователей
+
+        """
+        names = {name.lower() for name in names} - {settings.USER_NAME.lower()}
+        if names:
+            cls.delete_qs(cls.query().filter(func.lower(cls.username).in_(names)).all())
+
     def get_last_login(self):
         """Хитрый способ получения времени последнего входа."""
         return getattr(UserHistory.query().filter_by(
@@ -579,7 +592,14 @@ class Chat(Core):
         return history
 
     @classmethod
-    def chats_merge(cls, lst):
+    def chats_merge(cls, lst, deleted=None):
+        """Слияние списка чатов с сервера.
+
+        Args:
+            lst: измененные чаты или все чаты пользователя
+            deleted: имена удаленных чатов, None - в lst все чаты (default: {None})
+
+        """
         for item in lst:
             cht = cls.filter_by(name=item.get('name')).first()
             members = item.pop('members', [])
@@ -601,11 +621,26 @@ class Chat(Core):
             with database_lock:
                 cht.save()
 
-        lst_cht = [i.get('name') for i in lst]
-        for x in cls.all():
-            if x.name not in lst_cht:
-                with database_lock:
-                    x.delete()
+        if deleted is None:
+            lst_cht = [i.get('name') for i in lst]
+            deleted = [x.name for x in cls.all() if x.name not in lst_cht]
+        for x in cls.query().filter(cls.name.in_(deleted)):
+            with database_lock:
+                x.delete()
+
+    @classmethod
+    def refresh_avatars(cls, users):
+        """Обновление аватаров личных чатов с пользователями.
+
+        Args:
+            users: пользователи со сменившимся аватаром
+
+        """
+        for user in users:
+            for chat in user.chats:
+                if chat.is_personal:
+                    with database_lock:
+                        chat.save()
 
     @classmethod
     def create_msg(cls, msg, text=''):
@@ -643,6 +678,35 @@ class Link(Base):
     user_id = sa.Column(sa.Integer, sa.ForeignKey('user.id'))
 
 
+class SyncState(Core):
+    """Версии синхронизированных с сервером списков.
+
+    Attributes:
+        id: Идентификатор
+        kind: список (действие запроса)
+        version: версия последней синхронизации
+
+    """
+
+    id = sa.Column(sa.Integer, sa.ForeignKey(Core.id, ondelete='CASCADE'), primary_key=True)  # noqa
+    kind = sa.Column(sa.String(30), unique=True, nullable=False)
+    version = sa.Column(sa.Integer, default=0)
+
+    @classmethod
+    def get_version(cls, kind):
+        """Версия списка, 0 - список еще не получен."""
+        state = cls.filter_by(kind=kind).first()
+        return state.version if state else 0
+
+    @classmethod
+    def set_version(cls, kind, version):
+        """Запись версии списка."""
+        state = cls.filter_by(kind=kind).first() or cls(kind=kind)
+        state.version = version
+        with database_lock:
+            state.save()
+
+
 # Отладка
 if __name__ == '__main__':
     import pprint
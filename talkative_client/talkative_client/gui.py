@@ -5,10 +5,12 @@
 # @Last Modified by:   MaxST
 # @Last Modified time: 2019-09-01 15:02:39
 
+import asyncio
 import base64
 import logging
 import sys
 import time
+import uuid
 from pathlib import Path
 
 from Cryptodome.Cipher import PKCS1_OAEP
@@ -345,11 +347,7 @@ class ClientMainWindow(SaveGeometryMixin, QMainWindow):
 
         self.chat_members = chat.members
         self.current_chat = chat.name
-        for cm in self.chat_members:
-            if self.current_user == cm:
-                continue
-            self.client.notify(settings.PUBLIC_KEY_REQUEST, contact=cm.username)
-        self.make_encryptor()
+        self.request_keys()
 
         self.lblContact.setText(f'{obj.username}')
         self.btnAddUser.setVisible(not chat.is_personal)
@@ -391,9 +389,28 @@ class ClientMainWindow(SaveGeometryMixin, QMainWindow):
             self.fill_chat()
 
     def should_update_contact(self, **kwargs):
-        self.update_contact()
+        self.update_contact(self.editFind.text())
         self.select_active_user(current_chat=self.current_chat)
 
+    def request_keys(self, wait=False):
+        """Запрос публичных ключей участников чата.
+
+        Args:
+            wait: дождаться ответов сервера (default: {False})
+
+        """
+        client = self.client
+        names = [cm.username for cm in self.chat_members if cm != self.current_user]
+        if wait:
+            try:
+                client.call(client.request_keys(names))
+            except asyncio.TimeoutError:
+                logger.warning(f'Сервер не прислал ключи для чата {self.current_chat}')
+        else:
+            for name in names:
+                client.notify(settings.PUBLIC_KEY_REQUEST, contact=name)
+        self.make_encryptor()
+
     def make_encryptor(self, **kwargs):
         with db_lock:
             self.encryptors = {u.username: PKCS1_OAEP.new(RSA.import_key(u.pub_key)) for u in self.chat_members if u.pub_key}
@@ -404,8 +421,7 @@ class ClientMainWindow(SaveGeometryMixin, QMainWindow):
         if not self.current_chat or not text:
             return
         if not self.encryptors:
-            self.select_active_user()
-            time.sleep(1)
+            self.request_keys(wait=True)
             if not self.encryptors:
                 logger.warn(f'Нет ключа для этого чата {self.current_chat}')
                 self.MsgBox.critical(self, 'Ошибка', 'Нет ключа для этого чата')
@@ -439,6 +455,7 @@ class ClientMainWindow(SaveGeometryMixin, QMainWindow):
             settings.DESTINATION: username,
             settings.MESSAGE_TEXT: text,
             'chat': self.current_chat,
+            settings.MESSAGE_ID: uuid.uuid4().hex,
         })
 
     def switch_list_state(self, state=None):
@@ -493,6 +510,9 @@ class ClientMainWindow(SaveGeometryMixin, QMainWindow):
 
     def search_contact(self, text):
         self.update_contact(text)
+        if self.contacts_list_state == 'new' and text:
+            # новые контакты ищет сервер, локально только уже загруженные
+            self.client.notify(settings.USERS_REQUEST, query=text)
 
     def send_chat(self, chat):
         self.client.notify(
@@ -10,6 +10,8 @@ import tempfile
 
 from io import StringIO
 from pathlib import Path
+
+from dynaconf import settings
 from yaml import dump, load
 
 try:
@@ -17,6 +19,11 @@ try:
 except ImportError:
     from yaml import Loader
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 
 class PrototypeDispatcher(object):
     """Диспетчер прототипов форматов."""
@@ -251,6 +258,48 @@ class Yaml(object):
         return dump(data, default_flow_style=False, allow_unicode=True, indent=4)
 
 
+class Msgpack(object):
+    """Компактный двоичный конвертер (MessagePack).
+
+    Ключи из настройки BINARY_KEYS передаются номером в этом списке
+    (один байт вместо строки), остальные - строками. Список общий для
+    клиента и сервера, новые ключи только дописываются в конец.
+    """
+
+    ids = None
+    names = None
+
+    @classmethod
+    def load_keys(cls):
+        if cls.ids is None:
+            keys = list(settings.get('BINARY_KEYS') or [])
+            cls.ids = {name: num for num, name in enumerate(keys)}
+            cls.names = dict(enumerate(keys))
+
+    def read(self, file_name):
+        with Path(file_name).open('rb') as f:
+            return self.reads(f.read())
+
+    def reads(self, data):
+        self.load_keys()
+        names = self.names
+        return {names.get(k, k): v for k, v in msgpack.unpackb(data, raw=False, strict_map_key=False).items()}
+
+    def write(self, data):
+        response = None
+        with tempfile.NamedTemporaryFile(mode='wb', prefix='test_file', suffix='.msgpack', delete=False) as ntf:
+            response = ntf.name
+            ntf.write(self.dumps(data))
+        return response
+
+    def dumps(self, data):
+        self.load_keys()
+        ids = self.ids
+        return msgpack.packb({ids.get(k, k): v for k, v in data.items()}, use_bin_type=True)
+
+
 dispatcher.register_object('csv', Csv)
 dispatcher.register_object('json', Json)
 dispatcher.register_object('yaml', Yaml)
+if msgpack:
+    dispatcher.register_object('msgpack', Msgpack)
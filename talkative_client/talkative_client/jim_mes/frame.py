@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""Разбор потока на кадры с префиксом длины.
+
+Старший бит длины - признак сжатого кадра. Сжатие включается для
+подключения после согласования в presence: у каждой стороны один поток
+zlib (raw deflate) на направление, заранее заполненный словарем ZDICT
+из ключей и типовых значений JIM, так что уже первые кадры сжимаются
+хорошо, а последующие используют историю предыдущих. Кадр завершается
+Z_SYNC_FLUSH, последние 4 байта (``00 00 ff ff``) не передаются.
+"""
+import struct
+import zlib
+
+HEADER = struct.Struct('>I')
+COMPRESSED = 0x80000000
+SYNC_TAIL = b'\x00\x00\xff\xff'
+
+# Словарь не меняется без смены версии протокола: он должен совпадать
+# у клиента и сервера байт в байт. Частые строки ближе к концу.
+ZDICT = (
+    b'{"action": "presence", "type": "status", "user": "", "pubkey": "-----BEGIN PUBLIC KEY-----\\n'
+    b'-----END PUBLIC KEY-----"}\r\n'
+    b'{"response": 511, "action": "auth", "bin": "", "compress": "zlib"}\r\n'
+    b'{"response": 400, "error": "", "response": 202, "data_list": [["", null], ["", "iVBORw0KGgo"]]}\r\n'
+    b'"get_users", "get_contacts", "get_chats", "get_messages", "add", "remove", "edit_chat", '
+    b'"del_chat", "edit_ava", "pubkey_need", "account_name", "exit", "ping", "pong", '
+    b'{"response": 205, "time": ""}\r\n{"response": 206, "time": ""}\r\n'
+    b'{"action": "message", "from": "", "to": "", "chat": null, "mess_text": "", "time": "2019-01-01 00:00:00"}\r\n'
+)
+
+
+class FrameError(ValueError):
+    """Ошибка разбора кадра."""
+
+
+class Deflater(object):
+    """Сжатие исходящих кадров одного подключения."""
+
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION):
+        """Инициализация.
+
+        Args:
+            level: уровень сжатия zlib (default: {zlib.Z_DEFAULT_COMPRESSION})
+
+        """
+        super().__init__()
+        self.stream = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=ZDICT)
+
+    def __call__(self, data):
+        """Сжатие данных кадра.
+
+        Args:
+            data: данные кадра
+
+        Returns:
+            Сжатые данные без завершающего маркера Z_SYNC_FLUSH
+            bytes
+
+        """
+        return (self.stream.compress(data) + self.stream.flush(zlib.Z_SYNC_FLUSH))[:-len(SYNC_TAIL)]
+
+
+def encode(data, deflater=None):
+    """Заголовок и данные кадра.
+
+    Args:
+        data: данные кадра
+        deflater: :py:class:`Deflater` подключения, если сжатие включено (default: {None})
+
+    Returns:
+        Заголовок и данные (возможно сжатые)
+        tuple
+
+    """
+    if deflater is None:
+        return HEADER.pack(len(data)), data
+    data = deflater(data)
+    return HEADER.pack(len(data) | COMPRESSED), data
+
+
+class FrameDecoder(object):
+    """Инкрементальный декодер кадров.
+
+    Кадр это 4 байта длины (big-endian) и сами данные. За один вызов
+    :py:meth:`feed` извлекается любое количество кадров, заголовок и
+    данные могут быть разорваны между вызовами произвольно.
+
+    Данные кадра копируются ровно один раз: либо срезом из пришедшего
+    блока, если кадр пришел целиком, либо в заранее выделенный под
+    полный размер ``bytearray``, который и отдается наружу.
+
+    Сжатые кадры распаковываются только после
+    :py:meth:`enable_compression`, ограничение max_size действует и на
+    распакованные данные. Клиент узнает о сжатии из ответа 511, за
+    которым в том же блоке могут прийти уже сжатые кадры: с ``hold``
+    разбор останавливается на первом из них, а остаток потока ждет
+    :py:meth:`resume` после включения сжатия.
+
+    Attributes:
+        max_size: максимальный размер данных кадра (None - без ограничения)
+        hold: откладывать сжатые кадры до включения сжатия вместо ошибки
+        inflater: поток распаковки, если сжатие включено
+
+    """
+
+    def __init__(self, max_size=None, hold=False):
+        """Инициализация.
+
+        Args:
+            max_size: максимальный размер данных кадра (default: {None})
+            hold: откладывать сжатые кадры до включения сжатия (default: {False})
+
+        """
+        super().__init__()
+        self.max_size = max_size
+        self.hold = hold
+        self._held = None
+        self._header = bytearray()
+        self._payload = None
+        self._filled = 0
+        self._compressed = False
+        self.inflater = None
+
+    def enable_compression(self):
+        """Разрешение сжатых кадров (после согласования в presence)."""
+        if self.inflater is None:
+            self.inflater = zlib.decompressobj(-zlib.MAX_WBITS, zdict=ZDICT)
+
+    def inflate(self, data):
+        """Распаковка сжатого кадра.
+
+        Raises:
+            FrameError: если сжатие не включено или данные повреждены
+
+        """
+        if self.inflater is None:
+            raise FrameError('Сжатый кадр до согласования сжатия')
+        try:
+            data = self.inflater.decompress(bytes(data) + SYNC_TAIL, self.max_size or 0)
+        except zlib.error as error:
+            raise FrameError(f'Ошибка распаковки кадра: {error}')
+        if self.inflater.unconsumed_tail:
+            raise FrameError(f'Распакованный кадр превышает допустимый размер {self.max_size}')
+        return data
+
+    def resume(self):
+        """Разбор отложенных кадров после :py:meth:`enable_compression`.
+
+        Returns:
+            Список данных собранных кадров, пустой если отложенного нет
+            или сжатие еще не включено
+            list
+
+        """
+        if self._held is None or self.inflater is None:
+            return []
+        return self.feed(b'')
+
+    def feed(self, data):
+        """Разбор очередного блока данных.
+
+        Args:
+            data: пришедшие байты
+
+        Returns:
+            Список данных полностью собранных кадров
+            list
+
+        Raises:
+            FrameError: если размер кадра больше max_size или кадр не распаковывается
+
+        """
+        if self._held is not None:
+            if self.inflater is None:
+                self._held += data
+                return []
+            data, self._held = bytes(self._held) + bytes(data), None
+        frames = []
+        view = memoryview(data)
+        pos, end = 0, len(view)
+        header_size = HEADER.size
+        while pos < end:
+            if self._payload is None:
+                if not self._header and end - pos >= header_size:
+                    size = HEADER.unpack_from(view, pos)[0]
+                    pos += header_size
+                else:
+                    need = min(header_size - len(self._header), end - pos)
+                    self._header += view[pos:pos + need]
+                    pos += need
+                    if len(self._header) < header_size:
+                        break
+                    size = HEADER.unpack(self._header)[0]
+                    self._header.clear()
+
+                compressed = size & COMPRESSED
+                if compressed and self.inflater is None and self.hold:
+                    self._held = bytearray(HEADER.pack(size))
+                    self._held += view[pos:]
+                    break
+                size &= ~COMPRESSED
+                if self.max_size and size > self.max_size:
+                    raise FrameError(f'Размер кадра {size} превышает допустимый {self.max_size}')
+                if not size:
+                    continue
+                if end - pos >= size:
+                    frame = view[pos:pos + size]
+                    frames.append(self.inflate(frame) if compressed else bytes(frame))
+                    pos += size
+                    continue
+                self._payload = bytearray(size)
+                self._filled = 0
+                self._compressed = compressed
+
+            chunk = min(len(self._payload) - self._filled, end - pos)
+            self._payload[self._filled:self._filled + chunk] = view[pos:pos + chunk]
+            self._filled += chunk
+            pos += chunk
+            if self._filled == len(self._payload):
+                frames.append(self.inflate(self._payload) if self._compressed else self._payload)
+                self._payload = None
+        view.release()
+        return frames
@@ -4,6 +4,7 @@
 # @Last Modified by:   MaxST
 # @Last Modified time: 2019-08-31 22:23:16
 import logging
+import uuid
 
 from dynaconf import settings
 from tabulate import tabulate
@@ -28,6 +29,7 @@ class MessageCommand(AbstractCommand):
             settings.SENDER: settings.USER_NAME,
             settings.DESTINATION: to,
             settings.MESSAGE_TEXT: message_txt,
+            settings.MESSAGE_ID: uuid.uuid4().hex,
         })
         logger.debug(f'Сформировао сообщение: {message} для {to}')
         client.send_message(message)
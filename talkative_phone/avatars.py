@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Кэш аватаров на диске.
+
+Файл называется хешем содержимого аватара на сервере, поэтому
+неизменившийся аватар повторно не запрашивается, а одинаковые аватары
+разных пользователей хранятся один раз.
+"""
+import logging
+import os
+import re
+import tempfile
+from pathlib import Path
+
+from dynaconf import settings
+
+logger = logging.getLogger('avatars')
+HASH_RE = re.compile(r'[0-9a-f]{40}')
+
+
+class AvatarCache(object):
+    """Каталог аватаров, адресуемых хешем содержимого."""
+
+    def __init__(self, path=None):
+        """Инициализация.
+
+        Args:
+            path: каталог кэша (default: {AVATAR_CACHE})
+
+        """
+        super().__init__()
+        self.path = Path(path or settings.get('AVATAR_CACHE'))
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def file(self, hash_):
+        # хеш приходит с сервера, в путь попадает только проверенный
+        if not isinstance(hash_, str) or not HASH_RE.fullmatch(hash_):
+            raise ValueError(f'Неверный хеш аватара {hash_!r}')
+        return self.path.joinpath(hash_)
+
+    def get(self, hash_):
+        """Аватар из кэша.
+
+        Args:
+            hash_: хеш содержимого
+
+        Returns:
+            Данные аватара или None если его нет в кэше
+            bytes
+
+        """
+        try:
+            return self.file(hash_).read_bytes()
+        except (OSError, ValueError):
+            return None
+
+    def put(self, hash_, data):
+        """Сохранение аватара.
+
+        Запись идет во временный файл с последующей заменой, так что
+        прерванная запись не оставляет в кэше битый файл.
+
+        Args:
+            hash_: хеш содержимого
+            data: данные аватара
+
+        """
+        try:
+            target = self.file(hash_)
+            fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, target)
+        except (OSError, ValueError) as error:
+            logger.warning(f'Аватар не сохранен в кэш: {error}')
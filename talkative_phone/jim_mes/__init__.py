@@ -2,3 +2,4 @@
 """Модуль преобразования такста в объект сообщения."""
 from .jim import Message  # noqa
 from .convert import Converter, dispatcher # noqa
+from .frame import Deflater, FrameDecoder, FrameError  # noqa
@@ -3,9 +3,10 @@
 # @Date:   2019-09-14 16:58:29
 # @Last Modified by:   MaxST
 # @Last Modified time: 2019-09-14 19:30:42
+import asyncio
 import base64
 import logging
-import time
+import uuid
 
 from Cryptodome.Cipher import PKCS1_OAEP
 from Cryptodome.PublicKey import RSA
@@ -108,6 +109,25 @@ class CommonGUI:
     def critical(self, msg):
         logger.critical(msg)
 
+    def request_keys(self, wait=False):
+        """Запрос публичных ключей участников чата.
+
+        Args:
+            wait: дождаться ответов сервера (default: {False})
+
+        """
+        client = self.get_client()
+        names = [cm.username for cm in self.chat_members if cm != self.current_user]
+        if wait:
+            try:
+                client.call(client.request_keys(names))
+            except asyncio.TimeoutError:
+                logger.warning(f'Сервер не прислал ключи для чата {self.current_chat}')
+        else:
+            for name in names:
+                client.notify(settings.PUBLIC_KEY_REQUEST, contact=name)
+        self.make_encryptor()
+
     def make_encryptor(self, **kwargs):
         with db_lock:
             self.encryptors = {u.username: PKCS1_OAEP.new(RSA.import_key(u.pub_key)) for u in self.chat_members if u.pub_key}
@@ -134,12 +154,7 @@ class CommonGUI:
         self.current_chat = chat.name
         self.set_current_chat(chat)
         self.set_view_obj(obj)
-        client = self.get_client()
-        for cm in self.chat_members:
-            if self.current_user == cm:
-                continue
-            client.notify(settings.PUBLIC_KEY_REQUEST, contact=cm.username)
-        self.make_encryptor()
+        self.request_keys()
 
         if obj:
             self.fill_chat()
@@ -159,8 +174,7 @@ class CommonGUI:
         if not self.current_chat or not text:
             return
         if not self.encryptors:
-            self.set_active()
-            time.sleep(1)
+            self.request_keys(wait=True)
             if not self.encryptors:
                 logger.warn(f'Нет ключа для этого чата {self.current_chat}')
                 self.critical('Нет ключа для этого чата')
@@ -194,4 +208,5 @@ class CommonGUI:
             settings.DESTINATION: username,
             settings.MESSAGE_TEXT: text,
             'chat': self.current_chat,
+            settings.MESSAGE_ID: uuid.uuid4().hex,
         })
@@ -12,9 +12,61 @@ DEBUG_SQL = False
 # network
 PORT = 7777
 HOST = '127.0.0.1'
-MAX_CONNECTIONS = 5
-MAX_PACKAGE_LENGTH = 1024
+LISTEN_BACKLOG = 1024  # очередь подключений ожидающих accept
+MAX_PACKAGE_LENGTH = 16 * 1024 * 1024  # списки пользователей содержат аватары
+COMPRESSION = True  # сжимать кадры подключений запросивших сжатие
+COMPRESSION_LEVEL = 6
+CODECS = ['msgpack']  # кодеки которые сервер согласует вместо JSON
+USERS_PAGE_LIMIT = 100  # максимум пользователей в ответе на поиск get_users
+MESSAGES_BATCH = 200  # максимум недоставленных сообщений в одном кадре
+USER_CACHE_SIZE = 1024  # пользователей в кэше поиска по имени, 0 - без кэша
+USER_CACHE_TTL = 30  # сек, за это время видны изменения сделанные другими воркерами кластера
+HISTORY_BATCH = 500  # событий истории в одной записи в БД
+HISTORY_DELAY = 1.0  # сек, максимальная задержка записи истории
+HISTORY_BUFFER = 10000  # событий в очереди записи, при переполнении запрос ждет записи
 ENCODING = 'utf-8'
+LOOP = 'uvloop'  # цикл событий: 'uvloop' или 'asyncio' (если uvloop не установлен)
+
+# Профиль сокетов (None - значение ОС по умолчанию)
+TCP_NODELAY = True  # без задержки Нейгла для мелких кадров
+SO_KEEPALIVE = True
+TCP_KEEPIDLE = 60  # сек
+TCP_KEEPINTVL = 10  # сек
+TCP_KEEPCNT = 5
+SO_SNDBUF = None
+SO_RCVBUF = None
+
+# Многопроцессный режим
+WORKERS = 1
+BROKER_SOCKET = None  # по умолчанию talkative_<PORT>.sock во временном каталоге
+WORKER_STOP_TIMEOUT = 10  # сек на завершение воркеров после SIGTERM
+
+# Очередь отправки подключения
+SEND_QUEUE_SIZE = 1000  # кадров
+SEND_QUEUE_POLICY = 'spill'  # spill | drop | disconnect
+WRITE_BUFFER_HIGH = 256 * 1024
+WRITE_BUFFER_LOW = 64 * 1024
+
+# Уведомления 205/206 в пределах окна объединяются в одно
+UPDATE_LISTS_DELAY = 0.3  # сек
+
+# Контроль активности подключений
+PING_INTERVAL = 30  # сек тишины до ping клиенту
+IDLE_TIMEOUT = 90  # сек без входящих данных до разрыва
+AUTH_TIMEOUT = 30  # сек на авторизацию после подключения
+TIMER_TICK = 1  # шаг колеса таймеров, сек
+TIMER_SLOTS = 512
+
+# Ограничение частоты запросов: [запросов в сек, запас]
+RATE_LIMITS = {
+    'message': [20, 50],
+    'get_users': [5, 10],  # поиск по мере ввода
+    'get_avatar': [2, 10],
+    'get_messages': [1, 5],
+    'edit_ava': [0.2, 2],
+    'pubkey_need': [5, 20],
+}
+RATE_LIMIT_USER = [50, 100]  # на все действия пользователя вместе
 
 # log
 LOGGING_LEVEL = logging.DEBUG
@@ -29,11 +81,21 @@ SENDER = 'from'
 TIME = 'time'
 USER = 'user'
 
+# Номера ключей для двоичного кодека, порядок не менять - только дописывать
+BINARY_KEYS = [
+    'action', 'response', 'time', 'from', 'to', 'mess_text', 'chat', 'user',
+    'bin', 'data_list', 'error', 'account_name', 'pubkey', 'type', 'compress',
+    'codec', 'retry_after', 'id', 'query', 'limit', 'cursor', 'avatars',
+    'since', 'version', 'deleted',
+]
+
 # Прочие ключи, используемые в протоколе
 ADD_CONTACT = 'add'
 EDIT_CHAT = 'edit_chat'
 DEL_CHAT = 'del_chat'
 AVA_INFO = 'edit_ava'
+AVATARS = 'avatars'
+GET_AVATAR = 'get_avatar'
 AUTH = 'auth'
 DEL_CONTACT = 'remove'
 ERROR = 'error'
@@ -44,6 +106,18 @@ GET_MESSAGES = 'get_messages'
 LIST_INFO = 'data_list'
 MESSAGE = 'message'
 MESSAGE_TEXT = 'mess_text'
+MESSAGE_ID = 'id'
+QUERY = 'query'
+LIMIT = 'limit'
+CURSOR = 'cursor'
+SINCE = 'since'
+VERSION = 'version'
+DELETED = 'deleted'
+PING = 'ping'
+PONG = 'pong'
+COMPRESS = 'compress'
+CODEC = 'codec'
+RETRY_AFTER = 'retry_after'
 PRESENCE = 'presence'
 PUBLIC_KEY = 'pubkey'
 PUBLIC_KEY_REQUEST = 'pubkey_need'
@@ -75,8 +149,8 @@ DATABASES = {
 
 # Oper
 USER_NAME = None
-GUI = True  # do gui start default?
-CONSOLE = not GUI  # do console start default?
+GUI = False  # do gui start default? (без GUI и cli сервер работает в фоне)
+CONSOLE = False  # do console start default?
 NO_ASYNC = False
 
 # Colors
@@ -12,12 +12,11 @@ import time
 from pathlib import Path
 
 from dynaconf import settings
-from PyQt5.QtWidgets import QApplication
 
 from talkative_server.async_core import ServerA
 from talkative_server.cli import CommandLineInterface
+from talkative_server.cluster import ClusterClient, Supervisor
 from talkative_server.core import Server
-from talkative_server.gui import ServerGUI
 
 if getattr(sys, 'frozen', False):
     # frozen
@@ -37,6 +36,9 @@ def arg_parser():
     parser.add_argument('-a', '--host', nargs='?', help=f'IP (default "{settings.get("HOST")}")')
     parser.add_argument('-p', '--port', nargs='?', help=f'Port (default "{settings.get("PORT")}")')
     parser.add_argument('--no-async', dest='no_async', action='store_true', help='Start do not async server')
+    parser.add_argument('--loop', choices=('uvloop', 'asyncio'), help=f'Event loop (default "{settings.get("LOOP")}")')
+    parser.add_argument('-w', '--workers', type=int, help=f'Start N server processes on one port (default "{settings.get("WORKERS")}")')
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
     parser.set_defaults(no_async=False)
     parser.add_argument(
         '-v',
@@ -119,22 +121,34 @@ for item in p.rglob('*.py'):
         continue
     __import__(f'talkative_server.{item.parent.stem}.{item.stem}', globals(), locals())
 
+if settings.get('worker'):
+    serv = ServerA()
+    serv.cluster = ClusterClient(serv)
+    serv.run()
+    sys.exit(0)
+elif settings.as_int('WORKERS') > 1:
+    Supervisor(settings.as_int('WORKERS')).run()
+    sys.exit(0)
+
 if settings.get('no_async'):
     serv = Server()
     serv.daemon = True
-    serv.start()
 else:
     serv = ServerA()
 
-
-time.sleep(1)
-
 if settings.get('console'):
-    CommandLineInterface().main_loop()
+    serv.start()
+    time.sleep(1)
+    CommandLineInterface(serv).main_loop()
 elif settings.get('gui'):
+    # Qt загружается только для GUI, окно само запускает сервер
+    from PyQt5.QtWidgets import QApplication
+    from talkative_server.gui import ServerGUI
+
     sys.argv += ['-style', 'Fusion']
     app = QApplication(sys.argv)
     ServerGUI(serv)
     sys.exit(app.exec_())
 else:
-    pass
+    # Фоновый режим: цикл событий в основном потоке
+    serv.run()
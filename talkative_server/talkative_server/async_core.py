@@ -7,18 +7,24 @@ import asyncio
 import base64
 import binascii
 import hmac
+import inspect
 import logging
+import math
 import os
+import signal
 import socket
-import struct
+import threading
+from collections import deque
+from functools import partial
 
 from dynaconf import settings
-from PyQt5.QtCore import QObject, QThread, pyqtSignal
 
 from .db import DBManager
-from .decorators import login_required_db  # noqa
+from .decorators import session_required
 from .descriptors import PortDescr
-from .jim_mes import Message
+from .jim_mes import Deflater, FrameDecoder, FrameError, Message, dispatcher
+from .jim_mes.frame import HEADER, encode
+from .sockets import tune_socket
 
 # from .metaclasses import ServerVerifier
 
@@ -27,10 +33,34 @@ logger = logging.getLogger(app_name)
 db = DBManager(app_name)
 
 
-class ServerA(QThread):
+def loop_policy():
+    """Политика цикла событий из настройки LOOP.
+
+    Returns:
+        Политика uvloop если она выбрана и установлена, иначе стандартная
+        asyncio.AbstractEventLoopPolicy
+
+    """
+    if settings.get('LOOP', 'asyncio') == 'uvloop':
+        try:
+            import uvloop
+        except ImportError:
+            logger.warning('uvloop не установлен, используется стандартный цикл asyncio')
+        else:
+            return uvloop.EventLoopPolicy()
+    return asyncio.DefaultEventLoopPolicy()
+
+
+class ServerA(object):
     """Асинхронный сервер
 
-    not support cli yet
+    Чистый asyncio без зависимости от Qt. В фоновом режиме (без GUI)
+    :py:meth:`run` вызывается в основном потоке, для GUI и cli сервер
+    запускается в отдельном потоке через :py:meth:`start`.
+
+    Подписчиком события может быть объект с методом ``update`` или любой
+    вызываемый объект, оба получают одинаковые именованные аргументы.
+    GUI подписывается через свой мост в поток Qt (см. ``gui.QtObserver``).
 
     Attributes:
         port: [description]
@@ -50,13 +80,21 @@ class ServerA(QThread):
     """
 
     port = PortDescr()
-    update = pyqtSignal(dict)
 
     def __init__(self):
         super().__init__()
         self.started = False
+        self.thread = None
+        self.loop = None
         self._observers = {}
         self.auth = {}
+        self.users = ConnectionRegistry()
+        self.protocols = set()
+        self.cluster = None
+        self.pending_updates = {}
+        self.updates_timer = None
+        self.wheel = None
+        self.limiter = RateLimiter(settings.get('RATE_LIMITS') or {}, settings.get('RATE_LIMIT_USER'))
         self.protocol = None
         self.router = router.init(self)
 
@@ -65,9 +103,14 @@ class ServerA(QThread):
         self.sock = socket.socket()
         self.port = settings.as_int('PORT')
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if settings.get('worker'):
+            # Воркеры многопроцессного режима слушают один порт
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # буферы задаются до listen, что бы их унаследовали подключения
+        tune_socket(self.sock)
         self.sock.bind((settings.get('host'), self.port))
         self.sock.settimeout(0.5)
-        self.sock.listen(settings.get('max_connections'))
+        self.sock.listen(settings.as_int('LISTEN_BACKLOG'))
         self.started = True
         logger.info(f'start with {settings.get("host")}:{self.port}')
         self.notify('start_server')
@@ -75,15 +118,28 @@ class ServerA(QThread):
     async def async_start(self):
         self.loop = asyncio.get_running_loop()
         self.server = await self.loop.create_server(lambda: AsyncServerProtocol(self), sock=self.sock)
+        self.ping_frame = bytes(Message(**{settings.ACTION: settings.PING}))
+        self.wheel = TimerWheel(self.check_idle, settings.as_float('TIMER_TICK'), settings.as_int('TIMER_SLOTS'))
+        self.wheel.start(self.loop)
+        if self.cluster:
+            await self.cluster.connect()
+        try:
+            # воркеры кластера останавливаются супервизором по SIGTERM
+            self.loop.add_signal_handler(signal.SIGTERM, self.server.close)
+        except (NotImplementedError, RuntimeError, ValueError):
+            pass
 
         try:
             async with self.server:
                 await self.server.serve_forever()
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, asyncio.CancelledError):
             logger.debug('closed')
         except Exception as error:
             logger.error(error, exc_info=True)
         finally:
+            self.wheel.stop()
+            # остаток истории записывается до выхода
+            await self.loop.run_in_executor(None, db.history.close)
             logger.debug('stoped')
             self.notify('stoped_server')
 
@@ -91,29 +147,45 @@ class ServerA(QThread):
         self.notify('init_db')
         self.init_socket()
         self.notify('init_socket')
+        asyncio.set_event_loop_policy(loop_policy())
         asyncio.run(self.async_start())
 
+    def start(self):
+        """Запуск сервера в фоновом потоке."""
+        self.thread = threading.Thread(target=self.run, name='ServerA', daemon=True)
+        self.thread.start()
+
     def stop(self):
         self.started = False
-        self.server.close()
+        if self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.server.close)
         self.sock.close()
         logger.debug('stoped')
 
     def is_alive(self):
-        return self.started
+        return bool(self.thread and self.thread.is_alive())
 
     def notify(self, event, proto=None, msg=None, **kwargs):
+        """Уведомление подписчиков о событии.
+
+        Returns:
+            Список ожидаемых объектов от асинхронных обработчиков
+            list
+
+        """
         logger.info(f'Свершилось событие {event}')
         obs = self._observers.get(event, []) or []
         kwargs['event'] = event
         kwargs['thread'] = self
         protocol = proto or self.protocol
+        pending = []
 
         for observer in obs:
-            if isinstance(observer, QObject):
-                self.update.emit({**{'proto': protocol, 'msg': msg}, **kwargs})
-            else:
-                observer.update(proto=protocol, msg=msg, **kwargs)
+            handler = getattr(observer, 'update', observer)
+            result = handler(proto=protocol, msg=msg, **kwargs)
+            if inspect.isawaitable(result):
+                pending.append(result)
+        return pending
 
     def attach(self, observer, event):
         obs = self._observers.get(event, []) or []
@@ -128,106 +200,824 @@ class ServerA(QThread):
         self._observers[event] = obs
         logger.info(f'{observer} отписался от события {event}')
 
+    def queue_stats(self):
+        """Метрики очередей отправки по подключениям.
+
+        Returns:
+            Список диктов с именем пользователя, адресом и метриками очереди
+            list
+
+        """
+        return [{
+            'user': self.users.name_of(proto),
+            'peer': proto.transport.get_extra_info('peername'),
+            **proto.queue.stats(),
+        } for proto in list(self.protocols)]
+
+    def login(self, proto, username):
+        """Регистрация подключения авторизованного пользователя."""
+        self.users.add(username, proto)
+        if self.cluster:
+            self.cluster.online(username)
+
+    def logout(self, proto):
+        """Удаление подключения из реестра.
+
+        Returns:
+            Имя пользователя которому принадлежало подключение
+            str
+
+        """
+        username = self.users.remove(proto)
+        if username and self.cluster:
+            self.cluster.offline(username)
+        return username
+
+    def check_idle(self, proto):
+        """Проверка подключения по сработавшему таймеру колеса.
+
+        Входящие данные только обновляют время активности подключения,
+        колесо не трогается. Когда таймер срабатывает, подключение либо
+        разрывается, либо получает ping, либо переставляется на момент
+        когда его тишина достигнет PING_INTERVAL.
+
+        Args:
+            proto: экземпляр :py:class:`AsyncServerProtocol`
+
+        """
+        if proto.transport.is_closing():
+            return
+        now = self.loop.time()
+        idle = now - proto.last_seen
+        auth_left = None
+        if self.users.name_of(proto) is None:
+            auth_left = proto.connected + settings.as_float('AUTH_TIMEOUT') - now
+            if auth_left <= 0:
+                logger.info(f'Подключение {proto.peername} не авторизовалось, разрыв')
+                proto.transport.abort()
+                return
+        if idle >= settings.as_float('IDLE_TIMEOUT'):
+            logger.info(f'Подключение {proto.peername} молчит {idle:.0f} сек, разрыв')
+            proto.transport.abort()
+            return
+        interval = settings.as_float('PING_INTERVAL')
+        if idle >= interval:
+            proto.write(self.ping_frame)
+            delay = min(interval, settings.as_float('IDLE_TIMEOUT') - idle)
+        else:
+            delay = interval - idle
+        self.wheel.add(proto, delay if auth_left is None else min(delay, auth_left))
+
     def run_command(self, proto, mes):
         action = getattr(mes, settings.ACTION, None) or getattr(mes, settings.RESPONSE, None)
+        if action and action != settings.EXIT:
+            # корзины пользователя переживают переподключение
+            key = self.users.name_of(proto) or proto
+            retry_after = self.limiter.check(key, action, self.loop.time())
+            if retry_after:
+                logger.warning(f'Лимит {action} для {key if isinstance(key, str) else proto.peername}')
+                proto.write(Message.slow_down(retry_after, **{settings.ACTION: action}))
+                return []
         if action:
-            self.notify(action, proto, mes)
+            return self.notify(action, proto, mes)
+        logger.debug(f'Пустая команда {action}')
+        return []
+
+    async def dispatch(self, proto, mes):
+        """Выполнение команды с ожиданием асинхронных обработчиков.
+
+        Args:
+            proto: экземпляр :py:class:`AsyncServerProtocol`
+            mes: экземпляр :py:class:`~jim_mes.Message`
+
+        """
+        for pending in self.run_command(proto, mes):
+            await pending
+
+    def in_loop(self):
+        """Признак того что вызов сделан из потока цикла событий сервера."""
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def broadcast(self, msg, excep=None):
+        """Рассылка сообщения всем подключениям.
+
+        Сообщение кодируется один раз на кодек, всем получателям с одним
+        кодеком уходят одни и те же байты.
+
+        Args:
+            msg: :py:class:`~jim_mes.Message` или готовые байты
+            excep: подключение которому не отправлять (default: {None})
+
+        """
+        encoded = {}
+        for proto in list(self.protocols):
+            if proto is excep:
+                continue
+            if isinstance(msg, bytes):
+                data = msg
+            else:
+                data = encoded.get(proto.codec)
+                if data is None:
+                    data = encoded[proto.codec] = msg.encode(proto.codec)
+            proto.write(data)
+
+    def service_update_lists(self, code=205, excep=None, propagate=True):
+        """Требование клиентам обновить списки.
+
+        Уведомления копятся UPDATE_LISTS_DELAY секунд, за это время
+        каждый код рассылается не больше одного раза. Можно вызывать
+        из любого потока.
+
+        Args:
+            code: 205 - пользователи, 206 - чаты (default: {205})
+            excep: подключение инициатор, ему не отправлять (default: {None})
+            propagate: разослать другим воркерам (default: {True})
+
+        """
+        if not self.loop:
+            return
+        if not self.in_loop():
+            self.loop.call_soon_threadsafe(self.service_update_lists, code, excep, propagate)
+            return
+        if code in self.pending_updates:
+            pending_excep, pending_propagate = self.pending_updates[code]
+            # у объединенного уведомления разные инициаторы - получат все
+            excep = excep if excep is pending_excep else None
+            propagate = propagate or pending_propagate
+        self.pending_updates[code] = (excep, propagate)
+        if not self.updates_timer:
+            self.updates_timer = self.loop.call_later(settings.as_float('UPDATE_LISTS_DELAY'), self.flush_updates)
+
+    def flush_updates(self):
+        """Рассылка накопленных уведомлений об обновлении списков."""
+        self.updates_timer = None
+        pending, self.pending_updates = self.pending_updates, {}
+        for code, (excep, propagate) in pending.items():
+            if propagate and self.cluster:
+                self.cluster.broadcast(code)
+            self.broadcast(Message(response=code), excep)
+
+
+class ConnectionRegistry(object):
+    """Реестр подключенных пользователей.
+
+    Хранит соответствие имени пользователя его протоколу и обратное,
+    что бы маршрутизация сообщений не требовала обращений к БД.
+    Имена сравниваются без учета регистра, как и в :py:meth:`~db_mongo.User.by_name`.
+
+    """
+
+    def __init__(self):
+        """Инициализация."""
+        super().__init__()
+        self._by_name = {}
+        self._by_proto = {}
+
+    def add(self, username, proto):
+        """Регистрация подключения пользователя.
+
+        Args:
+            username: имя пользователя
+            proto: экземпляр :py:class:`AsyncServerProtocol`
+
+        """
+        self.remove(proto)
+        old = self._by_name.get(username.lower())
+        if old is not None:
+            self._by_proto.pop(old, None)
+        self._by_name[username.lower()] = proto
+        self._by_proto[proto] = username
+
+    def remove(self, proto):
+        """Удаление подключения.
+
+        Args:
+            proto: экземпляр :py:class:`AsyncServerProtocol`
+
+        Returns:
+            Имя пользователя которому принадлежало подключение
+            str
+
+        """
+        username = self._by_proto.pop(proto, None)
+        if username is not None and self._by_name.get(username.lower()) is proto:
+            del self._by_name[username.lower()]
+        return username
+
+    def get(self, username):
+        """Протокол пользователя по имени."""
+        return self._by_name.get(username.lower()) if username else None
+
+    def name_of(self, proto):
+        """Имя пользователя по протоколу."""
+        return self._by_proto.get(proto)
+
+    def __len__(self):
+        """Количество подключенных пользователей."""
+        return len(self._by_proto)
+
+    def __iter__(self):
+        """Перебор протоколов подключенных пользователей."""
+        return iter(tuple(self._by_proto))
+
+
+class SendQueue(object):
+    """Очередь отправки одного подключения.
+
+    Кадры копятся в очереди и отправляются одним ``writelines`` за
+    итерацию цикла событий. Пока транспорт просит паузу (буфер записи
+    выше верхней отметки) кадры остаются в очереди. При переполнении
+    очереди применяется политика медленного клиента:
+
+    * ``spill`` - сообщения чата сохраняются в БД как недоставленные,
+      остальные кадры отбрасываются;
+    * ``drop`` - кадр отбрасывается;
+    * ``disconnect`` - сообщение чата сохраняется как недоставленное,
+      подключение разрывается.
+
+    Attributes:
+        POLICIES: допустимые политики
+        maxsize: максимальное количество кадров в очереди
+        policy: политика при переполнении
+        paused: признак паузы записи
+        peak: максимальная глубина очереди
+        dropped: количество отброшенных кадров
+        spilled: количество сообщений сохраненных в БД
+
+    """
+
+    POLICIES = ('spill', 'drop', 'disconnect')
+
+    def __init__(self, transport, maxsize=1000, policy='spill'):
+        """Инициализация.
+
+        Args:
+            transport: транспорт подключения
+            maxsize: максимальное количество кадров (default: {1000})
+            policy: политика при переполнении (default: {'spill'})
+
+        Raises:
+            ValueError: при неизвестной политике
+
+        """
+        super().__init__()
+        if policy not in self.POLICIES:
+            raise ValueError(f'Неизвестная политика очереди {policy}')
+        self.transport = transport
+        self.maxsize = maxsize
+        self.policy = policy
+        self.frames = deque()
+        self.deflater = None
+        self.paused = False
+        self.peak = 0
+        self.dropped = 0
+        self.spilled = 0
+        self._scheduled = False
+
+    def __len__(self):
+        """Глубина очереди."""
+        return len(self.frames)
+
+    def put(self, data, msg=None):
+        """Постановка кадра в очередь.
+
+        Args:
+            data: данные кадра без заголовка
+            msg: исходное сообщение, нужно для сохранения в БД (default: {None})
+
+        Returns:
+            Признак того что кадр поставлен в очередь
+            bool
+
+        """
+        if self.transport.is_closing():
+            self.spill(msg)
+            return False
+        if len(self.frames) >= self.maxsize:
+            self.overflow(msg)
+            return False
+        self.frames.append(data)
+        self.peak = max(self.peak, len(self.frames))
+        self.schedule()
+        return True
+
+    def start_compression(self, deflater):
+        """Сжатие кадров поставленных в очередь после этого вызова.
+
+        Кадры сжимаются при отправке, что бы отброшенные кадры не
+        попадали в поток сжатия. Поэтому при непустой очереди момент
+        включения отмечается в ней самой.
+
+        Args:
+            deflater: :py:class:`~jim_mes.Deflater` подключения
+
+        """
+        if self.frames:
+            self.frames.append(deflater)
         else:
-            logger.debug(f'Пустая команда {action}')
+            self.deflater = deflater
+
+    def schedule(self):
+        """Планирование отправки на следующую итерацию цикла."""
+        if not self._scheduled and not self.paused:
+            self._scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        """Отправка накопленных кадров.
+
+        За раз отправляется не больше чем помещается до верхней отметки
+        буфера транспорта, остаток ждет следующей итерации или resume.
+
+        """
+        self._scheduled = False
+        if self.paused or not self.frames or self.transport.is_closing():
+            return
+        high = self.transport.get_write_buffer_limits()[1]
+        budget = high - self.transport.get_write_buffer_size()
+        chunks = []
+        while self.frames and (budget > 0 or not chunks):
+            data = self.frames.popleft()
+            if isinstance(data, Deflater):
+                self.deflater = data
+                continue
+            chunks.extend(encode(data, self.deflater))
+            budget -= HEADER.size + len(chunks[-1])
+        try:
+            self.transport.writelines(chunks)
+        except BrokenPipeError:
+            self.transport.close()
+            return
+        if self.frames:
+            self.schedule()
+
+    def pause(self):
+        """Транспорт перегружен."""
+        self.paused = True
+
+    def resume(self):
+        """Транспорт готов принимать данные."""
+        self.paused = False
+        self.schedule()
+
+    def overflow(self, msg=None):
+        """Применение политики медленного клиента.
+
+        Args:
+            msg: сообщение которое не поместилось в очередь (default: {None})
+
+        """
+        if self.policy == 'drop' or not self.spill(msg):
+            self.dropped += 1
+        logger.warning(f'Очередь отправки {self.transport.get_extra_info("peername")} переполнена, политика {self.policy}')
+        if self.policy == 'disconnect':
+            self.frames.clear()
+            self.transport.abort()
+
+    def spill(self, msg):
+        """Сохранение сообщения чата в БД как недоставленного.
+
+        Args:
+            msg: сообщение
+
+        Returns:
+            Признак сохранения
+            bool
+
+        """
+        if msg is None or getattr(msg, settings.ACTION, None) != settings.MESSAGE:
+            return False
+        db.spawn(db.Chat.create_msg, msg)
+        self.spilled += 1
+        return True
+
+    def stats(self):
+        """Метрики очереди."""
+        return {
+            'depth': len(self.frames),
+            'peak': self.peak,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+            'paused': self.paused,
+            'buffer': self.transport.get_write_buffer_size(),
+        }
+
 
-    def service_update_lists(self, code=205, excep=None):
-        for k, v in self.loop._transports.items():
-            if v is excep:
+class TokenBucket(object):
+    """Маркерная корзина.
+
+    Запас пополняется со скоростью ``rate`` маркеров в секунду до
+    ``capacity``, каждый запрос забирает один маркер.
+    """
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'stamp')
+
+    def __init__(self, rate, capacity, now):
+        super().__init__()
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait(self):
+        """Сколько секунд ждать следующего маркера."""
+        return (1 - self.tokens) / self.rate
+
+    def full(self, now):
+        """Запас восстановлен: корзина не отличается от новой."""
+        return self.tokens + (now - self.stamp) * self.rate >= self.capacity
+
+
+class RateLimiter(object):
+    """Ограничение частоты запросов.
+
+    Для каждого пользователя (до авторизации - для подключения)
+    заводится корзина на каждое действие из ``limits`` и общая корзина
+    на все действия. Запрос проходит, только если маркер есть во всех
+    его корзинах.
+
+    Корзины пользователя переживают переподключение, поэтому раз в
+    ``interval`` секунд удаляются владельцы, чьи корзины уже полны:
+    новые корзины будут такими же.
+
+    Attributes:
+        limits: действие -> (скорость, запас)
+        total: (скорость, запас) общей корзины или None
+        buckets: владелец -> {действие или None: корзина}
+        interval: период очистки, сек
+        swept: время последней очистки
+
+    """
+
+    def __init__(self, limits, total=None, interval=60):
+        """Инициализация.
+
+        Args:
+            limits: действие -> (запросов в секунду, запас)
+            total: лимит на все действия вместе (default: {None})
+            interval: период очистки полных корзин, сек (default: {60})
+
+        """
+        super().__init__()
+        self.limits = {action: tuple(limit) for action, limit in limits.items()}
+        self.total = tuple(total) if total else None
+        self.buckets = {}
+        self.interval = interval
+        self.swept = None
+
+    def check(self, key, action, now):
+        """Проверка и учет запроса.
+
+        Args:
+            key: имя пользователя или подключение
+            action: имя действия
+            now: текущее время цикла событий
+
+        Returns:
+            0 если запрос разрешен, иначе через сколько секунд повторить
+            float
+
+        """
+        limit = self.limits.get(action)
+        if not limit and not self.total:
+            return 0
+        if self.swept is None:
+            self.swept = now
+        elif now - self.swept >= self.interval:
+            self.sweep(now)
+        own = self.buckets.setdefault(key, {})
+        checked = []
+        for name, spec in ((action, limit), (None, self.total)):
+            if not spec:
                 continue
-            proto = v.get_protocol()
-            if proto:
-                proto.write(Message(response=code))
+            bucket = own.get(name)
+            if bucket is None:
+                bucket = own[name] = TokenBucket(spec[0], spec[1], now)
+            else:
+                bucket.refill(now)
+            checked.append(bucket)
+        retry_after = max((b.wait() for b in checked if b.tokens < 1), default=0)
+        if not retry_after:
+            for bucket in checked:
+                bucket.tokens -= 1
+        return retry_after
+
+    def forget(self, key):
+        """Удаление корзин владельца."""
+        self.buckets.pop(key, None)
+
+    def sweep(self, now):
+        """Удаление владельцев, все корзины которых полны."""
+        self.buckets = {key: own for key, own in self.buckets.items() if not all(b.full(now) for b in own.values())}
+        self.swept = now
+
+
+class TimerWheel(object):
+    """Хешированное колесо таймеров.
+
+    Таймеры раскладываются по ``size`` ячейкам, колесо проворачивается
+    на одну ячейку каждые ``tick`` секунд. Постановка и снятие таймера
+    O(1), за один шаг просматривается только текущая ячейка, так что
+    на весь сервер достаточно одного ``call_at`` вне зависимости от
+    числа подключений. Точность срабатывания - один шаг.
+
+    Attributes:
+        callback: вызывается с объектом сработавшего таймера
+        tick: длительность шага, сек
+        slots: ячейки, в каждой объект -> число оставшихся оборотов
+        where: объект -> номер его ячейки
+
+    """
+
+    def __init__(self, callback, tick=1.0, size=512):
+        """Инициализация.
+
+        Args:
+            callback: обработчик сработавшего таймера
+            tick: длительность шага, сек (default: {1.0})
+            size: количество ячеек (default: {512})
+
+        """
+        super().__init__()
+        self.callback = callback
+        self.tick = tick
+        self.slots = [{} for _ in range(size)]
+        self.where = {}
+        self.pos = 0
+        self.handle = None
+
+    def __len__(self):
+        """Количество поставленных таймеров."""
+        return len(self.where)
+
+    def add(self, item, delay):
+        """Постановка (или перестановка) таймера.
+
+        Args:
+            item: объект таймера
+            delay: через сколько секунд сработать
+
+        """
+        self.discard(item)
+        ticks = max(1, math.ceil(delay / self.tick))
+        size = len(self.slots)
+        slot = (self.pos + ticks) % size
+        self.slots[slot][item] = (ticks - 1) // size
+        self.where[item] = slot
+
+    def discard(self, item):
+        """Снятие таймера если он есть."""
+        slot = self.where.pop(item, None)
+        if slot is not None:
+            del self.slots[slot][item]
+
+    def advance(self):
+        """Поворот колеса на один шаг и вызов сработавших таймеров."""
+        self.pos = (self.pos + 1) % len(self.slots)
+        bucket = self.slots[self.pos]
+        expired = []
+        for item, rounds in bucket.items():
+            if rounds:
+                bucket[item] = rounds - 1
+            else:
+                expired.append(item)
+        for item in expired:
+            del bucket[item]
+            del self.where[item]
+        for item in expired:
+            try:
+                self.callback(item)
+            except Exception as error:
+                logger.error(error, exc_info=True)
+
+    def start(self, loop):
+        """Запуск вращения колеса в цикле событий."""
+        self.loop = loop
+        self.deadline = loop.time() + self.tick
+        self.handle = loop.call_at(self.deadline, self._run)
+
+    def stop(self):
+        if self.handle:
+            self.handle.cancel()
+            self.handle = None
+
+    def _run(self):
+        # Если цикл событий был занят, догоняем пропущенные шаги
+        now = self.loop.time()
+        while self.deadline <= now:
+            self.advance()
+            self.deadline += self.tick
+        self.handle = self.loop.call_at(self.deadline, self._run)
+
+
+class Session(object):
+    """Сессия авторизованного подключения.
+
+    Создается командой :py:class:`Auth` после проверки ответа на вызов
+    и живет до выхода пользователя. Права команды проверяются по сессии
+    без обращений к БД (:py:func:`~decorators.session_required`).
+
+    Attributes:
+        username: имя пользователя как в БД
+        peername: адрес клиента
+        started: время входа по часам цикла событий
+
+    """
+
+    __slots__ = ('username', 'key', 'peername', 'started')
+
+    def __init__(self, username, peername=None, started=None):
+        """Инициализация.
+
+        Args:
+            username: имя пользователя
+            peername: адрес клиента (default: {None})
+            started: время входа (default: {None})
+
+        """
+        super().__init__()
+        self.username = username
+        self.key = username.lower()
+        self.peername = peername
+        self.started = started
+
+    def owns(self, msg):
+        """Проверка что сообщение отправлено от имени пользователя сессии.
+
+        Имена пользователя и отправителя, если они есть в сообщении,
+        должны совпадать с именем сессии без учета регистра.
+
+        Args:
+            msg: :py:class:`~jim_mes.Message`
+
+        Returns:
+            Результат проверки
+            bool
+
+        """
+        for key in (settings.USER, settings.SENDER):
+            name = getattr(msg, key, None)
+            if name is not None and (not isinstance(name, str) or name.lower() != self.key):
+                return False
+        return True
 
 
 class AsyncServerProtocol(asyncio.Protocol):
     """Протокол TCP
 
-    Сначала читаем первые 4 байта в них содержится размер данных.
-    Далее читаем с размером по умолчанию до целевого размера.
+    Поток данных разбирается :py:class:`~jim_mes.FrameDecoder` на кадры:
+    первые 4 байта кадра содержат размер данных, далее сами данные.
+    За один вызов data_received может прийти любое количество кадров
+    или часть кадра.
 
-    Attributes:
-        CHUNK_SIZE: размер части в начале данных содержащий размер всей части
+    Сообщения складываются во входящую очередь подключения и
+    выполняются по одному задачей :py:meth:`process`, так что
+    асинхронные команды разных подключений выполняются параллельно,
+    а порядок команд одного подключения сохраняется.
     """
-    CHUNK_SIZE = 4
 
     def __init__(self, thread, *args, **kwargs):
         self._thread = thread
+        self.decoder = FrameDecoder(settings.as_int('MAX_PACKAGE_LENGTH'))
+        self.codec = None
+        self.request_id = None
+        self.session = None
         super().__init__(*args, **kwargs)
 
     def connection_made(self, transport):
-        peername = transport.get_extra_info('peername')
-        logger.info(f'Установлено соединение с ПК {peername}')
+        self.peername = transport.get_extra_info('peername')
+        logger.info(f'Установлено соединение с ПК {self.peername}')
         self.transport = transport
-        self.def_size, self.transport.max_size, self.cur_size = self.transport.max_size, self.CHUNK_SIZE, self.CHUNK_SIZE
+        tune_socket(transport.get_extra_info('socket'))
+        self.challenge = None
+        self.transport.set_write_buffer_limits(
+            high=settings.as_int('WRITE_BUFFER_HIGH'),
+            low=settings.as_int('WRITE_BUFFER_LOW'),
+        )
+        self.queue = SendQueue(
+            transport,
+            maxsize=settings.as_int('SEND_QUEUE_SIZE'),
+            policy=settings.get('SEND_QUEUE_POLICY'),
+        )
+        self.inbox = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        self.worker = loop.create_task(self.process())
+        self.connected = self.last_seen = loop.time()
+        self._thread.protocols.add(self)
+        if self._thread.wheel is not None:
+            self._thread.wheel.add(self, min(settings.as_float('PING_INTERVAL'), settings.as_float('AUTH_TIMEOUT')))
         self._thread.notify('new_connect')
-        self.long_data = b''
 
     def data_received(self, data):
-        if len(data) == self.CHUNK_SIZE:
-            self.cur_size = struct.unpack('>I', data)[0]
-            self.transport.max_size = min(self.cur_size, self.def_size)
-            return
-        self.long_data += data
-
-        if self.cur_size > len(self.long_data):
+        self.last_seen = self._thread.loop.time()
+        try:
+            frames = self.decoder.feed(data)
+        except FrameError as error:
+            logger.error(f'{error}. Соединение будет закрыто.')
+            self.transport.close()
             return
 
-        self.transport.max_size = self.cur_size = self.CHUNK_SIZE
-        logger.debug(f'Client say: {self.long_data.decode(settings.get("encoding", "utf-8"))}')
-        mes = Message(self.long_data)
-        self.long_data = b''
-        response = self._thread.run_command(self, mes)
-        if response:
-            logger.debug(f'send response')
+        for frame in frames:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f'Client say: {bytes(frame).decode(settings.get("encoding", "utf-8"), "replace")}')
+            self.inbox.put_nowait(Message(frame))
+
+    async def process(self):
+        """Последовательное выполнение входящих сообщений подключения."""
+        while True:
+            mes = await self.inbox.get()
+            if mes is None:
+                break
+            # ответы на запрос получают его id
+            self.request_id = getattr(mes, settings.MESSAGE_ID, None)
+            try:
+                await self._thread.dispatch(self, mes)
+            except Exception as error:
+                logger.error(error, exc_info=True)
+                self.transport.close()
+            finally:
+                self.request_id = None
 
     def connection_lost(self, exc):
         logger.info('The connection was closed')
-        ip, port = self.transport.get_extra_info('peername')
-        user = db.ActiveUsers.objects(ip_addr=ip, port=port).first()
-        if user:
-            self._thread.run_command(self, Message(**{
+        self._thread.protocols.discard(self)
+        if self._thread.wheel is not None:
+            self._thread.wheel.discard(self)
+        self._thread.limiter.forget(self)
+        if self.challenge:
+            # незавершенная авторизация, вызов больше никому не нужен
+            name, digest = self.challenge
+            if self._thread.auth.get(name, (None,))[0] == digest:
+                del self._thread.auth[name]
+        username = self._thread.logout(self)
+        if username:
+            self.inbox.put_nowait(Message(**{
                 settings.ACTION: settings.EXIT,
-                settings.USER: user.oper.username,
+                settings.USER: username,
             }))
+        self.inbox.put_nowait(None)
 
-    def write(self, msg, transport=None):
-        transport = transport or self.transport
-        if not isinstance(msg, bytes):
-            msg = bytes(msg)
-        try:
-            msg = struct.pack('>I', len(msg)) + msg
-            transport.write(msg)
-            logger.info(f'send {msg}')
-        except BrokenPipeError:
-            transport.close()
+    def enable_compression(self):
+        """Включение сжатия кадров подключения в обе стороны."""
+        self.decoder.enable_compression()
+        self.queue.start_compression(Deflater(settings.as_int('COMPRESSION_LEVEL')))
+
+    def pause_writing(self):
+        self.queue.pause()
+
+    def resume_writing(self):
+        self.queue.resume()
+
+    def write(self, msg):
+        """Постановка сообщения в очередь отправки.
+
+        Args:
+            msg: :py:class:`~jim_mes.Message` или готовые байты
+
+        Returns:
+            Признак того что сообщение поставлено в очередь
+            bool
+
+        """
+        if isinstance(msg, bytes):
+            data = msg
+        else:
+            if self.request_id is not None and getattr(msg, settings.RESPONSE, None) is not None:
+                msg.reply_to(self.request_id)
+            data = msg.encode(self.codec)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'send {data}')
+        return self.queue.put(data, None if isinstance(msg, bytes) else msg)
 
     def notify(self, event, *args, **kwargs):
-        self._thread.notify(event, self, *args, **kwargs)
+        return self._thread.notify(event, self, *args, **kwargs)
 
     def close(self):
         self.transport.close()
 
     def service_update_lists(self, code=205):
-        self._thread.service_update_lists(code=code, excep=self.transport)
+        self._thread.service_update_lists(code=code, excep=self)
 
-    def get_user_tr(self, user_name):
-        act_user = db.ActiveUsers.by_name(user_name)
-        if not act_user:
-            return
-        for k, v in self._thread.loop._transports.items():
-            if v is self:
-                continue
-            ip, port = v.get_extra_info('peername')
-            if act_user.ip_addr == ip and act_user.port == port:
-                return v
+    def get_user_proto(self, user_name):
+        """Протокол подключенного пользователя или None."""
+        return self._thread.users.get(user_name)
 
 
 class Router:
+    """Маршрутизатор команд.
+
+    Команда это класс или объект с методом ``update``, обычным или
+    ``async def``. Асинхронные обработчики ожидаются в
+    :py:meth:`ServerA.dispatch`.
+    """
+
     def __init__(self):
         self.commands = []
         self.source = None
@@ -264,75 +1054,225 @@ class MessageCommand:
 
     name = settings.MESSAGE
 
-    @login_required_db
-    def update(self, proto, msg, *args, **kwargs):
+    @session_required
+    async def update(self, proto, msg, *args, **kwargs):
         if msg.is_valid():
-            dest_user = getattr(msg, settings.DESTINATION, None)
-            src_user = getattr(msg, settings.SENDER, None)
-            dest = proto.get_user_tr(dest_user)
+            # Текст зашифрован клиентом, сервер читает только заголовок и
+            # пересылает исходные байты кадра
+            _, src_user, dest_user, _, msg_id = msg.header
+            dest = proto.get_user_proto(dest_user)
+            if not dest and proto._thread.cluster and proto._thread.cluster.route(dest_user, msg):
+                # Сообщение в БД запишет воркер получателя
+                await db.run(db.UserHistory.proc_message, src_user, dest_user)
+                logger.info(f'Сообщение пользователю {dest_user} от пользователя {src_user} передано брокеру.')
+                proto.notify(f'done_{self.name}')
+                return
             if not dest:
-                db.Chat.create_msg(msg)
-                db.UserHistory.proc_message(src_user, dest_user)
+                await db.run(self.save, msg, src_user, dest_user, False)
                 logger.info(f'Пользователь {dest_user} не зарегистрирован на сервере, отправка сообщения невозможна.')
                 return
-            proto.write(msg, dest)
-            db.UserHistory.proc_message(src_user, dest_user)
-            db.Chat.create_msg(msg, True)
-            logger.info(f'Отправлено сообщение пользователю {dest_user} от пользователя {src_user}.')
+            # Если сообщение не встало в очередь, его судьбу решила политика очереди
+            delivered = dest.write(msg)
+            await db.run(self.save, msg, src_user, dest_user, True if delivered else None)
+            logger.info(f'Отправлено сообщение {msg_id or ""} пользователю {dest_user} от пользователя {src_user}.')
             proto.notify(f'done_{self.name}')
 
+    @staticmethod
+    def save(msg, src_user, dest_user, received):
+        db.UserHistory.proc_message(src_user, dest_user)
+        if received is not None:
+            db.Chat.create_msg(msg, received)
+
 
 class Presence:
     name = settings.PRESENCE
 
-    def update(self, proto, msg, *args, **kwargs):
-        user = db.User.by_name(msg.user_account_name)
+    async def update(self, proto, msg, *args, **kwargs):
+        user, active = await db.run(self.load, msg.user_account_name)
         if not user:
             logger.info('Пользователь не зарегистрирован.')
             return proto.write(Message.error_resp('Пользователь не зарегистрирован.'))
 
-        if user.user_activity:
+        if active:
             logger.info('Имя пользователя уже занято.')
             return proto.write(Message.error_resp('Имя пользователя уже занято.'))
 
         random_str = binascii.hexlify(os.urandom(64))
         digest = hmac.new(user.auth_key, random_str).digest()
         proto._thread.auth[user.username] = (digest, getattr(msg, settings.PUBLIC_KEY, ''))
-        proto.write(Message(response=511, **{settings.ACTION: settings.AUTH, settings.DATA: random_str.decode('ascii')}))
+        proto.challenge = (user.username, digest)
+        answer = {settings.ACTION: settings.AUTH, settings.DATA: random_str.decode('ascii')}
+        compress = settings.get('COMPRESSION') and getattr(msg, settings.COMPRESS, None) == 'zlib'
+        if compress:
+            answer[settings.COMPRESS] = 'zlib'
+        codec = getattr(msg, settings.CODEC, None)
+        if codec not in (settings.get('CODECS') or []) or codec not in dispatcher.get_objects():
+            codec = None
+        if codec:
+            answer[settings.CODEC] = codec
+        proto.write(Message(response=511, **answer))
+        # ответ 511 уходит в JSON без сжатия, все следующие кадры - согласованными
+        proto.codec = codec
+        if compress:
+            proto.enable_compression()
         proto.notify(f'done_{self.name}')
 
+    @staticmethod
+    def load(username):
+        user = db.User.by_name(username)
+        return user, bool(user and user.user_activity)
+
 
 class Auth:
     name = 'auth'
 
-    def update(self, proto, msg, *args, **kwargs):
-        user = db.User.by_name(msg.user_account_name)
+    async def update(self, proto, msg, *args, **kwargs):
+        user = await db.run(db.User.by_name, msg.user_account_name)
         if not user:
             return proto.write(Message.error_resp('Пользователь не зарегистрирован.'))
         client_digest = binascii.a2b_base64(getattr(msg, settings.DATA, ''))
         digest, pub_key = proto._thread.auth.pop(user.username, (None, None))
+        proto.challenge = None
         if digest and hmac.compare_digest(digest, client_digest):
             proto.write(Message(response=212, **{settings.ACTION: settings.AUTH}))
-            client_ip, client_port = proto.transport.get_extra_info('peername')
-            db.User.login_user(user.username, ip_addr=client_ip, port=client_port, pub_key=pub_key)
+            client_ip, client_port = proto.peername
+            await db.run(db.User.login_user, user.username, ip_addr=client_ip, port=client_port, pub_key=pub_key)
+            proto.session = Session(user.username, proto.peername, proto._thread.loop.time())
+            proto._thread.login(proto, user.username)
             proto.notify('auth_new_user')
         else:
             proto.write(Message(response=412, error='Ошибка авторизации', **{settings.ACTION: settings.AUTH}))
 
 
+def parse_since(msg):
+    """Версия списка из запроса синхронизации.
+
+    Returns:
+        Версия клиента или None если запрос без версии
+        int
+
+    Raises:
+        ValueError: версия не целое неотрицательное число
+
+    """
+    since = getattr(msg, settings.SINCE, None)
+    if since is None:
+        return None
+    if isinstance(since, bool) or not isinstance(since, int) or since < 0:
+        raise ValueError(f'Неверная версия {since!r}')
+    return since
+
+
+def sync_list(kind, since, load, owner=None):
+    """Изменения списка после версии клиента (выполняется в потоке БД).
+
+    Первая синхронизация (версия 0) или версия больше известной серверу
+    (клиент от другой БД) получают весь список без ключа удаленных.
+
+    Args:
+        kind: вид списка
+        since: версия клиента
+        load: функция загрузки записей по именам, None - все записи
+        owner: пользователь для личных списков (default: {None})
+
+    Returns:
+        Поля ответа: записи, версия и имена удаленных записей
+        dict
+
+    """
+    version = db.Change.current(kind)
+    if not since or since > version:
+        return {settings.LIST_INFO: load(None), settings.VERSION: version}
+    changed, deleted = db.Change.since(kind, since, owner)
+    return {
+        settings.LIST_INFO: load(changed) if changed else [],
+        settings.VERSION: version,
+        settings.DELETED: deleted,
+    }
+
+
 class UserListCommand:
     name = settings.USERS_REQUEST
 
-    @login_required_db
-    def update(self, proto, msg, *args, **kwargs):
-        lst = []
-        for user in db.User.objects.all():
-            lst.append((user.username, base64.b64encode(user.avatar).decode('ascii') if user.avatar else None))
+    @session_required
+    async def update(self, proto, msg, *args, **kwargs):
+        query = getattr(msg, settings.QUERY, None)
+        limit = getattr(msg, settings.LIMIT, None)
+        cursor = getattr(msg, settings.CURSOR, None)
+        answer = {settings.ACTION: settings.USERS_REQUEST}
+        # клиент с кэшем аватаров получает хеши вместо содержимого
+        hashed = getattr(msg, settings.AVATARS, None) == 'hash'
+        try:
+            since = parse_since(msg)
+        except ValueError:
+            return proto.write(Message.error_resp('Неверная версия списка', **answer))
+        if since is not None:
+            answer.update(await db.run(sync_list, db.USERS, since, partial(self.load, hashed=hashed)))
+        elif query is None and limit is None and cursor is None:
+            # старые клиенты получают весь список
+            answer[settings.LIST_INFO] = await db.run(self.load, hashed=hashed)
+        else:
+            page = settings.as_int('USERS_PAGE_LIMIT')
+            try:
+                if query is not None and not isinstance(query, str):
+                    raise TypeError(query)
+                after = base64.b64decode(cursor, b'-_', validate=True).decode('utf-8') if cursor else None
+                limit = max(min(int(limit or page), page), 1)
+            except (TypeError, ValueError):
+                return proto.write(Message.error_resp('Неверные параметры поиска', **answer))
+            answer[settings.LIST_INFO], answer[settings.CURSOR] = await db.run(self.search, query, limit, after, hashed)
+        proto.write(Message.success(202, **answer))
+        proto.notify(f'done_{self.name}')
+
+    @staticmethod
+    def row(user, hashed=False):
+        if hashed:
+            return (user.username, user.avatar_hash)
+        return (user.username, base64.b64encode(user.avatar).decode('ascii') if user.avatar else None)
+
+    @classmethod
+    def load(cls, names=None, hashed=False):
+        users = db.User.search() if names is None else db.User.by_names(names)
+        return [cls.row(user, hashed) for user in users]
+
+    @classmethod
+    def search(cls, query, limit, after, hashed=False):
+        """Страница результатов поиска.
+
+        Args:
+            query: начало имени
+            limit: размер страницы
+            after: имя в нижнем регистре, после которого начинать
+            hashed: хеш аватара вместо содержимого (default: {False})
+
+        Returns:
+            Пользователи страницы и курсор следующей (None - страница последняя)
+            tuple
+
+        """
+        users = db.User.search(query, limit + 1, after)
+        cursor = None
+        if len(users) > limit:
+            users = users[:limit]
+            cursor = base64.urlsafe_b64encode(users[-1].username.lower().encode('utf-8')).decode('ascii')
+        return [cls.row(user, hashed) for user in users], cursor
+
+
+class GetAvatarCommand:
+    """Выдача аватаров по хешам содержимого."""
+
+    name = settings.GET_AVATAR
+
+    @session_required
+    async def update(self, proto, msg, *args, **kwargs):
+        hashes = getattr(msg, settings.LIST_INFO, None)
+        if not isinstance(hashes, list) or not all(isinstance(h, str) for h in hashes):
+            return proto.write(Message.error_resp('Неверный список аватаров', **{settings.ACTION: self.name}))
+        found = await db.run(db.User.avatars, hashes[:settings.as_int('USERS_PAGE_LIMIT')])
         proto.write(Message.success(202, **{
-            settings.LIST_INFO: lst,
-            settings.ACTION: settings.USERS_REQUEST,
+            settings.ACTION: self.name,
+            settings.LIST_INFO: [(h, base64.b64encode(ava).decode('ascii')) for h, ava in found.items()],
         }))
-        proto.notify(f'done_{self.name}')
 
 
 class AddContactCommand:
@@ -340,125 +1280,199 @@ class AddContactCommand:
 
     name = settings.ADD_CONTACT
 
-    @login_required_db
-    def update(self, proto, msg, *args, **kwargs):
-        src_user = getattr(msg, settings.USER, None)
+    @session_required
+    async def update(self, proto, msg, *args, **kwargs):
+        src_user = proto.session.username
         contact = getattr(msg, settings.ACCOUNT_NAME, None)
-        user = db.User.by_name(src_user)
         if contact:
-            user.add_contact(contact)
+            await db.run(self.save, src_user, contact)
             proto.write(Message.success())
         else:
             proto.write(Message.error_resp('Не найден контакт'))
         logger.info(f'User {src_user} add contact {contact}')
         proto.notify(f'done_{self.name}')
 
+    @staticmethod
+    def save(src_user, contact):
+        db.User.by_name(src_user).add_contact(contact)
+
 
 class EditChatCommand:
     """Обрабатывает запросы на добавление/изменение чата."""
 
     name = settings.EDIT_CHAT
 
-    @login_required_db
-    def update(self, proto, msg, *args, **kwargs):
-        user = db.User.by_name(getattr(msg, settings.USER, None))
+    @session_required
+    async def update(self, proto, msg, *args, **kwargs):
         data = getattr(msg, settings.DATA, None)
-        chat = db.Chat.objects(name=data.get('name')).first()
-        code_resp = 201
-
-        if chat:
-            chat.update(set__members=[db.User.by_name(m) for m in data.get('members', [])])
-            code_resp = 202
-        else:
-            chat = db.Chat.objects.create(
-                name=data.get('name'),
-                owner=db.User.by_name(data.get('owner')),
-                is_personal=data.get('is_personal'),
-                members=[db.User.by_name(m) for m in data.get('members', [])],
-            )
+        code_resp = await db.run(self.save, data)
         proto.write(Message.success(code_resp))
-        logger.info(f'User {user} edit chat {chat.name}')
+        logger.info(f'User {proto.session.username} edit chat {data.get("name")}')
         proto.service_update_lists(206)
         proto.notify(f'done_{self.name}')
 
+    @staticmethod
+    def save(data):
+        chat = db.Chat.objects(name=data.get('name')).first()
+
+        if chat:
+            chat.set_members([db.User.by_name(m) for m in data.get('members', [])])
+            return 202
+        db.Chat.objects.create(
+            name=data.get('name'),
+            owner=db.User.by_name(data.get('owner')),
+            is_personal=data.get('is_personal'),
+            members=[db.User.by_name(m) for m in data.get('members', [])],
+        )
+        return 201
+
 
 class DelChatCommand:
     """Обрабатывает запросы на удаление контакта."""
 
     name = settings.DEL_CHAT
 
-    @login_required_db
-    def update(self, proto, msg, *args, **kwargs):
+    @session_required
+    async def update(self, proto, msg, *args, **kwargs):
         """Выполнение."""
-        user = db.User.by_name(getattr(msg, settings.USER, None))
         data = getattr(msg, settings.DATA, None)
-        chat = db.Chat.objects(name=data.get('name')).first()
 
-        if chat:
-            chat.delete()
+        if await db.run(self.delete, data.get('name')):
             proto.write(Message.success())
-            logger.info(f'User {user} del chat {data.get("name")}')
+            logger.info(f'User {proto.session.username} del chat {data.get("name")}')
             proto.service_update_lists(206)
             proto.notify(f'done_{self.name}')
 
+    @staticmethod
+    def delete(name):
+        chat = db.Chat.objects(name=name).first()
+        if chat:
+            chat.delete()
+            return True
+        return False
+
 
 class ListContactsCommand:
     """Обрабатывает запросы на получение списка контактов пользователя."""
 
     name = settings.GET_CONTACTS
 
-    @login_required_db
-    def update(self, proto, msg, *args, **kwargs):
-        user = db.User.by_name(msg.user_account_name)
-        proto.write(Message.success(202, **{settings.LIST_INFO: [c.username for c in user.contacts], settings.ACTION: settings.GET_CONTACTS}))
-        logger.info(f'User {user.username} get list contacts')
+    @session_required
+    async def update(self, proto, msg, *args, **kwargs):
+        username = proto.session.username
+        answer = {settings.ACTION: settings.GET_CONTACTS}
+        try:
+            since = parse_since(msg)
+        except ValueError:
+            return proto.write(Message.error_resp('Неверная версия списка', **answer))
+        if since is None:
+            answer[settings.LIST_INFO] = await db.run(self.load, username)
+        else:
+            answer.update(await db.run(sync_list, db.CONTACTS, since, partial(self.load, username), username))
+        proto.write(Message.success(202, **answer))
+        logger.info(f'User {username} get list contacts')
         proto.notify(f'done_{self.name}')
 
+    @staticmethod
+    def load(username, names=None):
+        if names is not None:
+            # имя контакта и есть запись списка
+            return names
+        return [c.username for c in db.User.by_name(username).contacts]
+
 
 class ListChatsCommand:
     """Обрабатывает запросы на получение списка контактов пользователя."""
 
     name = settings.GET_CHATS
 
-    @login_required_db
-    def update(self, proto, msg, *args, **kwargs):
-        user = db.User.by_name(msg.user_account_name)
-        proto.write(
-            Message.success(
-                202, **{
-                    settings.LIST_INFO: [{
-                        'name': c.name,
-                        'owner': c.owner.username if c.owner else None,
-                        'avatar': c.avatar,
-                        'is_personal': c.is_personal,
-                        'members': [i.username for i in c.members],
-                    } for c in user.chats],
-                    settings.ACTION:
-                    settings.GET_CHATS,
-                }))
-        logger.info(f'User {user.username} get list chats')
+    @session_required
+    async def update(self, proto, msg, *args, **kwargs):
+        username = proto.session.username
+        answer = {settings.ACTION: settings.GET_CHATS}
+        try:
+            since = parse_since(msg)
+        except ValueError:
+            return proto.write(Message.error_resp('Неверная версия списка', **answer))
+        if since is None:
+            answer[settings.LIST_INFO] = await db.run(self.load, username)
+        else:
+            answer.update(await db.run(sync_list, db.CHATS, since, partial(self.load, username), username))
+        proto.write(Message.success(202, **answer))
+        logger.info(f'User {username} get list chats')
         proto.notify(f'done_{self.name}')
 
+    @staticmethod
+    def load(username, names=None):
+        user = db.User.by_name(username)
+        chats = user.chats if names is None else db.Chat.objects(members=user, name__in=names)
+        return [{
+            'name': c.name,
+            'owner': c.owner.username if c.owner else None,
+            'avatar': c.avatar,
+            'is_personal': c.is_personal,
+            'members': [i.username for i in c.members],
+        } for c in chats]
+
 
 class ListMessagesCommand:
     """Обрабатывает запросы на получение списка писем."""
 
     name = settings.GET_MESSAGES
 
-    @login_required_db
-    def update(self, proto, msg, *args, **kwargs):
-        user = db.User.by_name(msg.user_account_name)
-        for msg in db.Messages.objects(receiver=user, received=False):
-            proto.write(Message(**{
+    @session_required
+    async def update(self, proto, msg, *args, **kwargs):
+        """Выдача недоставленных сообщений страницами.
+
+        Клиент указавший ``limit`` получает сообщения пачками в ответах 202
+        (по пачке на кадр), остальные - по кадру на сообщение. Доставленными
+        одним обновлением отмечаются только сообщения, поставленные в
+        очередь отправки. Если очередь отказала (переполнение, разрыв),
+        выдача прекращается, остальное остается недоставленным.
+
+        """
+        username = proto.session.username
+        limit = getattr(msg, settings.LIMIT, None)
+        try:
+            batch = max(min(int(limit), settings.as_int('MESSAGES_BATCH')), 1) if limit else None
+        except (TypeError, ValueError):
+            return proto.write(Message.error_resp('Неверный размер пачки', **{settings.ACTION: self.name}))
+        page = batch or settings.as_int('MESSAGES_BATCH')
+        user = await db.run(db.User.by_name, username)
+        after, count = None, 0
+        while True:
+            rows = await db.run(db.Messages.pending, user, page, after)
+            if not rows:
+                break
+            messages = [{
                 settings.ACTION: settings.MESSAGE,
-                settings.SENDER: msg.sender.username,
-                settings.DESTINATION: msg.receiver.username,
-                settings.MESSAGE_TEXT: msg.text,
-                'chat': msg.chat.name,
-            }))
-            msg.received = True
-            msg.save()
-        logger.info(f'User {user.username} get list messages')
+                settings.SENDER: sender,
+                settings.DESTINATION: username,
+                settings.MESSAGE_TEXT: text,
+                'chat': chat,
+            } for _, sender, chat, text in rows]
+            if batch:
+                sent = len(rows) if proto.write(Message.success(202, **{settings.ACTION: self.name, settings.LIST_INFO: messages})) else 0
+            else:
+                sent = 0
+                for mes in messages:
+                    # готовыми байтами: при отказе очередь не сохраняет копию, сообщение и так в БД
+                    if not proto.write(Message(**mes).encode(proto.codec)):
+                        break
+                    sent += 1
+            if sent:
+                await db.run(db.Messages.mark_received, [row[0] for row in rows[:sent]])
+            count += sent
+            if sent < len(rows):
+                logger.warning(f'User {username} messages not queued: delivery stopped')
+                break
+            after = rows[-1][0]
+            if len(rows) < page:
+                break
+        if batch:
+            # пустая пачка - признак конца выдачи
+            proto.write(Message.success(202, **{settings.ACTION: self.name, settings.LIST_INFO: []}))
+        logger.info(f'User {username} get list messages: {count}')
         proto.notify(f'done_{self.name}')
 
 
@@ -467,11 +1481,11 @@ class RequestKeyCommand:
 
     name = settings.PUBLIC_KEY_REQUEST
 
-    @login_required_db
-    def update(self, event, proto, msg, *args, **kwargs):
+    @session_required
+    async def update(self, event, proto, msg, *args, **kwargs):
         dest_user = getattr(msg, settings.DESTINATION, None)
-        src_user = getattr(msg, settings.SENDER, None)
-        user = db.User.by_name(dest_user)
+        src_user = proto.session.username
+        user = await db.run(db.User.by_name, dest_user)
         if user and user.pub_key:
             mes = Message(response=202, **{
                 settings.DATA: user.pub_key,
@@ -490,38 +1504,69 @@ class EditAvatar:
 
     name = settings.AVA_INFO
 
-    @login_required_db
-    def update(self, proto, msg, *args, **kwargs):
-        user = db.User.by_name(msg.user_account_name)
+    @session_required
+    async def update(self, proto, msg, *args, **kwargs):
         ava = getattr(msg, settings.DATA, None)
-        if user and ava:
-            user.avatar = base64.b64decode(ava)
-            user.save()
-            logger.info(f'Ava saved for user {user.username}')
+        if ava and await db.run(self.save, proto.session.username, ava):
+            logger.info(f'Ava saved for user {proto.session.username}')
             proto.notify(f'done_{self.name}')
             proto.service_update_lists()
             proto.service_update_lists(206)
 
+    @staticmethod
+    def save(username, ava):
+        user = db.User.by_name(username)
+        if user:
+            user.avatar = base64.b64decode(ava)
+            user.save()
+        return bool(user)
+
 
 class ExitCommand:
     """Выход пользователя."""
 
     name = settings.EXIT
 
-    @login_required_db
+    @session_required
+    async def update(self, proto, msg, *args, **kwargs):
+        username = proto.session.username
+        client_ip, client_port = proto.peername
+        proto._thread.logout(proto)
+        proto.session = None
+        proto.close()
+        await db.run(db.User.logout_user, username, ip_addr=client_ip, port=client_port)
+        logger.info(f'User {username} log off')
+        proto.notify(f'done_{self.name}')
+
+
+class PingCommand:
+    """Ответ на ping клиента.
+
+    Данные ping возвращаются как есть, по ним клиент считает RTT.
+    """
+
+    name = settings.PING
+
     def update(self, proto, msg, *args, **kwargs):
-        user = db.User.by_name(msg.user_account_name)
-        if user:
-            client_ip, client_port = proto.transport.get_extra_info('peername')
-            proto.close()
-            db.User.logout_user(user.username, ip_addr=client_ip, port=client_port)
-            logger.info(f'User {user.username} log off')
-            proto.notify(f'done_{self.name}')
+        proto.write(Message(**{settings.ACTION: settings.PONG, settings.DATA: getattr(msg, settings.DATA, None)}))
+
+
+class PongCommand:
+    """Ответ клиента на ping сервера.
+
+    Время активности подключения уже обновлено при получении данных.
+    """
+
+    name = settings.PONG
+
+    def update(self, proto, msg, *args, **kwargs):
+        pass
 
 
 router.reg_command(Presence)
 router.reg_command(Auth)
 router.reg_command(UserListCommand)
+router.reg_command(GetAvatarCommand)
 router.reg_command(ListContactsCommand)
 router.reg_command(ListChatsCommand)
 router.reg_command(EditAvatar)
@@ -532,3 +1577,5 @@ router.reg_command(EditChatCommand)
 router.reg_command(MessageCommand)
 router.reg_command(ListMessagesCommand)
 router.reg_command(ExitCommand)
+router.reg_command(PingCommand)
+router.reg_command(PongCommand)
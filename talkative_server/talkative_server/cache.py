@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Кэш объектов БД в памяти процесса.
+
+Используется бекэндами БД перед частыми выборками по ключу, например
+поиском пользователя по имени на каждое сообщение чата.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Ограниченный кэш с вытеснением давно не использованных записей.
+
+    Потокобезопасен: обращения идут из пула потоков БД. Запись
+    результата выборки передает поколение кэша, прочитанное до выборки,
+    и пропускается если за это время был сброс (:py:meth:`discard`):
+    иначе устаревший объект вернулся бы в кэш.
+
+    Attributes:
+        maxsize: максимум записей, 0 - кэш отключен
+        ttl: время жизни записи в секундах, 0 - без ограничения
+        generation: поколение, растет при каждом сбросе
+        hits: попадания
+        misses: промахи
+        evictions: вытеснения по размеру
+
+    """
+
+    def __init__(self, maxsize=1024, ttl=0):
+        """Инициализация.
+
+        Args:
+            maxsize: максимум записей (default: {1024})
+            ttl: время жизни записи в секундах (default: {0})
+
+        """
+        super().__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = 0
+        self.hits = self.misses = self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """Запись кэша.
+
+        Args:
+            key: ключ
+
+        Returns:
+            Значение или None если записи нет или она устарела
+            object
+
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if not expires or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, generation=None):
+        """Запись в кэш.
+
+        Args:
+            key: ключ
+            value: значение
+            generation: поколение до выборки значения (default: {None})
+
+        """
+        if not self.maxsize:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data[key] = (value, time.monotonic() + self.ttl if self.ttl else 0)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        """Сброс записи после изменения объекта."""
+        with self._lock:
+            self.generation += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Сброс всех записей."""
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+    def stats(self):
+        """Счетчики кэша.
+
+        Returns:
+            Размер, попадания, промахи, доля попаданий и вытеснения
+            dict
+
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'ratio': self.hits / total if total else 0.0,
+                'evictions': self.evictions,
+            }
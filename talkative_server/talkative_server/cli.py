@@ -22,7 +22,20 @@ class CommandLineInterface(object):
 
     Принимает команды и передает их на обработку
 
+    Attributes:
+        server: запущенный сервер, если есть
+
     """
+    def __init__(self, server=None):
+        """Инициализация.
+
+        Args:
+            server: запущенный сервер (default: {None})
+
+        """
+        super().__init__()
+        self.server = server
+
     def main_loop(self):
         """Основной цикл ждет ввода команды или Ctrl+C для выхода."""
         icommands.print_help()
@@ -86,7 +99,12 @@ class UserListCommand(AbstractCommand):
         """
         tab = []
         for user in db.User.all():
-            tab.append({'Пользователь': user.username, 'Последний вход': user.last_login})
+            tab.append({
+                'Пользователь': user.username,
+                'Последний вход': user.last_login,
+                'Отправлено': user.sent,
+                'Получено': user.accepted,
+            })
         print()
         print(tabulate(
             tab,
@@ -184,7 +202,151 @@ class LoginHistoryCommand(AbstractCommand):
         return True
 
 
+class SendQueuesCommand(AbstractCommand):
+    """Очереди отправки подключений.
+
+    Attributes:
+        name: имя команды в интерфейсе
+
+    """
+
+    name = 'queues'
+
+    def execute(self, cli, command, **kwargs):
+        """Выполнение команды.
+
+        Args:
+            cli: объект класса :py:class:`~CommandLineInterface`
+            command: имя команды для выполнения
+            **kwargs: дополнительные параметры
+
+        Returns:
+            Возвращает результат выполнения
+            bool
+
+        """
+        if not hasattr(cli.server, 'queue_stats'):
+            print('Очереди отправки есть только у асинхронного сервера')
+            return True
+        tab = []
+        for stat in cli.server.queue_stats():
+            host, port = stat['peer'] or ('', '')
+            tab.append({
+                'Пользователь': stat['user'] or '',
+                'HOST:PORT': f'{host}:{port}',
+                'В очереди': stat['depth'],
+                'Максимум': stat['peak'],
+                'Отброшено': stat['dropped'],
+                'Сохранено в БД': stat['spilled'],
+                'Буфер': stat['buffer'],
+                'Пауза': stat['paused'],
+            })
+        print()
+        print(tabulate(
+            tab,
+            headers='keys',
+            tablefmt='rst',
+        ))
+        print()
+        return True
+
+
+class UserCacheCommand(AbstractCommand):
+    """Счетчики кэша пользователей.
+
+    Attributes:
+        name: имя команды в интерфейсе
+
+    """
+
+    name = 'cache'
+
+    def execute(self, cli, command, **kwargs):
+        """Выполнение команды.
+
+        Args:
+            cli: объект класса :py:class:`~CommandLineInterface`
+            command: имя команды для выполнения
+            **kwargs: дополнительные параметры
+
+        Returns:
+            Возвращает результат выполнения
+            bool
+
+        """
+        stat = db.user_cache.stats()
+        print()
+        print(tabulate(
+            [{
+                'Записей': stat['size'],
+                'Максимум': stat['maxsize'],
+                'Попадания': stat['hits'],
+                'Промахи': stat['misses'],
+                'Доля попаданий': f'{stat["ratio"]:.1%}',
+                'Вытеснено': stat['evictions'],
+            }],
+            headers='keys',
+            tablefmt='rst',
+        ))
+        print()
+        return True
+
+
+class ExplainCommand(AbstractCommand):
+    """Проверка планов частых запросов к БД.
+
+    Запросы, выполняемые полным просмотром коллекции, отмечаются.
+
+    Attributes:
+        name: имя команды в интерфейсе
+
+    """
+
+    name = 'explain'
+
+    def execute(self, cli, command, **kwargs):
+        """Выполнение команды.
+
+        Args:
+            cli: объект класса :py:class:`~CommandLineInterface`
+            command: имя команды для выполнения
+            **kwargs: дополнительные параметры
+
+        Returns:
+            Возвращает результат выполнения
+            bool
+
+        """
+        if not hasattr(db, 'explain_queries'):
+            print('Проверка планов запросов есть только для MongoDB')
+            return True
+        plans = db.explain_queries()
+        tab = []
+        for plan in plans:
+            tab.append({
+                'Запрос': plan['query'],
+                'Коллекция': plan['collection'],
+                'План': ' < '.join(plan['stages']),
+                'Индекс': ', '.join(plan['indexes']),
+                'Полный просмотр': 'ДА' if plan['collscan'] else '',
+            })
+        print()
+        print(tabulate(
+            tab,
+            headers='keys',
+            tablefmt='rst',
+        ))
+        scans = sum(plan['collscan'] for plan in plans)
+        if scans:
+            print(f'Запросов с полным просмотром коллекции: {scans}')
+        print()
+        return True
+
+
 icommands.reg_cmd(QuitCommand)
 icommands.reg_cmd(UserListCommand)
 icommands.reg_cmd(ConnectedUsersCommand)
 icommands.reg_cmd(LoginHistoryCommand)
+icommands.reg_cmd(SendQueuesCommand)
+icommands.reg_cmd(UserCacheCommand)
+icommands.reg_cmd(ExplainCommand)
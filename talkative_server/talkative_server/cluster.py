@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+"""Многопроцессный режим сервера.
+
+Несколько процессов-воркеров слушают один порт через ``SO_REUSEPORT``,
+ядро само распределяет между ними подключения. Процесс-супервизор
+запускает воркеры и держит брокер на Unix-сокете, через который воркеры:
+
+* сообщают о входе и выходе своих пользователей;
+* пересылают сообщения чата пользователю подключенному к другому воркеру
+  (заголовок ``worker_route`` и следом исходный кадр сообщения);
+* рассылают всем уведомления об обновлении списков (205/206).
+
+"""
+import asyncio
+import logging
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from dynaconf import settings
+
+from .db import DBManager
+from .async_core import loop_policy
+from .jim_mes import FrameDecoder, Message
+from .jim_mes.frame import HEADER
+
+logger = logging.getLogger('cluster')
+db = DBManager('server')
+
+ONLINE = 'worker_online'
+OFFLINE = 'worker_offline'
+SYNC = 'worker_sync'
+ROUTE = 'worker_route'
+BROADCAST = 'worker_broadcast'
+
+
+def broker_path():
+    """Путь к Unix-сокету брокера.
+
+    Returns:
+        Путь из настройки BROKER_SOCKET или файл во временном каталоге
+        Path
+
+    """
+    path = settings.get('BROKER_SOCKET')
+    if path:
+        return Path(path)
+    return Path(tempfile.gettempdir()).joinpath(f'talkative_{settings.as_int("PORT")}.sock')
+
+
+class ClusterProtocol(asyncio.Protocol):
+    """Протокол связи воркера с брокером.
+
+    Кадры те же что и у клиентов: 4 байта длины и сообщение JIM.
+    Все события передаются обработчику (брокеру или клиенту брокера).
+    За заголовком ROUTE идет кадр пересылаемого сообщения как есть,
+    в кодеке отправителя: протокол передает его в ``routed`` без разбора.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.decoder = FrameDecoder()
+        self.pending_route = None
+        super().__init__()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.handler.connected(self)
+
+    def data_received(self, data):
+        for frame in self.decoder.feed(data):
+            if self.pending_route is not None:
+                header, self.pending_route = self.pending_route, None
+                self.handler.routed(self, header, bytes(frame))
+                continue
+            msg = Message(frame)
+            if getattr(msg, settings.ACTION, None) == ROUTE:
+                self.pending_route = msg
+            else:
+                self.handler.received(self, msg)
+
+    def connection_lost(self, exc):
+        self.handler.disconnected(self)
+
+    def write(self, msg):
+        if isinstance(msg, bytes):
+            self.transport.writelines([HEADER.pack(len(msg)), msg])
+        else:
+            self.transport.write(msg.to_frame())
+
+    def forward(self, header, frame):
+        """Запись заголовка ROUTE и кадра сообщения одним вызовом."""
+        data = bytes(header)
+        self.transport.writelines([HEADER.pack(len(data)), data, HEADER.pack(len(frame)), frame])
+
+
+class Broker(object):
+    """Брокер процесса-супервизора.
+
+    Attributes:
+        path: путь к Unix-сокету
+        workers: подключенные воркеры
+        owners: имя пользователя (в нижнем регистре) -> подключение воркера
+
+    """
+
+    def __init__(self, path):
+        """Инициализация.
+
+        Args:
+            path: путь к Unix-сокету
+
+        """
+        super().__init__()
+        self.path = path
+        self.workers = set()
+        self.owners = {}
+
+    async def start(self):
+        """Запуск приема подключений воркеров."""
+        if self.path.exists():
+            self.path.unlink()
+        self.server = await asyncio.get_running_loop().create_unix_server(lambda: ClusterProtocol(self), str(self.path))
+
+    def connected(self, conn):
+        self.workers.add(conn)
+        conn.write(Message(**{settings.ACTION: SYNC, settings.LIST_INFO: list(self.owners)}))
+
+    def disconnected(self, conn):
+        self.workers.discard(conn)
+        for name in [n for n, c in self.owners.items() if c is conn]:
+            del self.owners[name]
+            self.fan_out(Message(**{settings.ACTION: OFFLINE, settings.USER: name}))
+
+    def received(self, conn, msg):
+        action = getattr(msg, settings.ACTION, None)
+        if action == ONLINE:
+            self.owners[getattr(msg, settings.USER).lower()] = conn
+            self.fan_out(msg, conn)
+        elif action == OFFLINE:
+            name = getattr(msg, settings.USER).lower()
+            if self.owners.get(name) is conn:
+                del self.owners[name]
+                self.fan_out(msg, conn)
+        elif action == BROADCAST:
+            self.fan_out(msg, conn)
+
+    def routed(self, conn, header, frame):
+        # Если владелец уже отключился, сообщение вернется отправителю
+        # и тот сохранит его как недоставленное.
+        self.owners.get(getattr(header, settings.DESTINATION).lower(), conn).forward(header, frame)
+
+    def fan_out(self, msg, excep=None):
+        """Рассылка сообщения всем воркерам кроме excep."""
+        data = bytes(msg)
+        for worker in self.workers:
+            if worker is not excep:
+                worker.write(data)
+
+
+class ClusterClient(object):
+    """Связь воркера с брокером.
+
+    Attributes:
+        server: экземпляр :py:class:`~async_core.ServerA` воркера
+        remote: имена пользователей подключенных к другим воркерам
+
+    """
+
+    def __init__(self, server, path=None):
+        """Инициализация.
+
+        Args:
+            server: сервер воркера
+            path: путь к Unix-сокету брокера (default: {None})
+
+        """
+        super().__init__()
+        self.server = server
+        self.path = path or broker_path()
+        self.remote = set()
+        self.conn = None
+
+    async def connect(self):
+        """Подключение к брокеру."""
+        await asyncio.get_running_loop().create_unix_connection(lambda: ClusterProtocol(self), str(self.path))
+
+    def connected(self, conn):
+        self.conn = conn
+
+    def disconnected(self, conn):
+        logger.error('Потеряна связь с брокером')
+        self.conn = None
+        self.remote.clear()
+
+    def send(self, **kwargs):
+        if self.conn:
+            self.conn.write(Message(**kwargs))
+
+    def online(self, username):
+        """Пользователь подключился к этому воркеру."""
+        self.send(**{settings.ACTION: ONLINE, settings.USER: username})
+
+    def offline(self, username):
+        """Пользователь отключился от этого воркера."""
+        self.send(**{settings.ACTION: OFFLINE, settings.USER: username})
+
+    def route(self, username, msg):
+        """Пересылка сообщения пользователю другого воркера.
+
+        Args:
+            username: имя получателя
+            msg: сообщение
+
+        Returns:
+            Признак того что получатель подключен к другому воркеру
+            bool
+
+        """
+        if not self.conn or not username or username.lower() not in self.remote:
+            return False
+        self.conn.forward(Message(**{settings.ACTION: ROUTE, settings.DESTINATION: username}), msg.frame)
+        return True
+
+    def broadcast(self, code):
+        """Рассылка уведомления об обновлении списков другим воркерам."""
+        self.send(**{settings.ACTION: BROADCAST, settings.RESPONSE: code})
+
+    def received(self, conn, msg):
+        action = getattr(msg, settings.ACTION, None)
+        if action == SYNC:
+            self.remote = {n.lower() for n in getattr(msg, settings.LIST_INFO, [])}
+        elif action == ONLINE:
+            name = getattr(msg, settings.USER).lower()
+            self.remote.add(name)
+            # воркер пользователя записал при входе новый ключ
+            db.user_cache.discard(name)
+        elif action == OFFLINE:
+            self.remote.discard(getattr(msg, settings.USER).lower())
+        elif action == BROADCAST:
+            self.server.service_update_lists(getattr(msg, settings.RESPONSE), propagate=False)
+
+    def routed(self, conn, header, frame):
+        self.deliver(getattr(header, settings.DESTINATION), Message(frame))
+
+    def deliver(self, username, msg):
+        """Доставка пересланного сообщения локальному пользователю.
+
+        Учет сообщения в БД ведет воркер который его доставляет.
+
+        """
+        dest = self.server.users.get(username)
+        if dest is None:
+            db.spawn(db.Chat.create_msg, msg)
+        elif dest.write(msg):
+            db.spawn(db.Chat.create_msg, msg, True)
+
+
+class Supervisor(object):
+    """Супервизор воркеров.
+
+    Запускает брокер и N процессов сервера с теми же параметрами
+    командной строки и ключом ``--worker``.
+
+    Attributes:
+        count: количество воркеров
+        processes: запущенные процессы
+
+    """
+
+    def __init__(self, count):
+        """Инициализация.
+
+        Args:
+            count: количество воркеров
+
+        """
+        super().__init__()
+        self.count = count
+        self.processes = []
+
+    def worker_command(self, num):
+        """Командная строка запуска воркера.
+
+        Args:
+            num: номер воркера начиная с 1
+
+        Returns:
+            Список аргументов процесса
+            list
+
+        """
+        if getattr(sys, 'frozen', False):
+            cmd = [sys.executable]
+        else:
+            cmd = [sys.executable, '-m', 'talkative_server']
+        args = iter(sys.argv[1:])
+        for arg in args:
+            if arg in ('-w', '--workers'):
+                next(args, None)
+            elif not arg.startswith('--workers='):
+                cmd.append(arg)
+        return cmd + ['--worker', str(num)]
+
+    async def serve(self):
+        """Работа брокера до SIGTERM (systemd, docker stop)."""
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        try:
+            loop.add_signal_handler(signal.SIGTERM, lambda: stop.done() or stop.set_result(None))
+        except NotImplementedError:
+            pass  # Windows: только Ctrl+C
+        broker = Broker(broker_path())
+        await broker.start()
+        logger.info(f'Брокер запущен {broker.path}, воркеров {self.count}')
+        for num in range(1, self.count + 1):
+            self.processes.append(subprocess.Popen(self.worker_command(num)))
+        try:
+            await stop
+            logger.info('Получен SIGTERM')
+        finally:
+            # без wait_closed: он ждет соединения воркеров, а их останавливает run()
+            broker.server.close()
+
+    def run(self):
+        """Запуск до прерывания или SIGTERM, затем остановка воркеров.
+
+        Воркеры получают SIGTERM и WORKER_STOP_TIMEOUT секунд на запись
+        остатков, не успевшие завершаются принудительно.
+
+        """
+        asyncio.set_event_loop_policy(loop_policy())
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            logger.debug('closed')
+        finally:
+            for proc in self.processes:
+                proc.terminate()
+            deadline = time.monotonic() + settings.as_float('WORKER_STOP_TIMEOUT')
+            for proc in self.processes:
+                try:
+                    proc.wait(max(deadline - time.monotonic(), 0))
+                except subprocess.TimeoutExpired:
+                    logger.warning(f'Воркер {proc.pid} не завершился, принудительная остановка')
+                    proc.kill()
+                    proc.wait()
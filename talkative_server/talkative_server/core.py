@@ -16,6 +16,7 @@ from .db import DBManager
 from .descriptors import PortDescr
 from .jim_mes import Message
 from .metaclasses import ServerVerifier
+from .sockets import tune_socket
 
 app_name = 'server'
 logger = logging.getLogger(app_name)
@@ -106,9 +107,10 @@ class Server(threading.Thread, metaclass=ServerVerifier):
         self.sock = socket.socket()
         self.port = settings.as_int('PORT')
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        tune_socket(self.sock)
         self.sock.bind((settings.get('host'), self.port))
         self.sock.settimeout(0.5)
-        self.sock.listen(settings.get('max_connections'))
+        self.sock.listen(settings.as_int('LISTEN_BACKLOG'))
         self.started = True
         logger.info(f'start with {settings.get("host")}:{self.port}')
 
@@ -125,6 +127,7 @@ class Server(threading.Thread, metaclass=ServerVerifier):
                     pass
                 else:
                     logger.info(f'Установлено соединение с ПК {client_address}')
+                    tune_socket(client)
                     self.clients.append(client)
 
                 recv_data = []
@@ -213,9 +216,7 @@ class Server(threading.Thread, metaclass=ServerVerifier):
 
         """
         try:
-            msg = bytes(mes)
-            msg = struct.pack('>I', len(msg)) + msg
-            client.sendall(msg)
+            client.sendall(mes.to_frame())
         except BrokenPipeError:
             self.clients.remove(client)
             client.close()
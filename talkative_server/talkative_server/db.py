@@ -3,9 +3,12 @@
 # @Date:   2019-05-25 22:33:58
 # @Last Modified by:   MaxST
 # @Last Modified time: 2019-08-30 09:35:54
+import asyncio
 import logging
 import sys
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import sqlalchemy as sa
 from dynaconf import settings
@@ -18,7 +21,15 @@ database_lock = threading.Lock()
 
 
 class DBManager(metaclass=SingletonMeta):
-    """Менеджер инициатор БД."""
+    """Менеджер инициатор БД.
+
+    Кроме доступа к моделям бекэнда дает асинхронный интерфейс:
+    :py:meth:`run` выполняет синхронный код работы с БД в отдельном пуле
+    потоков, не блокируя цикл событий сервера. Размер пула задается
+    ключом ``WORKERS`` в настройках БД, по умолчанию берется
+    ``MAX_WORKERS`` модуля бекэнда (1 для sqlite, сессия одна на всех).
+
+    """
     def __init__(self, envs, *args, **kwargs):
         """Инициализация.
 
@@ -78,5 +89,50 @@ class DBManager(metaclass=SingletonMeta):
         if hasattr(self.module, f'init_{engine.lower()}'):
             getattr(self.module, f'init_{engine.lower()}')(self.db_settings)
 
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.db_settings.get('WORKERS', getattr(self.module, 'MAX_WORKERS', 1)),
+            thread_name_prefix=f'db_{engine.lower()}',
+        )
+
+    def run(self, func, *args, **kwargs):
+        """Асинхронное выполнение функции работы с БД.
+
+        Args:
+            func: синхронная функция
+            *args: параметры функции
+            **kwargs: параметры функции
+
+        Returns:
+            Future с результатом выполнения, можно ожидать через await
+            asyncio.Future
+
+        """
+        return asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    def spawn(self, func, *args, **kwargs):
+        """Выполнение функции работы с БД без ожидания результата.
+
+        Для записей, которых вызывающий код не ждет. Ошибка выполнения
+        пишется в лог, а не теряется вместе с неожидаемым future.
+
+        Args:
+            func: синхронная функция
+            *args: параметры функции
+            **kwargs: параметры функции
+
+        Returns:
+            Future выполнения
+            asyncio.Future
+
+        """
+        future = asyncio.ensure_future(self.run(func, *args, **kwargs))
+        future.add_done_callback(partial(self._log_error, func))
+        return future
+
+    @staticmethod
+    def _log_error(func, future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f'Ошибка {getattr(func, "__qualname__", func)}', exc_info=future.exception())
+
     def __getattr__(self, attr):
         return getattr(self.module, attr)
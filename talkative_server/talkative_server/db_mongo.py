@@ -3,27 +3,72 @@
 # @Date:   2019-08-29 21:53:57
 # @Last Modified by:   MaxST
 # @Last Modified time: 2019-09-01 11:58:31
+import hashlib
 import logging
 import sys
+from collections import Counter, defaultdict
 from datetime import datetime
 
+from bson import ObjectId
 from dynaconf import settings
 from mongoengine import (BinaryField, BooleanField, DateTimeField, Document,
                          EmbeddedDocument, EmbeddedDocumentListField,
                          ImageField, IntField, LazyReferenceField, ListField,
-                         ReferenceField, StringField, connect)
+                         Q, ReferenceField, StringField, connect)
+from pymongo import UpdateOne
 
+from .cache import LRUCache
 from .errors import NotFoundUser
+from .writer import BatchWriter
 
 logger = logging.getLogger('server__db')
+MAX_WORKERS = 8  # потоков асинхронного доступа к БД, pymongo потокобезопасен
+# виды синхронизируемых списков
+USERS = 'users'
+CONTACTS = 'contacts'
+CHATS = 'chats'
+# пользователи по имени в нижнем регистре, изменения других воркеров видны через USER_CACHE_TTL
+user_cache = LRUCache(settings.as_int('USER_CACHE_SIZE'), settings.as_float('USER_CACHE_TTL'))
 
 
 def init_mongo(db_settings):
     global db
     credential = {'username': db_settings.get('USERNAME'), 'password': db_settings.get('PASSWORD'), 'authentication_source': 'admin'}
     db = connect(db_settings.get('NAME'), **credential)
+    sync_indexes()
 
     ActiveUsers.objects.delete()
+    # пользователи созданные до появления полей поиска и хеша аватара
+    for user in User.objects(Q(username_lower=None) | Q(avatar_hash=None, avatar__ne=None)):
+        user.save()
+    # пользователи созданные до появления счетчиков сообщений
+    missing = list(User.objects(sent__exists=False).scalar('id'))
+    if missing:
+        User.recount(missing)
+
+
+def sync_indexes():
+    """Создание объявленных в документах индексов.
+
+    Лишние индексы не удаляются: ими могут пользоваться воркеры с
+    другой версией кода, поэтому они только попадают в лог.
+
+    Returns:
+        Недостающие до синхронизации и лишние индексы по коллекциям
+        dict
+
+    """
+    result = {}
+    for document in DOCUMENTS:
+        diff = document.compare_indexes()
+        document.ensure_indexes()
+        name = document._get_collection_name()
+        for index in diff['missing']:
+            logger.info(f'Создан индекс {name} {index}')
+        for index in diff['extra']:
+            logger.warning(f'Индекс {name} {index} не объявлен в {document.__name__}')
+        result[name] = diff
+    return result
 
 
 class Core(Document):
@@ -35,6 +80,110 @@ class Core(Document):
     # meta = {'allow_inheritance': True}
     meta = {'abstract': True}
 
+    @classmethod
+    def all(cls):
+        """Возвращает все записи коллекции."""
+        return cls.objects.all()
+
+
+class Version(Document):
+    """Счетчик версий списка.
+
+    Attributes:
+        kind: вид списка
+        value: последняя выданная версия
+
+    """
+
+    kind = StringField(primary_key=True)
+    value = IntField(default=0)
+
+    @classmethod
+    def next(cls, kind):
+        """Следующая версия списка (атомарно)."""
+        return cls.objects(kind=kind).modify(upsert=True, new=True, inc__value=1).value
+
+    @classmethod
+    def current(cls, kind):
+        """Последняя выданная версия списка."""
+        version = cls.objects(kind=kind).first()
+        return version.value if version else 0
+
+
+class Change(Document):
+    """Последнее изменение записи списка.
+
+    На запись хранится одна строка с версией последнего изменения,
+    удаление оставляет строку с признаком ``deleted``. Личные списки
+    (контакты, чаты) ведутся для каждого пользователя отдельно.
+
+    Строка помечается ``pending`` до получения версии и отдается в
+    каждой выборке, пока версия не записана. Иначе изменение с версией
+    меньше уже выданной клиенту (другой поток или воркер кластера еще не
+    успел его записать) было бы потеряно.
+
+    Attributes:
+        kind: вид списка
+        key: имя записи
+        owner: пользователь для личных списков
+        version: версия последнего изменения
+        deleted: запись удалена
+        pending: версия еще не записана
+
+    """
+
+    kind = StringField(required=True)
+    key = StringField(required=True)
+    owner = StringField()
+    version = IntField(default=0)
+    deleted = BooleanField(default=False)
+    pending = BooleanField(default=False)
+
+    meta = {'indexes': [('kind', 'owner', 'key'), ('kind', 'owner', 'version')]}
+
+    @classmethod
+    def touch(cls, kind, key, *owners, deleted=False):
+        """Запись изменения.
+
+        Вызывается после изменения самой записи.
+
+        Args:
+            kind: вид списка
+            key: имя записи
+            *owners: пользователи личного списка, без них список общий
+            deleted: запись удалена (default: {False})
+
+        """
+        owners = list(owners) or [None]
+        for owner in owners:
+            cls.objects(kind=kind, key=key, owner=owner).update_one(upsert=True, set__pending=True, set__deleted=deleted)
+        cls.objects(kind=kind, key=key, owner__in=owners).update(set__version=Version.next(kind), set__pending=False)
+
+    @classmethod
+    def current(cls, kind):
+        """Версия списка, читается до выборки изменений."""
+        return Version.current(kind)
+
+    @classmethod
+    def since(cls, kind, version, owner=None):
+        """Изменения списка после версии.
+
+        Args:
+            kind: вид списка
+            version: версия клиента
+            owner: пользователь для личных списков (default: {None})
+
+        Returns:
+            Измененные и удаленные имена записей
+            tuple
+
+        """
+        changed, deleted = [], []
+        rows = cls.objects(Q(version__gt=version) | Q(pending=True), kind=kind, owner=owner).only('key', 'deleted')
+        for change in rows:
+            (deleted if change.deleted else changed).append(change.key)
+        return changed, deleted
+
 
 # class Contact(EmbeddedDocument):
 #     """Список контактов.
@@ -84,6 +233,10 @@ class TypeHistory(object):
     )
 
 
+# события истории, которые считаются в полях пользователя
+MESSAGE_COUNTERS = {TypeHistory.mes_sent: 'sent', TypeHistory.mes_accepted: 'accepted'}
+
+
 class UserHistory(Core):
     """История пользователя.
 
@@ -106,6 +259,8 @@ class UserHistory(Core):
     port = IntField()
     note = StringField()
 
+    meta = {'indexes': [('oper', 'type_row')]}
+
     @classmethod
     def proc_message(cls, scr, dest):
         """Фиксация отправленного или пришедшего сообщения.
@@ -117,10 +272,42 @@ class UserHistory(Core):
         """
         user = User.by_name(scr)
         if user:
-            cls.objects.create(oper=user, type_row=TypeHistory.mes_sent)
+            history.put(cls(oper=user, type_row=TypeHistory.mes_sent))
         user = User.by_name(dest)
         if user:
-            cls.objects.create(oper=user, type_row=TypeHistory.mes_accepted)
+            history.put(cls(oper=user, type_row=TypeHistory.mes_accepted))
+
+    @classmethod
+    def write_many(cls, rows):
+        """Запись пачки событий одним insert_many.
+
+        Счетчики сообщений пользователей увеличиваются после вставки
+        одним bulk_write с ``$inc`` на пользователя.
+
+        Args:
+            rows: документы истории
+
+        """
+        cls.objects.insert(rows, load_bulk=False)
+        counters = defaultdict(Counter)
+        for row in rows:
+            if row.oper and row.type_row in MESSAGE_COUNTERS:
+                counters[row.oper.pk][MESSAGE_COUNTERS[row.type_row]] += 1
+        if counters:
+            User._get_collection().bulk_write(
+                [UpdateOne({'_id': pk}, {'$inc': dict(inc)}) for pk, inc in counters.items()],
+                ordered=False,
+            )
+
+
+# история не читается на пути запроса и пишется пачками в фоне
+history = BatchWriter(
+    UserHistory.write_many,
+    batch=settings.as_int('HISTORY_BATCH'),
+    delay=settings.as_float('HISTORY_DELAY'),
+    maxsize=settings.as_int('HISTORY_BUFFER'),
+    name='history_writer',
+)
 
 
 class User(Core):
@@ -132,9 +319,50 @@ class User(Core):
     # sa.Column(PasswordType(schemes=['pbkdf2_sha512']), nullable=False, unique=False)
     pub_key = StringField()
     username = StringField(max_length=30, unique=True, null=False, required=True)
+    username_lower = StringField(max_length=30)  # для поиска без учета регистра
+    avatar_hash = StringField(max_length=40)  # sha1 содержимого аватара
+    # счетчики сообщений ведет запись истории через $inc,
+    # у объектов из user_cache они не обновляются
+    sent = IntField(default=0)
+    accepted = IntField(default=0)
 
     contacts = ListField(ReferenceField('self'))
 
+    meta = {'indexes': ['username_lower', 'avatar_hash']}
+
+    def clean(self):
+        self.username_lower = self.username.lower() if self.username else None
+        self.avatar_hash = hashlib.sha1(self.avatar).hexdigest() if self.avatar else None
+
+    def save(self, *args, **kwargs):
+        # в списке пользователей имя и аватар, вход и смена ключа не в счет
+        changed = self._created or bool({'username', 'avatar'} & set(self._get_changed_fields()))
+        result = super().save(*args, **kwargs)
+        user_cache.discard(self.username.lower())
+        if changed:
+            Change.touch(USERS, self.username)
+        return result
+
+    def update(self, **kwargs):
+        result = super().update(**kwargs)
+        user_cache.discard(self.username.lower())
+        return result
+
+    @classmethod
+    def avatars(cls, hashes):
+        """Аватары по хешам содержимого.
+
+        Args:
+            hashes: хеши аватаров
+
+        Returns:
+            Хеш -> аватар, неизвестные хеши пропускаются
+            dict
+
+        """
+        users = cls.objects(avatar_hash__in=list(hashes)).only('avatar', 'avatar_hash')
+        return {u.avatar_hash: u.avatar for u in users}
+
     @property
     def user_activity(self):
         return ActiveUsers.objects(oper=self).all()
@@ -145,11 +373,53 @@ class User(Core):
 
     @classmethod
     def by_name(cls, username):
-        """Возвращает объект пользователя по его имени."""
+        """Возвращает объект пользователя по его имени.
+
+        Кэш хранит SON документа, каждый вызов получает новый объект:
+        команды меняют его на месте (аватар, вход) из разных потоков БД.
+        """
+        if not username:
+            return None
+        key = username.lower()
+        son = user_cache.get(key)
+        if son is not None:
+            return cls._from_son(son)
+        generation = user_cache.generation
         try:
-            return cls.objects.get(username=username.lower())
+            user = cls.objects.get(username=key)
         except Exception:
             return None
+        user_cache.put(key, user.to_mongo(), generation)
+        return user
+
+    @classmethod
+    def by_names(cls, names):
+        """Пользователи по списку имен."""
+        return list(cls.objects(username__in=list(names)))
+
+    @classmethod
+    def search(cls, prefix=None, limit=None, after=None):
+        """Поиск пользователей по началу имени без учета регистра.
+
+        Args:
+            prefix: начало имени (default: {None})
+            limit: количество пользователей (default: {None})
+            after: имя в нижнем регистре, после которого начинать (default: {None})
+
+        Returns:
+            Пользователи по возрастанию имени
+            list
+
+        """
+        query = {}
+        if prefix:
+            query['username_lower__startswith'] = prefix.lower()
+        if after:
+            query['username_lower__gt'] = after
+        users = cls.objects(**query).order_by('username_lower')
+        if limit:
+            users = users.limit(limit)
+        return list(users)
 
     @property
     def chats(self):
@@ -172,7 +442,7 @@ class User(Core):
         }
 
         ActiveUsers.objects.create(**param)
-        UserHistory.objects.create(type_row=TypeHistory.login, **param)
+        history.put(UserHistory(type_row=TypeHistory.login, **param))
 
     @classmethod
     def logout_user(cls, username, **kwargs):
@@ -180,12 +450,13 @@ class User(Core):
         user = cls.by_name(username)
         if not user:
             logger.warn(str(NotFoundUser(username)))
+        user_cache.discard(username.lower())
         ActiveUsers.objects(oper=user).delete()
-        UserHistory.objects.create(
+        history.put(UserHistory(
             type_row=TypeHistory.logout,
             ip_addr=str(kwargs.get('ip_addr', '')),
             port=kwargs.get('port', None),
-        )
+        ))
 
     def has_contact(self, contact_name):
         """Проверка на контакт.
@@ -216,6 +487,7 @@ class User(Core):
         if cont and not self.has_contact(contact_name):
             self.update(push__contacts=cont)
             self.save()
+            Change.touch(CONTACTS, cont.username, self.username)
             UserHistory.objects.create(oper=self, type_row=TypeHistory.add_contact, note=contact_name)
 
     def del_contact(self, contact_name):
@@ -231,17 +503,34 @@ class User(Core):
         if cont and self.has_contact(contact_name):
             self.update(pull__contacts=cont)
             self.save()
+            Change.touch(CONTACTS, cont.username, self.username, deleted=True)
             UserHistory.objects(oper=self, type_row=TypeHistory.del_contact, note=contact_name).delete()
 
-    @property
-    def sent(self):
-        """Количество отправленных сообщений."""
-        return len([i for i in self.history if i.type_row == TypeHistory.mes_sent])
+    @classmethod
+    def recount(cls, ids=None):
+        """Пересчет счетчиков сообщений по истории.
 
-    @property
-    def accepted(self):
-        """Количество полученных сообщений."""
-        return len([i for i in self.history if i.type_row == TypeHistory.mes_accepted])
+        Разовое заполнение для существующих данных, история
+        группируется на стороне БД.
+
+        Args:
+            ids: id пользователей, None - все (default: {None})
+
+        """
+        match = {'type_row': {'$in': list(MESSAGE_COUNTERS)}}
+        if ids is not None:
+            match['oper'] = {'$in': list(ids)}
+        else:
+            ids = list(cls.objects.scalar('id'))
+        counters = defaultdict(Counter)
+        for row in UserHistory.objects.aggregate([
+            {'$match': match},
+            {'$group': {'_id': {'oper': '$oper', 'type_row': '$type_row'}, 'count': {'$sum': 1}}},
+        ]):
+            counters[row['_id']['oper']][MESSAGE_COUNTERS[row['_id']['type_row']]] = row['count']
+        for pk in ids:
+            cls.objects(id=pk).update_one(set__sent=counters[pk]['sent'], set__accepted=counters[pk]['accepted'])
+        logger.info(f'Пересчитаны счетчики сообщений {len(ids)} пользователей')
 
 
 class ActiveUsers(Core):
@@ -261,6 +550,8 @@ class ActiveUsers(Core):
     port = IntField()
     port = IntField()
 
+    meta = {'indexes': ['oper', ('ip_addr', 'port')]}
+
     @classmethod
     def by_name(cls, username):
         """Возвращает объект пользователя по его имени."""
@@ -277,6 +568,57 @@ class Messages(Core):
     received = BooleanField(default=False)
     readed = BooleanField(default=False)
 
+    # недоставленные получателя по порядку id, сообщения чата
+    meta = {'indexes': [('receiver', 'received', 'id'), 'chat']}
+
+    @classmethod
+    def pending(cls, receiver, limit=None, after=None):
+        """Страница недоставленных сообщений пользователя.
+
+        Ссылки не разыменовываются по одной: имена отправителей и чатов
+        страницы выбираются одним запросом на коллекцию.
+
+        Args:
+            receiver: получатель
+            limit: размер страницы (default: {None})
+            after: id последнего сообщения предыдущей страницы (default: {None})
+
+        Returns:
+            Список (id, отправитель, чат, текст) по возрастанию id
+            list
+
+        """
+        query = {'receiver': receiver, 'received': False}
+        if after:
+            query['id__gt'] = after
+        rows = cls.objects(**query).order_by('id').only('id', 'sender', 'chat', 'text').no_dereference()
+        if limit:
+            rows = rows.limit(limit)
+        rows = list(rows)
+        if not rows:
+            return []
+        senders = User.objects(id__in={r.sender.id for r in rows if r.sender}).only('username')
+        chats = Chat.objects(id__in={r.chat.id for r in rows if r.chat}).only('name')
+        senders = {u.id: u.username for u in senders}
+        chats = {c.id: c.name for c in chats}
+        return [(
+            r.id,
+            senders.get(r.sender.id) if r.sender else None,
+            chats.get(r.chat.id) if r.chat else None,
+            r.text,
+        ) for r in rows]
+
+    @classmethod
+    def mark_received(cls, ids):
+        """Отметка о доставке сообщений одним обновлением.
+
+        Args:
+            ids: id сообщений
+
+        """
+        if ids:
+            cls.objects(id__in=list(ids)).update(set__received=True)
+
 
 class Chat(Core):
     name = StringField(unique=True)
@@ -285,10 +627,46 @@ class Chat(Core):
     owner = ReferenceField('User')
     is_personal = BooleanField(default=True)
 
+    meta = {'indexes': ['members']}
+
     @property
     def messages(self):
         return Messages.objects(chat=self).all()
 
+    @property
+    def member_names(self):
+        return [m.username for m in self.members if m]
+
+    def save(self, *args, **kwargs):
+        changed = self._created or bool(self._get_changed_fields())
+        result = super().save(*args, **kwargs)
+        if changed:
+            Change.touch(CHATS, self.name, *self.member_names)
+        return result
+
+    def delete(self, *args, **kwargs):
+        members = self.member_names
+        super().delete(*args, **kwargs)
+        if members:
+            Change.touch(CHATS, self.name, *members, deleted=True)
+
+    def set_members(self, members):
+        """Замена участников чата.
+
+        Исключенные участники получат удаление чата при синхронизации.
+
+        Args:
+            members: пользователи, несуществующие (None) пропускаются
+
+        """
+        members = [m for m in members if m]
+        removed = set(self.member_names) - {m.username for m in members}
+        self.update(set__members=members)
+        self.reload()
+        if removed:
+            Change.touch(CHATS, self.name, *removed, deleted=True)
+        Change.touch(CHATS, self.name, *self.member_names)
+
     @classmethod
     def chat_hiltory(cls, chatname, limit=100):
         """Получение истории чата.
@@ -325,6 +703,86 @@ class Chat(Core):
         Messages.objects.create(chat=chat, text=text, sender=sender, receiver=receiver, received=received)
 
 
+DOCUMENTS = (Version, Change, UserHistory, User, ActiveUsers, Messages, Chat)
+
+
+def hot_queries():
+    """Частые запросы сервера для проверки планов.
+
+    Значения условий произвольные: план зависит от полей, а не от данных.
+
+    Returns:
+        Пары (описание, QuerySet)
+        tuple
+
+    """
+    oid = ObjectId()
+    return (
+        ('Пользователь по имени', User.objects(username='')),
+        ('Поиск пользователей', User.objects(username_lower__startswith='').order_by('username_lower')),
+        ('Аватары по хешу', User.objects(avatar_hash__in=[''])),
+        ('Подключения пользователя', ActiveUsers.objects(oper=oid)),
+        ('Подключение по адресу', ActiveUsers.objects(ip_addr='', port=0)),
+        ('Недоставленные сообщения', Messages.objects(receiver=oid, received=False).order_by('id')),
+        ('Сообщения чата', Messages.objects(chat=oid)),
+        ('Чаты пользователя', Chat.objects(members=oid)),
+        ('Чат по имени', Chat.objects(name='')),
+        ('История пользователя', UserHistory.objects(oper=oid, type_row=TypeHistory.login)),
+        ('Изменения списка', Change.objects(Q(version__gt=0) | Q(pending=True), kind=CONTACTS, owner='')),
+    )
+
+
+def plan_stages(plan):
+    """Стадии и индексы плана запроса.
+
+    Args:
+        plan: выигравший план из ``explain()``
+
+    Returns:
+        Стадии от корня плана и имена использованных индексов
+        tuple
+
+    """
+    stages, indexes = [], []
+    nodes = [plan]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, list):
+            nodes.extend(reversed(node))
+            continue
+        if not isinstance(node, dict):
+            continue
+        if 'stage' in node:
+            stages.append(node['stage'])
+        if 'indexName' in node:
+            indexes.append(node['indexName'])
+        nodes.extend(reversed([v for v in node.values() if isinstance(v, (dict, list))]))
+    return stages, indexes
+
+
+def explain_queries():
+    """Планы частых запросов.
+
+    Returns:
+        Запрос, коллекция, стадии, индексы и признак полного просмотра
+        коллекции (COLLSCAN) для каждого запроса :py:func:`hot_queries`
+        list
+
+    """
+    result = []
+    for name, qs in hot_queries():
+        explain = qs.explain()
+        stages, indexes = plan_stages(explain.get('queryPlanner', {}).get('winningPlan', {}))
+        result.append({
+            'query': name,
+            'collection': qs._document._get_collection_name(),
+            'stages': stages,
+            'indexes': indexes,
+            'collscan': 'COLLSCAN' in stages,
+        })
+    return result
+
+
 if __name__ == '__main__':
     init_mongo({'USERNAME': 'root', 'PASSWORD': 'root', 'NAME': 'db_server'})
     user = User.by_name('maxst')
@@ -5,23 +5,33 @@
 # @Last Modified time: 2019-08-30 08:08:24
 import datetime
 import enum
+import hashlib
 import logging
 import threading
+from collections import Counter, defaultdict
 from pathlib import Path
 
 import sqlalchemy as sa
 from dynaconf import settings
 from sqlalchemy import desc, func
-from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.ext.declarative.api import as_declarative
-from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import relationship, scoped_session, sessionmaker
+from sqlalchemy.ext.declarative import as_declarative, declared_attr
+from sqlalchemy.orm import (backref, relationship, scoped_session, sessionmaker,
+                            validates)
 from sqlalchemy_utils import PasswordType
 
+from .cache import LRUCache
 from .errors import NotFoundUser
+from .writer import BatchWriter
 
 logger = logging.getLogger('server__db')
+MAX_WORKERS = 1  # потоков асинхронного доступа к БД, сессия одна, доступ только последовательный
 database_lock = threading.Lock()
+# виды синхронизируемых списков
+USERS = 'users'
+CONTACTS = 'contacts'
+CHATS = 'chats'
+# пользователи по имени в нижнем регистре, изменения других воркеров видны через USER_CACHE_TTL
+user_cache = LRUCache(settings.as_int('USER_CACHE_SIZE'), settings.as_float('USER_CACHE_TTL'))
 
 
 def init_sqlite(db_settings):
@@ -33,11 +43,24 @@ def init_sqlite(db_settings):
         connect_args=db_settings.get('CONNECT_ARGS'),
     )
     Base.metadata.create_all(engine)
+    # индекс поиска пользователей без учета регистра, в т.ч. для старых БД
+    engine.execute('CREATE INDEX IF NOT EXISTS ix_user_username_lower ON user (lower(username))')
+    # хеш аватара в БД созданных до его появления
+    if 'avatar_hash' not in {c['name'] for c in sa.inspect(engine).get_columns('user')}:
+        engine.execute('ALTER TABLE user ADD COLUMN avatar_hash VARCHAR(40)')
+    engine.execute('CREATE INDEX IF NOT EXISTS ix_user_avatar_hash ON user (avatar_hash)')
     session_factory = sessionmaker(bind=engine)
     session = scoped_session(session_factory)
 
     Core.set_session(session())
+    for user in User.query().filter(User.avatar.isnot(None), User.avatar_hash.is_(None)):
+        user.avatar_hash = User.hash_avatar(user.avatar)
+    Core._session.commit()
+    # у потока записи истории своя сессия
+    UserHistory.sessions = session
     ActiveUsers.delete_all()
+    # пользователи созданные до появления счетчиков сообщений
+    MessageCounter.recount()
 
 
 @as_declarative()
@@ -233,6 +256,96 @@ class Core(Base):
         cls.delete_qs(cls.all())
 
 
+class Version(Base):
+    """Счетчик версий списка.
+
+    Attributes:
+        kind: вид списка
+        value: последняя выданная версия
+
+    """
+
+    kind = sa.Column(sa.String(30), unique=True, nullable=False)
+    value = sa.Column(sa.Integer, default=0, nullable=False)
+
+    @classmethod
+    def current(cls, kind):
+        """Последняя выданная версия списка."""
+        version = Core.query(cls).filter_by(kind=kind).first()
+        return version.value if version else 0
+
+
+class Change(Base):
+    """Последнее изменение записи списка.
+
+    На запись хранится одна строка с версией последнего изменения,
+    удаление оставляет строку с признаком ``deleted``. Версия и строки
+    изменений пишутся одной транзакцией.
+
+    Attributes:
+        kind: вид списка
+        key: имя записи
+        owner: пользователь для личных списков
+        version: версия последнего изменения
+        deleted: запись удалена
+
+    """
+
+    kind = sa.Column(sa.String(30), nullable=False)
+    key = sa.Column(sa.String(), nullable=False)
+    owner = sa.Column(sa.String(30))
+    version = sa.Column(sa.Integer, default=0, nullable=False)
+    deleted = sa.Column(sa.Boolean, default=False)
+
+    __table_args__ = (sa.Index('ix_change_kind_owner_version', 'kind', 'owner', 'version'), )
+
+    @classmethod
+    def touch(cls, kind, key, *owners, deleted=False):
+        """Запись изменения.
+
+        Args:
+            kind: вид списка
+            key: имя записи
+            *owners: пользователи личного списка, без них список общий
+            deleted: запись удалена (default: {False})
+
+        """
+        session = Core._session
+        version = Core.query(Version).filter_by(kind=kind).first() or Version(kind=kind, value=0)
+        version.value += 1
+        session.add(version)
+        for owner in owners or (None, ):
+            change = Core.query(cls).filter_by(kind=kind, key=key, owner=owner).first() or cls(kind=kind, key=key, owner=owner)
+            change.version = version.value
+            change.deleted = deleted
+            session.add(change)
+        session.commit()
+
+    @classmethod
+    def current(cls, kind):
+        """Версия списка, читается до выборки изменений."""
+        return Version.current(kind)
+
+    @classmethod
+    def since(cls, kind, version, owner=None):
+        """Изменения списка после версии.
+
+        Args:
+            kind: вид списка
+            version: версия клиента
+            owner: пользователь для личных списков (default: {None})
+
+        Returns:
+            Измененные и удаленные имена записей
+            tuple
+
+        """
+        changed, deleted = [], []
+        for change in Core.query(cls).filter(cls.kind == kind, cls.owner == owner, cls.version > version):
+            (deleted if change.deleted else changed).append(change.key)
+        return changed, deleted
+
+
 class User(Core):
     """Таблица пользователей.
 
@@ -246,12 +359,14 @@ class User(Core):
         auth_key: Ключ авторизации
         pub_key: Публичный ключ шифрования
         last_login: Последний вход на сервер (дата время)
+        avatar_hash: Хеш sha1 содержимого аватара
 
     """
 
     id = sa.Column(sa.Integer, sa.ForeignKey(Core.id, ondelete='CASCADE'), primary_key=True)  # noqa
     auth_key = sa.Column(sa.String())
     avatar = sa.Column(sa.BLOB)
+    avatar_hash = sa.Column(sa.String(40), index=True)
     descr = sa.Column(sa.String(300))
     last_login = sa.Column(sa.DateTime)
     password = sa.Column(PasswordType(schemes=['pbkdf2_sha512']), nullable=False, unique=False)
@@ -261,7 +376,85 @@ class User(Core):
     @classmethod
     def by_name(cls, username):
         """Возвращает объект пользователя по его имени."""
-        return cls.query().filter(func.lower(cls.username) == username.lower()).first()
+        if not username:
+            return None
+        key = username.lower()
+        user = user_cache.get(key)
+        if user is None:
+            generation = user_cache.generation
+            user = cls.query().filter(func.lower(cls.username) == key).first()
+            if user:
+                user_cache.put(key, user, generation)
+        return user
+
+    @classmethod
+    def by_names(cls, names):
+        """Пользователи по списку имен."""
+        return cls.query().filter(cls.username.in_(list(names))).all()
+
+    def save(self):
+        # в списке пользователей имя и аватар, вход и смена ключа не в счет
+        state = sa.inspect(self)
+        changed = not state.persistent or any(state.attrs[f].history.has_changes() for f in ('username', 'avatar'))
+        super().save()
+        user_cache.discard(self.username.lower())
+        if changed:
+            Change.touch(USERS, self.username)
+        return self
+
+    @staticmethod
+    def hash_avatar(avatar):
+        """Хеш sha1 содержимого аватара."""
+        return hashlib.sha1(avatar).hexdigest() if avatar else None
+
+    @validates('avatar')
+    def set_avatar_hash(self, key, avatar):
+        self.avatar_hash = self.hash_avatar(avatar)
+        return avatar
+
+    @classmethod
+    def avatars(cls, hashes):
+        """Аватары по хешам содержимого.
+
+        Args:
+            hashes: хеши аватаров
+
+        Returns:
+            Хеш -> аватар, неизвестные хеши пропускаются
+            dict
+
+        """
+        rows = cls.query(cls.avatar_hash, cls.avatar).filter(cls.avatar_hash.in_(list(hashes)))
+        return dict(rows)
+
+    @classmethod
+    def search(cls, prefix=None, limit=None, after=None):
+        """Поиск пользователей по началу имени без учета регистра.
+
+        Условие на префикс задается диапазоном, чтобы использовался
+        индекс по ``lower(username)``.
+
+        Args:
+            prefix: начало имени (default: {None})
+            limit: количество пользователей (default: {None})
+            after: имя в нижнем регистре, после которого начинать (default: {None})
+
+        Returns:
+            Пользователи по возрастанию имени
+            list
+
+        """
+        name = func.lower(cls.username)
+        query = cls.query()
+        if prefix:
+            prefix = prefix.lower()
+            query = query.filter(name >= prefix, name < f'{prefix}\uffff')
+        if after:
+            query = query.filter(name > after)
+        query = query.order_by(name)
+        if limit:
+            query = query.limit(limit)
+        return query.all()
 
     def get_last_login(self):
         """Хитрый способ получения времени последнего входа."""
@@ -286,7 +479,7 @@ class User(Core):
             'port': kwargs.get('port', None),
         }
         ActiveUsers.create(**param)
-        UserHistory.create(type_row=TypeHistory.login, **param)
+        UserHistory.record(user, TypeHistory.login, ip_addr=param['ip_addr'], port=param['port'])
 
     @classmethod
     def logout_user(cls, username, **kwargs):
@@ -294,10 +487,11 @@ class User(Core):
         user = cls.by_name(username)
         if not user:
             logger.warn(str(NotFoundUser(username)))
+        user_cache.discard(username.lower())
         ActiveUsers.delete_qs(ActiveUsers.filter_by(oper=user))
-        UserHistory.create(
-            type_row=TypeHistory.logout,
-            oper=user,
+        UserHistory.record(
+            user,
+            TypeHistory.logout,
             ip_addr=str(kwargs.get('ip_addr', '')),
             port=kwargs.get('port', None),
         )
@@ -332,6 +526,7 @@ class User(Core):
             self.contacts.append(Contact(contact=cont))
             self.history.append(UserHistory(type_row=TypeHistory.add_contact, note=contact_name))
             self.save()
+            Change.touch(CONTACTS, cont.username, self.username)
 
     def del_contact(self, contact_name):
         """Удаляет контакт.
@@ -347,16 +542,17 @@ class User(Core):
             self.contacts.remove(Contact.filter_by(owner=self, contact=cont).one())
             self.history.append(UserHistory(type_row=TypeHistory.del_contact, note=contact_name))
             self.save()
+            Change.touch(CONTACTS, cont.username, self.username, deleted=True)
 
-    @hybrid_property
+    @property
     def sent(self):
         """Количество отправленных сообщений."""
-        return UserHistory.filter_by(oper=self, type_row=TypeHistory.mes_sent).count()
+        return self.counter.sent if self.counter else 0
 
-    @hybrid_property
+    @property
     def accepted(self):
         """Количество полученных сообщений."""
-        return UserHistory.filter_by(oper=self, type_row=TypeHistory.mes_accepted).count()
+        return self.counter.accepted if self.counter else 0
 
 
 class TypeHistory(enum.Enum):
@@ -382,6 +578,63 @@ class TypeHistory(enum.Enum):
     mes_accepted = 7
 
 
+# события истории, которые считаются в MessageCounter
+MESSAGE_COUNTERS = {TypeHistory.mes_sent: 'sent', TypeHistory.mes_accepted: 'accepted'}
+
+
+class MessageCounter(Base):
+    """Счетчики сообщений пользователя.
+
+    Ведутся записью истории в той же транзакции, что и сами события.
+
+    Attributes:
+        oper_id: ИД пользователя
+        sent: отправлено сообщений
+        accepted: получено сообщений
+        oper: обратная ссылка на пользователя
+
+    """
+
+    oper_id = sa.Column(sa.ForeignKey('user.id', ondelete='CASCADE'), unique=True, nullable=False)
+    sent = sa.Column(sa.Integer, default=0, nullable=False)
+    accepted = sa.Column(sa.Integer, default=0, nullable=False)
+
+    oper = relationship('User', backref=backref('counter', uselist=False), foreign_keys=[oper_id])
+
+    @classmethod
+    def add(cls, session, counters):
+        """Увеличение счетчиков без коммита.
+
+        Args:
+            session: сессия записи
+            counters: {ИД пользователя: {имя счетчика: прирост}}
+
+        """
+        for oper_id, inc in counters.items():
+            values = {getattr(cls, name): getattr(cls, name) + count for name, count in inc.items()}
+            if not session.query(cls).filter_by(oper_id=oper_id).update(values, synchronize_session=False):
+                session.add(cls(oper_id=oper_id, **inc))
+
+    @classmethod
+    def recount(cls):
+        """Заполнение счетчиков по истории для пользователей без них."""
+        session = Core._session
+        missing = Core.query(User.id).filter(~User.id.in_(Core.query(cls.oper_id))).all()
+        if not missing:
+            return
+        ids = [row.id for row in missing]
+        counters = defaultdict(Counter, {id_: Counter() for id_ in ids})
+        rows = Core.query(UserHistory.oper_id, UserHistory.type_row, func.count(UserHistory.id)).filter(
+            UserHistory.oper_id.in_(ids),
+            UserHistory.type_row.in_(list(MESSAGE_COUNTERS)),
+        ).group_by(UserHistory.oper_id, UserHistory.type_row)
+        for oper_id, type_row, count in rows:
+            counters[oper_id][MESSAGE_COUNTERS[type_row]] = count
+        session.add_all([cls(oper_id=oper_id, sent=inc['sent'], accepted=inc['accepted']) for oper_id, inc in counters.items()])
+        session.commit()
+        logger.info(f'Пересчитаны счетчики сообщений {len(ids)} пользователей')
+
+
 class UserHistory(Core):
     """История пользователя.
 
@@ -406,6 +659,7 @@ class UserHistory(Core):
     note = sa.Column(sa.String())
 
     oper = relationship('User', backref='history', foreign_keys=[oper_id])
+    sessions = None  # реестр сессий по потокам, задается в init_sqlite
 
     @classmethod
     def proc_message(cls, scr, dest):
@@ -416,8 +670,54 @@ class UserHistory(Core):
             dest: получатель
 
         """
-        cls.create(oper=User.by_name(scr), type_row=TypeHistory.mes_sent)
-        cls.create(oper=User.by_name(dest), type_row=TypeHistory.mes_accepted)
+        cls.record(User.by_name(scr), TypeHistory.mes_sent)
+        cls.record(User.by_name(dest), TypeHistory.mes_accepted)
+
+    @staticmethod
+    def record(user, type_row, **kwargs):
+        """Постановка события в очередь записи.
+
+        Объекты сессии запроса в поток записи не передаются, только id.
+
+        Args:
+            user: пользователь или None
+            type_row: тип события
+            **kwargs: прочие поля
+
+        """
+        history.put(dict(
+            oper_id=user.id if user else None,
+            type_row=type_row,
+            created=datetime.datetime.utcnow(),
+            **kwargs,
+        ))
+
+    @classmethod
+    def write_many(cls, rows):
+        """Запись пачки событий и счетчиков сообщений одной транзакцией."""
+        session = cls.sessions()
+        try:
+            session.add_all([cls(**row) for row in rows])
+            counters = defaultdict(Counter)
+            for row in rows:
+                if row['oper_id'] and row['type_row'] in MESSAGE_COUNTERS:
+                    counters[row['oper_id']][MESSAGE_COUNTERS[row['type_row']]] += 1
+            MessageCounter.add(session, counters)
+            session.commit()
+        except Exception:
+            # иначе сессия потока записи не примет следующие пачки
+            session.rollback()
+            raise
+
+
+# история не читается на пути запроса и пишется пачками в фоне
+history = BatchWriter(
+    UserHistory.write_many,
+    batch=settings.as_int('HISTORY_BATCH'),
+    delay=settings.as_float('HISTORY_DELAY'),
+    maxsize=settings.as_int('HISTORY_BUFFER'),
+    name='history_writer',
+)
 
 
 class ActiveUsers(Core):
@@ -9,11 +9,7 @@ from functools import wraps
 
 from dynaconf import settings
 
-from .db import DBManager
-from .jim_mes import Message
-
 logger = logging.getLogger('decorators')
-db = DBManager('server')
 
 
 def get_name_by_frame(frame):
@@ -81,22 +77,42 @@ def login_required(func):
     return checker
 
 
-def login_required_db(func):
+def session_required(func):
+    """Декоратор проверяющий сессию подключения.
+
+    Команда выполняется только на подключении прошедшем авторизацию и
+    только от имени пользователя сессии (:py:class:`~async_core.Session`).
+    Проверка не обращается к БД.
+
+    Args:
+        func: декорируемая функция
+
+    Returns:
+        Результат выполнения декорируемой функции
+
+    Raises:
+        TypeError: если подключение не авторизовано или сообщение от чужого имени
+
+    """
+    def is_authorized(kwargs):
+        session = getattr(kwargs.get('proto'), 'session', None)
+        return bool(session and session.owns(kwargs.get('msg')))
+
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_checker(*args, **kwargs):
+            if not is_authorized(kwargs):
+                logger.critical('Ошибка session_required')
+                raise TypeError
+            return await func(*args, **kwargs)
+
+        return async_checker
+
+    @wraps(func)
     def checker(*args, **kwargs):
-        user = None
-        for x in args:
-            if isinstance(x, Message):
-                user = db.User.by_name(x.user_account_name)
-                break
-        for k, v in kwargs.items():
-            if isinstance(v, Message):
-                user = db.User.by_name(v.user_account_name)
-                break
-
-        if not user or not user.user_activity:
-            logger.critical('Ошибка login_required')
+        if not is_authorized(kwargs):
+            logger.critical('Ошибка session_required')
             raise TypeError
-
         return func(*args, **kwargs)
 
     return checker
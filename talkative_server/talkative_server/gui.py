@@ -13,7 +13,7 @@ from pathlib import Path
 from dynaconf import settings
 from dynaconf.loaders import yaml_loader as loader
 from PyQt5 import uic
-from PyQt5.QtCore import QSettings, Qt, pyqtSlot
+from PyQt5.QtCore import QObject, QSettings, Qt, pyqtSignal, pyqtSlot
 from PyQt5.QtGui import QStandardItem, QStandardItemModel
 from PyQt5.QtWidgets import (QApplication, QDialog, QFileDialog, QInputDialog,
                              QMainWindow, QMessageBox)
@@ -56,6 +56,19 @@ class SaveGeometryMixin(object):
         e.accept()
 
 
+class QtObserver(QObject):
+    """Мост событий сервера в поток Qt.
+
+    Сервер вызывает подписчика в своем потоке, сигнал доставляет
+    параметры события окну уже в потоке GUI.
+    """
+
+    received = pyqtSignal(dict)
+
+    def __call__(self, proto=None, msg=None, **kwargs):
+        self.received.emit({'proto': proto, 'msg': msg, **kwargs})
+
+
 class ServerGUI(object):
     """Класс прослойка."""
     def __init__(self, server):
@@ -81,7 +94,8 @@ class ServerMainWindow(SaveGeometryMixin, QMainWindow):
         """
         self.server = server
         super().__init__()
-        self.server.update.connect(self.update)
+        self.observer = QtObserver()
+        self.observer.received.connect(self.update)
         self.server.start()
         uic.loadUi(cfile.joinpath(Path('templates/server_settings.ui')), self)
 
@@ -101,14 +115,18 @@ class ServerMainWindow(SaveGeometryMixin, QMainWindow):
 
     def register_event(self):
         """Регистрация событий."""
-        for event in self.events.keys():
-            self.server.attach(self, event)
+        self.attach_server()
 
         for action in self.toolBar.actions():
             method = self.events.get(action.objectName())
             if method:
                 action.triggered.connect(method)
 
+    def attach_server(self):
+        """Подписка на события сервера."""
+        for event in self.events.keys():
+            self.server.attach(self.observer, event)
+
     def init_ui(self):
         """Инициализация интерфейса."""
         super().init_ui()
@@ -173,6 +191,7 @@ class ServerMainWindow(SaveGeometryMixin, QMainWindow):
             time.sleep(1)
         self.server = server()
         self.server.daemon = True
+        self.attach_server()
         self.server.start()
 
     def create_group(self):
@@ -194,8 +213,7 @@ class ServerMainWindow(SaveGeometryMixin, QMainWindow):
                     break
                 item, ok = QInputDialog.getItem(self, 'Выберите участников для перкращения нажмите отмену', 'Участник:', items)
                 if ok and item:
-                    chat.update(push__members=db.User.by_name(item))
-                    chat.reload()
+                    chat.set_members([*chat.members, db.User.by_name(item)])
                 chat.save()
 
 
@@ -224,7 +242,7 @@ class HistoryWindow(SaveGeometryMixin, QDialog):
         """Обновление списка пользователей."""
         list_ = QStandardItemModel()
         list_.setHorizontalHeaderLabels(['Пользователь', 'Последний вход', 'Сообщений отправлено', 'Сообщений получено'])
-        for auser in db.User.objects.all():
+        for auser in db.User.objects.only('username', 'last_login', 'sent', 'accepted'):
             user = QStandardItem(auser.username)
             user.setEditable(False)
             last_login = QStandardItem(str(auser.last_login.replace(microsecond=0) if auser.last_login else 'Не входил'))
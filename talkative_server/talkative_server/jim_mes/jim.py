@@ -3,41 +3,129 @@
 # @Date:   2019-04-07 11:20:56
 # @Last Modified by:   MaxST
 # @Last Modified time: 2019-08-23 10:03:38
+import itertools
 import time
 
 from dynaconf import settings
 
-from .convert import Converter
+from .convert import dispatcher
+from .frame import HEADER
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+_codecs = {}
+_request_ids = itertools.count(1)
+
+
+def get_codec(name='json'):
+    """Общий экземпляр конвертера.
+
+    Конвертеры не хранят состояния, поэтому один экземпляр на формат
+    используется всеми сообщениями.
+
+    Args:
+        name: имя формата в диспетчере (default: {'json'})
+
+    Returns:
+        Конвертер формата
+        object
+
+    """
+    conv = _codecs.get(name)
+    if conv is None:
+        conv = _codecs[name] = dispatcher.get_objects()[name]()
+    return conv
+
+
+json_codec = get_codec('json')
 
 
 class Message(object):
     """Класс сообщения.
 
     Отдает свои атребуты как ключи из данных и без генерации
-    ошибок
+    ошибок. Время сообщения форматируется при первом обращении
+    к нему или при кодировании. Принятое сообщение хранит исходные
+    байты кадра и пересылается ими же, если кодек получателя совпадает.
 
     """
 
+    __slots__ = ('_raw', '_created', '_frame', '_codec', 'date_format', 'delimiter', 'client')
+
     def __init__(self, loads=None, **kwargs):
         """Инициализация."""
-        self.conv = Converter(type='json')
-        date_format = kwargs.pop('date_format', '%Y-%m-%d %H:%M:%S')
+        self.date_format = kwargs.pop('date_format', DATE_FORMAT)
         self.delimiter = kwargs.pop('delimiter', '\r\n')
+        self._frame = self._codec = None
         if loads:
-            self.__raw = self.conv.reads(loads)
+            if not isinstance(loads, (str, bytes)):
+                # кадр собранный из нескольких чтений приходит как bytearray
+                loads = bytes(loads)
+            # JSON всегда начинается с "{", двоичный кодек - нет
+            if isinstance(loads, str) or loads[:1] == b'{':
+                self._codec = 'json'
+                self._raw = json_codec.reads(loads)
+            else:
+                self._codec = 'msgpack'
+                self._raw = get_codec('msgpack').reads(loads)
+            if isinstance(loads, bytes):
+                self._frame = loads
         else:
-            self.__raw = kwargs
-        self.__raw['time'] = time.strftime(date_format)
-        self.required = (settings.ACTION, settings.SENDER, settings.DESTINATION, settings.MESSAGE_TEXT)
+            self._raw = kwargs
+        # время отправителя сохраняется, новое сообщение получает текущее
+        self._created = None if 'time' in self._raw else time.time()
+
+    def _stamp(self):
+        if self._created is not None:
+            self._raw['time'] = time.strftime(self.date_format, time.localtime(self._created))
+            self._created = None
+        return self._raw
 
     def __bytes__(self):
         """Преобразование в байты."""
-        return f'{self.conv.dumps(self.__raw)}{self.delimiter}'.encode()
+        return self.encode()
+
+    def encode(self, codec=None):
+        """Преобразование в байты выбранным кодеком.
+
+        Args:
+            codec: имя конвертера, None - JSON (default: {None})
+
+        Returns:
+            Данные кадра
+            bytes
+
+        """
+        codec = codec or 'json'
+        if self._frame is not None and codec == self._codec:
+            return self._frame
+        if codec == 'json':
+            return f'{json_codec.dumps(self._stamp())}{self.delimiter}'.encode()
+        return get_codec(codec).dumps(self._stamp())
+
+    def to_frame(self, codec=None):
+        """Кадр с префиксом длины, готовый к записи в сокет.
+
+        Args:
+            codec: имя конвертера, None - JSON (default: {None})
+
+        Returns:
+            Заголовок и данные одним буфером
+            bytes
+
+        """
+        data = self.encode(codec)
+        return HEADER.pack(len(data)) + data
+
+    @property
+    def frame(self):
+        """Исходные байты принятого кадра, у созданного сообщения - JSON."""
+        return self.encode(self._codec)
 
     def __str__(self):
         """Преобразование в строку."""
-        response = getattr(self, settings.MESSAGE_TEXT, self.__raw) or self.__raw
-        resp = self.__raw.get('response', None)
+        raw = self._raw
+        response = raw.get(settings.MESSAGE_TEXT) or raw
+        resp = raw.get('response', None)
         if resp == 400:
             response = f'client error:\n{self.error}'
         elif resp == 500:
@@ -45,28 +133,64 @@ class Message(object):
         return f'{response}'
 
     def __getattr__(self, attr):
-        """Получение атрибутов."""
-        if attr and attr not in vars(self) and not hasattr(type(self), attr):
-            return self.__raw[attr] if attr in self.__raw else None
-        return super().__getattr__(attr)
+        """Получение атрибутов.
+
+        Вызывается только для имен, которых нет среди слотов и атрибутов
+        класса.
+        """
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        if attr == 'time':
+            return self._stamp()['time']
+        return self._raw.get(attr)
 
     def is_valid(self):
         """Проверка на валидность сообщения."""
-        val = True
-        for attr in self.required:
-            if attr not in self.__raw:
-                val = False
-                break
-        if settings.USER_NAME and val and getattr(self, settings.DESTINATION, None) != settings.USER_NAME:
-            val = False
-        return val
+        raw = self._raw
+        for attr in (settings.ACTION, settings.SENDER, settings.DESTINATION, settings.MESSAGE_TEXT):
+            if attr not in raw:
+                return False
+        return not settings.USER_NAME or raw.get(settings.DESTINATION) == settings.USER_NAME
+
+    def reply_to(self, msg_id):
+        """Отметка ответа id запроса.
+
+        Args:
+            msg_id: id запроса, None - не отмечать
+
+        Returns:
+            Возвращает себя
+            Message
+
+        """
+        if msg_id is not None and self._frame is None:
+            self._raw.setdefault(settings.MESSAGE_ID, msg_id)
+        return self
+
+    @property
+    def header(self):
+        """Заголовок маршрутизации.
+
+        Returns:
+            Действие, отправитель, получатель, чат и id сообщения
+            tuple
+
+        """
+        raw = self._raw
+        return (
+            raw.get(settings.ACTION),
+            raw.get(settings.SENDER),
+            raw.get(settings.DESTINATION),
+            raw.get('chat'),
+            raw.get(settings.MESSAGE_ID),
+        )
 
     @property
     def user_account_name(self):
         """Имя пользователя."""
         try:
             for x in (settings.USER, settings.SENDER, settings.DESTINATION):
-                name = self.__raw.get(x)
+                name = self._raw.get(x)
                 if name:
                     return name
         except ValueError:
@@ -103,6 +227,21 @@ class Message(object):
         """
         return cls(response=400, error=text, **kwargs)
 
+    @classmethod
+    def slow_down(cls, retry_after, **kwargs):
+        """Превышен лимит запросов.
+
+        Args:
+            retry_after: через сколько секунд можно повторить запрос
+            **kwargs: доп. параметры
+
+        Returns:
+            Возвращает себя инициализированного
+            Message
+
+        """
+        return cls(response=429, error='Слишком много запросов', **{settings.RETRY_AFTER: round(retry_after, 3)}, **kwargs)
+
     @classmethod
     def error_request(cls, text, **kwargs):
         """Ошибка.
@@ -118,6 +257,24 @@ class Message(object):
         """
         return cls(action=settings.ERROR, msg=text, **kwargs)
 
+    @classmethod
+    def request(cls, **kwargs):
+        """Запрос к серверу.
+
+        Запрос получает id, уникальный в пределах процесса, сервер
+        повторяет его в ответе.
+
+        Args:
+            **kwargs: параметры запроса
+
+        Returns:
+            Возвращает себя инициализированного
+            Message
+
+        """
+        kwargs.setdefault(settings.MESSAGE_ID, next(_request_ids))
+        return cls(**kwargs)
+
     @classmethod
     def presence(cls, type_='status', user=None, **kwargs):
         """Презентационное сообщение.
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""Настройка сокетов по профилю из настроек.
+
+Профиль задается ключами TCP_NODELAY, SO_KEEPALIVE, TCP_KEEPIDLE,
+TCP_KEEPINTVL, TCP_KEEPCNT, SO_SNDBUF и SO_RCVBUF. Пустое значение
+оставляет параметр ОС по умолчанию. Опции, которых нет на платформе,
+пропускаются.
+"""
+import logging
+import socket
+
+from dynaconf import settings
+
+logger = logging.getLogger('sockets')
+
+
+def socket_options():
+    """Опции сокета из настроек.
+
+    Returns:
+        Список (level, option, value) для setsockopt
+        list
+
+    """
+    options = []
+    nodelay = settings.get('TCP_NODELAY')
+    if nodelay is not None:
+        options.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, int(bool(nodelay))))
+    keepalive = settings.get('SO_KEEPALIVE')
+    if keepalive is not None:
+        options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, int(bool(keepalive))))
+    if keepalive:
+        for name in ('TCP_KEEPIDLE', 'TCP_KEEPINTVL', 'TCP_KEEPCNT'):
+            value = settings.get(name)
+            if value and hasattr(socket, name):
+                options.append((socket.IPPROTO_TCP, getattr(socket, name), int(value)))
+    for name in ('SO_SNDBUF', 'SO_RCVBUF'):
+        value = settings.get(name)
+        if value:
+            options.append((socket.SOL_SOCKET, getattr(socket, name), int(value)))
+    return options
+
+
+def tune_socket(sock):
+    """Применение профиля к сокету.
+
+    Args:
+        sock: сокет (или ``TransportSocket`` из транспорта asyncio)
+
+    """
+    if sock is None or sock.family not in (socket.AF_INET, socket.AF_INET6):
+        return
+    for level, option, value in socket_options():
+        try:
+            sock.setsockopt(level, option, value)
+        except OSError as error:
+            logger.warning(f'Опция сокета {option} не применена: {error}')
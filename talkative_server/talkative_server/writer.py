@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""Фоновая запись в БД пачками.
+
+Используется для записей, которые не читаются на пути запроса
+(история пользователей): запрос только ставит запись в очередь.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger('server__db')
+STOP = object()
+
+
+class BatchWriter(object):
+    """Фоновая запись пачками.
+
+    Записи копятся в ограниченной очереди, поток записи забирает их
+    пачками до ``batch`` штук и ждет не дольше ``delay`` секунд после
+    первой записи пачки. Когда очередь заполнена, :py:meth:`put` ждет
+    места: записи не теряются, источник замедляется до скорости записи.
+    Поток запускается первой записью, остаток пишется при
+    :py:meth:`close` (в т.ч. при выходе из интерпретатора).
+
+    Attributes:
+        write: функция записи пачки, получает список записей
+        batch: максимум записей в пачке
+        delay: максимальная задержка записи в секундах
+        written: записано
+        failed: потеряно из-за ошибок записи
+
+    """
+
+    def __init__(self, write, batch=500, delay=1.0, maxsize=10000, name='batch_writer'):
+        """Инициализация.
+
+        Args:
+            write: функция записи пачки
+            batch: максимум записей в пачке (default: {500})
+            delay: максимальная задержка в секундах (default: {1.0})
+            maxsize: размер очереди (default: {10000})
+            name: имя потока записи (default: {'batch_writer'})
+
+        """
+        super().__init__()
+        self.write = write
+        self.batch = batch
+        self.delay = delay
+        self.name = name
+        self.written = self.failed = 0
+        self.queue = queue.Queue(maxsize)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def put(self, item):
+        """Постановка записи в очередь."""
+        if self._thread is None:
+            self.start()
+        self.queue.put(item)
+
+    def start(self):
+        """Запуск потока записи."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def close(self, timeout=None):
+        """Запись остатка очереди и остановка потока.
+
+        Args:
+            timeout: ожидание потока в секундах (default: {None})
+
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        atexit.unregister(self.close)
+        self.queue.put(STOP)
+        thread.join(timeout)
+
+    def stats(self):
+        """Счетчики записи.
+
+        Returns:
+            В очереди, записано и потеряно
+            dict
+
+        """
+        return {'pending': self.queue.qsize(), 'written': self.written, 'failed': self.failed}
+
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self.queue.get()
+            if item is STOP:
+                break
+            items = [item]
+            deadline = time.monotonic() + self.delay
+            while len(items) < self.batch:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is STOP:
+                    stop = True
+                    break
+                items.append(item)
+            try:
+                self.write(items)
+                self.written += len(items)
+            except Exception as error:
+                self.failed += len(items)
+                logger.error(f'Не записано {len(items)} записей: {error}', exc_info=True)
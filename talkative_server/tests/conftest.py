@@ -0,0 +1,44 @@
+import tempfile
+from pathlib import Path
+
+import pytest
+from dynaconf import settings
+
+# команды сервера работают с временной БД sqlite вместо MongoDB
+settings.set('DATABASES', {
+    **settings.DATABASES,
+    'server': {
+        'ENGINE': 'sqlite',
+        'NAME': str(Path(tempfile.mkdtemp()).joinpath('db_test.db')),
+        'CONNECT_ARGS': {'check_same_thread': False},
+    },
+})
+
+
+class Proto(object):
+    """Подключение, очередь которого принимает ``capacity`` кадров."""
+
+    peername = ('127.0.0.1', 50000)
+
+    def __init__(self, username=None, capacity=None):
+        from talkative_server.async_core import Session
+
+        self.session = Session(username) if username else None
+        self.codec = None
+        self.capacity = capacity
+        self.sent = []
+
+    def write(self, msg):
+        if self.capacity is not None and len(self.sent) >= self.capacity:
+            return False
+        self.sent.append(msg)
+        return True
+
+    def notify(self, *args, **kwargs):
+        pass
+
+
+@pytest.fixture
+def make_proto():
+    """Фабрика подключений: ``make_proto('alice', capacity=3)``."""
+    return Proto
@@ -0,0 +1,34 @@
+from talkative_server.cache import LRUCache
+
+
+def test_lru_eviction():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+    assert cache.stats()['evictions'] == 1
+
+
+def test_discard_skips_stale_put():
+    cache = LRUCache(8)
+    generation = cache.generation
+    cache.discard('a')
+    cache.put('a', 'old', generation)
+    assert cache.get('a') is None
+    cache.put('a', 'new', cache.generation)
+    assert cache.get('a') == 'new'
+
+
+def test_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('talkative_server.cache.time.monotonic', lambda: now[0])
+    cache = LRUCache(8, ttl=30)
+    cache.put('a', 1)
+    now[0] += 29
+    assert cache.get('a') == 1
+    now[0] += 2
+    assert cache.get('a') is None
+    assert cache.stats()['hits'] == cache.stats()['misses'] == 1
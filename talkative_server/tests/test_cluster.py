@@ -0,0 +1,82 @@
+from types import SimpleNamespace
+
+import pytest
+
+from talkative_server.async_core import ConnectionRegistry
+from talkative_server.cluster import Broker, ClusterClient, ClusterProtocol, db
+from talkative_server.jim_mes import Message, dispatcher
+
+
+class Transport(object):
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+    def writelines(self, chunks):
+        for chunk in chunks:
+            self.data += chunk
+
+    def take(self):
+        data, self.data = bytes(self.data), bytearray()
+        return data
+
+
+def connect(handler):
+    conn = ClusterProtocol(handler)
+    conn.connection_made(Transport())
+    return conn
+
+
+@pytest.fixture
+def saved(monkeypatch):
+    """Сообщения которые воркер записал бы в БД."""
+    calls = []
+    monkeypatch.setattr(db.module, 'Chat', SimpleNamespace(create_msg=None), raising=False)
+    monkeypatch.setattr(db, 'spawn', lambda func, *args: calls.append(args))
+    return calls
+
+
+def worker(**users):
+    server = SimpleNamespace(users=ConnectionRegistry())
+    for name, proto in users.items():
+        server.users.add(name, proto)
+    client = ClusterClient(server, 'broker.sock')
+    client.conn = connect(client)
+    return client
+
+
+@pytest.mark.skipif('msgpack' not in dispatcher.get_objects(), reason='msgpack не установлен')
+def test_route_forwards_original_frame(saved, make_proto):
+    broker = Broker('broker.sock')
+    bob = make_proto()
+    sender, receiver = worker(), worker(bob=bob)
+    from_sender, from_receiver = connect(broker), connect(broker)
+    from_receiver.transport.take()
+    broker.owners['bob'] = from_receiver
+    sender.remote.add('bob')
+
+    frame = Message(action='message', to='bob', mess_text='привет', chat=None).encode('msgpack')
+    assert sender.route('Bob', Message(frame))
+    from_sender.data_received(sender.conn.transport.take())
+    receiver.conn.data_received(from_receiver.transport.take())
+
+    assert bob.sent[0].encode('msgpack') == frame
+    assert saved == [(bob.sent[0], True)]
+
+
+def test_route_returns_to_sender_when_owner_left(saved):
+    broker = Broker('broker.sock')
+    sender = worker()
+    conn = connect(broker)
+    conn.transport.take()
+    sender.remote.add('bob')
+
+    msg = Message(action='message', to='bob', mess_text='hi', chat=None)
+    assert sender.route('bob', msg)
+    conn.data_received(sender.conn.transport.take())
+    sender.conn.data_received(conn.transport.take())
+
+    assert len(saved) == 1
+    assert saved[0][0].mess_text == 'hi'
@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+from talkative_server.async_core import ListMessagesCommand, MessageCommand, Session, db
+from talkative_server.jim_mes import Message
+
+
+class Messages(object):
+    """Недоставленные сообщения в памяти вместо БД."""
+
+    rows = {}
+
+    @classmethod
+    def pending(cls, receiver, limit=None, after=None):
+        ids = sorted(i for i in cls.rows if after is None or i > after)[:limit]
+        return [(i, 'bob', None, cls.rows[i]) for i in ids]
+
+    @classmethod
+    def mark_received(cls, ids):
+        for i in ids:
+            del cls.rows[i]
+
+
+@pytest.fixture
+def messages(monkeypatch):
+    monkeypatch.setattr(db.module, 'Messages', Messages, raising=False)
+    monkeypatch.setattr(Messages, 'rows', {i: f'm{i}' for i in range(1, 8)})
+    return Messages.rows
+
+
+def get_messages(proto, **kwargs):
+    msg = Message(action='get_messages', user='alice', **kwargs)
+    asyncio.run(ListMessagesCommand().update(proto=proto, msg=msg))
+
+
+def test_messages_marked_only_when_queued(messages, make_proto):
+    get_messages(make_proto('alice', capacity=3))
+    assert sorted(messages) == [4, 5, 6, 7]
+    get_messages(make_proto('alice'))
+    assert messages == {}
+
+
+def test_batch_not_queued_stays_pending(messages, make_proto):
+    proto = make_proto('alice', capacity=1)
+    get_messages(proto, limit=5)
+    assert len(proto.sent[0].data_list) == 5
+    assert sorted(messages) == [6, 7]
+
+
+@pytest.mark.parametrize('fields, owns', [
+    ({}, True),
+    ({'user': 'ALICE', 'from': 'alice'}, True),
+    ({'user': 'bob'}, False),
+    ({'from': 'bob'}, False),
+    ({'user': 'alice', 'from': 'bob'}, False),
+    ({'from': ['alice']}, False),
+])
+def test_session_owns(fields, owns):
+    assert Session('Alice').owns(Message(action='message', **fields)) is owns
+
+
+def test_foreign_sender_rejected(make_proto):
+    proto = make_proto('alice')
+    msg = Message(**{'action': 'message', 'from': 'bob', 'to': 'alice', 'text': 'hi'})
+    with pytest.raises(TypeError):
+        asyncio.run(MessageCommand().update(proto=proto, msg=msg))
+    assert proto.sent == []
+
+
+def test_foreign_history_rejected(messages, make_proto):
+    with pytest.raises(TypeError):
+        get_messages(make_proto('bob'))
+    assert len(messages) == 7
+
+
+def test_unauthenticated_rejected(messages, make_proto):
+    proto = make_proto()
+    with pytest.raises(TypeError):
+        get_messages(proto)
+    assert proto.sent == []
+    assert len(messages) == 7
@@ -0,0 +1,12 @@
+from talkative_server.db_mongo import plan_stages
+
+
+def test_plan_stages_collscan():
+    plan = {
+        'stage': 'SORT',
+        'inputStage': {'stage': 'OR', 'inputStages': [
+            {'stage': 'IXSCAN', 'indexName': 'receiver_1'},
+            {'stage': 'COLLSCAN'},
+        ]},
+    }
+    assert plan_stages(plan) == (['SORT', 'OR', 'IXSCAN', 'COLLSCAN'], ['receiver_1'])
@@ -0,0 +1,32 @@
+import asyncio
+import hashlib
+
+from talkative_server.async_core import db
+
+
+def test_avatars_by_stored_hash():
+    user = db.User.by_name('ava_user') or db.User.create(username='ava_user', password='secret')
+    user.avatar = b'png'
+    user.save()
+    digest = hashlib.sha1(b'png').hexdigest()
+    assert user.avatar_hash == digest
+    assert db.User.avatars([digest, 'unknown']) == {digest: b'png'}
+    user.avatar = None
+    user.save()
+    assert db.User.avatars([digest]) == {}
+
+
+def test_by_name_without_name():
+    assert db.User.by_name(None) is None
+    assert db.User.by_name('') is None
+
+
+def test_spawn_logs_error(caplog):
+    def fail():
+        raise RuntimeError('disk full')
+
+    async def main():
+        await asyncio.wait([db.spawn(fail)])
+
+    asyncio.run(main())
+    assert 'disk full' in caplog.text
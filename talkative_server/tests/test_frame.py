@@ -0,0 +1,68 @@
+import struct
+
+import pytest
+
+from talkative_server.jim_mes import Deflater, FrameDecoder, FrameError
+from talkative_server.jim_mes.frame import encode
+
+
+def pack(data):
+    return struct.pack('>I', len(data)) + data
+
+
+def test_coalesced_frames():
+    decoder = FrameDecoder()
+    assert decoder.feed(pack(b'one') + pack(b'two') + pack(b'three')) == [b'one', b'two', b'three']
+
+
+def test_split_frames():
+    stream = pack(b'first') + pack(b'second')
+    decoder = FrameDecoder()
+    frames = []
+    for i in range(len(stream)):
+        frames.extend(bytes(f) for f in decoder.feed(stream[i:i + 1]))
+    assert frames == [b'first', b'second']
+
+
+def test_max_size():
+    with pytest.raises(FrameError):
+        FrameDecoder(4).feed(pack(b'too long'))
+
+
+def test_compressed_stream():
+    deflater = Deflater()
+    messages = [b'{"action": "message", "from": "a", "to": "b", "mess_text": "%d"}\r\n' % i for i in range(5)]
+    stream = b''.join(b''.join(encode(m, deflater)) for m in messages)
+    assert len(stream) < sum(len(m) for m in messages)
+    decoder = FrameDecoder()
+    decoder.enable_compression()
+    frames = []
+    for i in range(0, len(stream), 3):
+        frames.extend(bytes(f) for f in decoder.feed(stream[i:i + 3]))
+    assert frames == messages
+
+
+def test_compressed_not_negotiated():
+    with pytest.raises(FrameError):
+        FrameDecoder().feed(b''.join(encode(b'data', Deflater())))
+
+
+def test_compressed_max_size():
+    decoder = FrameDecoder(1024)
+    decoder.enable_compression()
+    with pytest.raises(FrameError):
+        decoder.feed(b''.join(encode(bytes(4096), Deflater())))
+
+
+def test_compressed_after_511_in_one_chunk():
+    deflater = Deflater()
+    auth = b'{"response": 511, "action": "auth", "compress": "zlib"}'
+    update = b'{"response": 205}'
+    stream = b''.join(encode(auth)) + b''.join(encode(update, deflater))
+    decoder = FrameDecoder(hold=True)
+    assert decoder.feed(stream[:-2]) == [auth]
+    assert decoder.feed(stream[-2:]) == []
+    assert decoder.resume() == []
+    decoder.enable_compression()
+    assert decoder.resume() == [update]
+    assert decoder.resume() == []
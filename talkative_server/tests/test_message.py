@@ -0,0 +1,50 @@
+import struct
+
+import pytest
+
+from talkative_server.jim_mes import FrameDecoder, Message, dispatcher
+
+
+@pytest.mark.skipif('msgpack' not in dispatcher.get_objects(), reason='msgpack не установлен')
+def test_msgpack_roundtrip():
+    msg = Message(action='message', to='bob', mess_text='привет', chat=None, custom=[1, 2])
+    data = msg.encode('msgpack')
+    assert len(data) < len(msg.encode())
+    decoded = Message(data)
+    for key in ('action', 'to', 'mess_text', 'chat', 'custom', 'time'):
+        assert getattr(decoded, key) == getattr(msg, key)
+
+
+def test_json_default():
+    msg = Message(action='ping')
+    assert msg.encode() == msg.encode('json') == bytes(msg)
+    assert Message(bytes(msg)).action == 'ping'
+
+
+def test_forward_original_frame():
+    frame = b'{"action": "message", "from": "a", "to": "b", "chat": null, "id": "1", "time": "2019-01-01 00:00:00"}\r\n'
+    msg = Message(frame)
+    assert msg.header == ('message', 'a', 'b', None, '1')
+    assert msg.encode() is frame
+    assert msg.time == '2019-01-01 00:00:00'
+    if 'msgpack' in dispatcher.get_objects():
+        assert Message(msg.encode('msgpack')).time == '2019-01-01 00:00:00'
+
+
+def test_forward_frame_from_several_reads():
+    frame = b'{"action": "message", "from": "a", "to": "b", "time": "2019-01-01 00:00:00"}'
+    decoder = FrameDecoder()
+    stream = struct.pack('>I', len(frame)) + frame
+    assert decoder.feed(stream[:20]) == []
+    data = decoder.feed(stream[20:])[0]
+    assert isinstance(data, bytearray)
+    msg = Message(data)
+    assert msg.encode() == frame
+    assert msg.encode() is msg.encode()
+
+
+def test_request_ids():
+    first, second = Message.request(action='get_users'), Message.request(action='get_users')
+    assert first.id != second.id
+    assert Message.success(202).reply_to(first.id).id == first.id
+    assert Message.success(202).reply_to(None).id is None
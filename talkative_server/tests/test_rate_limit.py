@@ -0,0 +1,96 @@
+import pytest
+from dynaconf import settings
+
+from talkative_server.async_core import RateLimiter, ServerA, TokenBucket
+from talkative_server.jim_mes import Message
+
+
+class Clock(object):
+    """Часы цикла событий, время двигается вручную."""
+
+    def __init__(self):
+        self.now = 100.0
+
+    def time(self):
+        return self.now
+
+
+def test_bucket_refill_capped():
+    bucket = TokenBucket(rate=2, capacity=4, now=0)
+    bucket.tokens = 0
+    bucket.refill(1)
+    assert bucket.tokens == 2
+    bucket.refill(10)
+    assert bucket.tokens == 4
+    bucket.tokens = 0.5
+    assert bucket.wait() == pytest.approx(0.25)
+
+
+def test_burst_then_retry_after():
+    limiter = RateLimiter({'message': (2, 3)})
+    assert [limiter.check('alice', 'message', 0) for _ in range(3)] == [0, 0, 0]
+    assert limiter.check('alice', 'message', 0) == pytest.approx(0.5)
+    # отказ маркер не забирает
+    assert limiter.check('alice', 'message', 0.25) == pytest.approx(0.25)
+    assert limiter.check('alice', 'message', 0.5) == 0
+    assert limiter.check('alice', 'message', 0.5) == pytest.approx(0.5)
+
+
+def test_action_buckets_separate():
+    limiter = RateLimiter({'message': (1, 1), 'get_users': (1, 1)})
+    assert limiter.check('alice', 'message', 0) == 0
+    assert limiter.check('alice', 'message', 0) > 0
+    assert limiter.check('alice', 'get_users', 0) == 0
+    assert limiter.check('alice', 'presence', 0) == 0
+
+
+def test_user_buckets_separate():
+    limiter = RateLimiter({'message': (1, 1)})
+    assert limiter.check('alice', 'message', 0) == 0
+    assert limiter.check('alice', 'message', 0) > 0
+    assert limiter.check('bob', 'message', 0) == 0
+    limiter.forget('alice')
+    assert limiter.check('alice', 'message', 0) == 0
+
+
+def test_total_bucket_shared_by_actions():
+    limiter = RateLimiter({'message': (10, 10)}, total=(1, 2))
+    assert limiter.check('alice', 'message', 0) == 0
+    assert limiter.check('alice', 'get_users', 0) == 0
+    assert limiter.check('alice', 'presence', 0) == pytest.approx(1)
+    assert limiter.check('alice', 'message', 0) == pytest.approx(1)
+    # запрос отклоненный общей корзиной не тратит маркер действия
+    assert limiter.buckets['alice']['message'].tokens == 9
+
+
+def test_server_answers_429(make_proto):
+    server = ServerA()
+    server.loop = Clock()
+    server.limiter = RateLimiter({'ping_test': (1, 2)})
+    handled = []
+    server.attach(lambda proto, msg, **kwargs: handled.append(msg), 'ping_test')
+    proto = make_proto()
+    server.users.add('alice', proto)
+    for _ in range(3):
+        server.run_command(proto, Message(**{settings.ACTION: 'ping_test'}))
+    assert len(handled) == 2
+    answer = proto.sent[0]
+    assert answer.response == 429
+    assert getattr(answer, settings.RETRY_AFTER) == 1
+    server.loop.now += 1
+    server.run_command(proto, Message(**{settings.ACTION: 'ping_test'}))
+    assert len(handled) == 3
+
+
+def test_full_buckets_swept():
+    limiter = RateLimiter({'message': (1, 2)}, interval=10)
+    limiter.check('alice', 'message', 0)
+    for _ in range(3):
+        limiter.check('bob', 'message', 9)
+    limiter.check('carol', 'message', 10)
+    # корзина alice полна с 1 сек, bob еще ждет маркеры
+    assert set(limiter.buckets) == {'bob', 'carol'}
+    assert limiter.check('bob', 'message', 10) == 0
+    assert limiter.check('bob', 'message', 10) > 0
+    limiter.check('carol', 'message', 20)
+    assert set(limiter.buckets) == {'carol'}
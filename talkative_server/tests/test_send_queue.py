@@ -0,0 +1,154 @@
+import asyncio
+
+import pytest
+from dynaconf import settings
+
+from talkative_server.async_core import SendQueue, db
+from talkative_server.jim_mes import FrameDecoder, Message
+
+
+class Transport(object):
+    """Транспорт с буфером записи заданного размера."""
+
+    def __init__(self, high=64 * 1024, buffered=0):
+        self.high = high
+        self.buffered = buffered
+        self.writes = []
+        self.closing = False
+        self.aborted = False
+
+    def is_closing(self):
+        return self.closing
+
+    def get_write_buffer_limits(self):
+        return self.high // 4, self.high
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+    def writelines(self, chunks):
+        self.writes.append(b''.join(chunks))
+
+    def abort(self):
+        self.aborted = self.closing = True
+
+    def get_extra_info(self, name):
+        return ('127.0.0.1', 7777)
+
+    def frames(self):
+        return [bytes(f) for f in FrameDecoder().feed(b''.join(self.writes))]
+
+
+@pytest.fixture
+def spilled(monkeypatch):
+    """Сообщения которые очередь сохранила бы в БД."""
+    calls = []
+
+    class Chat(object):
+        @staticmethod
+        def create_msg(msg):
+            calls.append(msg)
+
+    monkeypatch.setattr(db.module, 'Chat', Chat, raising=False)
+    monkeypatch.setattr(db, 'spawn', lambda func, *args: func(*args))
+    return calls
+
+
+def chat(text):
+    return Message(**{settings.ACTION: settings.MESSAGE, 'text': text})
+
+
+def run(queue, *frames):
+    """Постановка кадров в очередь и одна итерация цикла событий."""
+    async def main():
+        result = [queue.put(data, msg) for data, msg in frames]
+        await asyncio.sleep(0)
+        return result
+    return asyncio.run(main())
+
+
+def test_frames_coalesced():
+    transport = Transport()
+    queue = SendQueue(transport)
+    assert run(queue, (b'one', None), (b'two', None), (b'three', None)) == [True, True, True]
+    assert len(transport.writes) == 1
+    assert transport.frames() == [b'one', b'two', b'three']
+    assert queue.stats()['peak'] == 3
+
+
+def test_pause_resume():
+    transport = Transport()
+    queue = SendQueue(transport)
+
+    async def main():
+        queue.pause()
+        queue.put(b'one')
+        queue.put(b'two')
+        await asyncio.sleep(0)
+        assert transport.writes == []
+        assert len(queue) == 2
+        queue.resume()
+        await asyncio.sleep(0)
+
+    asyncio.run(main())
+    assert transport.frames() == [b'one', b'two']
+    assert len(queue) == 0
+
+
+def test_full_buffer_sends_frame_per_iteration():
+    transport = Transport(high=100, buffered=100)
+    queue = SendQueue(transport)
+
+    async def main():
+        queue.put(b'one')
+        queue.put(b'two')
+        await asyncio.sleep(0)
+        assert transport.frames() == [b'one']
+        assert len(queue) == 1
+        await asyncio.sleep(0)
+
+    asyncio.run(main())
+    assert transport.frames() == [b'one', b'two']
+    assert len(transport.writes) == 2
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        SendQueue(Transport(), policy='block')
+
+
+def test_spill_policy(spilled):
+    queue = SendQueue(Transport(), maxsize=1, policy='spill')
+    msg = chat('second')
+    assert run(queue, (b'first', None), (b'second', msg), (b'presence', Message(action='presence'))) == [True, False, False]
+    assert spilled == [msg]
+    assert (queue.spilled, queue.dropped) == (1, 1)
+
+
+def test_drop_policy(spilled):
+    transport = Transport()
+    queue = SendQueue(transport, maxsize=1, policy='drop')
+    assert run(queue, (b'first', None), (b'second', chat('second'))) == [True, False]
+    assert spilled == []
+    assert (queue.spilled, queue.dropped) == (0, 1)
+    assert transport.frames() == [b'first']
+
+
+def test_disconnect_policy(spilled):
+    transport = Transport()
+    queue = SendQueue(transport, maxsize=1, policy='disconnect')
+    msg = chat('second')
+    assert run(queue, (b'first', None), (b'second', msg)) == [True, False]
+    assert transport.aborted
+    assert transport.writes == []
+    assert len(queue) == 0
+    assert spilled == [msg]
+
+
+def test_closing_transport_spills(spilled):
+    transport = Transport()
+    transport.closing = True
+    queue = SendQueue(transport)
+    msg = chat('late')
+    assert run(queue, (b'late', msg)) == [False]
+    assert spilled == [msg]
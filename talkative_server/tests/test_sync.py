@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+from talkative_server.async_core import (ListChatsCommand, ListContactsCommand,
+                                         UserListCommand, db, sync_list)
+from talkative_server.jim_mes import Message
+
+
+def user(name):
+    return db.User.by_name(name) or db.User.create(username=name, password='secret')
+
+
+def test_since_returns_changes_and_deletions():
+    kind = 'sync_test'
+    db.Change.touch(kind, 'alice')
+    db.Change.touch(kind, 'bob')
+    since = db.Change.current(kind)
+    db.Change.touch(kind, 'carol')
+    db.Change.touch(kind, 'bob', deleted=True)
+
+    answer = sync_list(kind, since, lambda names: sorted(names or ['alice', 'bob', 'carol']))
+    assert answer == {'data_list': ['carol'], 'version': since + 2, 'deleted': ['bob']}
+    # первая синхронизация получает весь список без удаленных
+    assert sync_list(kind, 0, lambda names: ['alice', 'carol']) == {'data_list': ['alice', 'carol'], 'version': since + 2}
+
+
+def test_contacts_since(make_proto):
+    owner, contact = user('sync_owner'), user('sync_contact')
+    owner.add_contact(contact.username)
+    since = db.Change.current(db.CONTACTS)
+    owner.del_contact(contact.username)
+
+    proto = make_proto(owner.username)
+    msg = Message(action='get_contacts', user=owner.username, since=since)
+    asyncio.run(ListContactsCommand().update(proto=proto, msg=msg))
+    answer, = proto.sent
+    assert answer.response == 202
+    assert answer.data_list == []
+    assert answer.deleted == [contact.username]
+    assert answer.version > since
+
+
+@pytest.mark.parametrize('command, action', [
+    (UserListCommand, 'get_users'),
+    (ListContactsCommand, 'get_contacts'),
+    (ListChatsCommand, 'get_chats'),
+])
+@pytest.mark.parametrize('since', ['1', -1, 1.5, True])
+def test_bad_since(command, action, since, make_proto):
+    proto = make_proto('alice')
+    asyncio.run(command().update(proto=proto, msg=Message(action=action, user='alice', since=since)))
+    answer, = proto.sent
+    assert (answer.response, answer.error, answer.action) == (400, 'Неверная версия списка', action)
@@ -0,0 +1,153 @@
+from types import SimpleNamespace
+
+from dynaconf import settings
+
+from talkative_server.async_core import ServerA, TimerWheel
+
+
+def make_wheel(size=4):
+    fired = []
+    return TimerWheel(fired.append, tick=1.0, size=size), fired
+
+
+def turn(wheel, ticks):
+    for _ in range(ticks):
+        wheel.advance()
+
+
+def test_fires_after_delay():
+    wheel, fired = make_wheel()
+    wheel.add('a', 2)
+    wheel.add('b', 0.1)  # меньше шага - через один шаг
+    turn(wheel, 1)
+    assert fired == ['b']
+    turn(wheel, 1)
+    assert fired == ['b', 'a']
+    assert len(wheel) == 0
+
+
+def test_wrap_around():
+    wheel, fired = make_wheel(size=4)
+    turn(wheel, 3)
+    # ячейка (3 + 2) % 4 = 1 уже после перехода через ноль
+    wheel.add('near', 2)
+    # 9 шагов на 4 ячейках: два полных оборота и еще один шаг
+    wheel.add('far', 9)
+    assert wheel.where == {'near': 1, 'far': 0}
+    turn(wheel, 2)
+    assert fired == ['near']
+    turn(wheel, 6)
+    assert fired == ['near']
+    turn(wheel, 1)
+    assert fired == ['near', 'far']
+
+
+def test_cancel_and_reschedule():
+    wheel, fired = make_wheel()
+    wheel.add('a', 1)
+    wheel.discard('a')
+    wheel.discard('a')
+    wheel.add('b', 1)
+    wheel.add('b', 3)
+    turn(wheel, 2)
+    assert fired == []
+    turn(wheel, 1)
+    assert fired == ['b']
+
+
+def test_callback_error_does_not_stop_wheel():
+    fired = []
+
+    def callback(item):
+        fired.append(item)
+        raise RuntimeError(item)
+
+    wheel = TimerWheel(callback, tick=1.0, size=4)
+    wheel.add('a', 1)
+    wheel.add('b', 1)
+    turn(wheel, 1)
+    assert sorted(fired) == ['a', 'b']
+    assert len(wheel) == 0
+
+
+class Transport(object):
+    def __init__(self):
+        self.aborted = False
+
+    def is_closing(self):
+        return self.aborted
+
+    def abort(self):
+        self.aborted = True
+
+
+class Proto(object):
+    peername = ('127.0.0.1', 50000)
+
+    def __init__(self, now):
+        self.transport = Transport()
+        self.connected = self.last_seen = now
+        self.sent = []
+
+    def write(self, data):
+        self.sent.append(data)
+        return True
+
+
+def idle_server(size=8):
+    server = ServerA()
+    server.loop = SimpleNamespace(now=0.0)
+    server.loop.time = lambda: server.loop.now
+    server.ping_frame = b'ping'
+    server.wheel = TimerWheel(server.check_idle, tick=1.0, size=size)
+    return server
+
+
+def drive(server, seconds):
+    for _ in range(int(seconds)):
+        server.loop.now += 1
+        server.wheel.advance()
+
+
+def test_idle_reap(monkeypatch):
+    monkeypatch.setitem(settings, 'PING_INTERVAL', 3)
+    monkeypatch.setitem(settings, 'IDLE_TIMEOUT', 10)
+    server = idle_server()
+    proto = Proto(server.loop.now)
+    server.users.add('alice', proto)
+    server.wheel.add(proto, 3)
+    drive(server, 3)
+    assert proto.sent == [b'ping']
+    drive(server, 6)
+    assert proto.sent == [b'ping'] * 3
+    assert not proto.transport.aborted
+    drive(server, 1)
+    assert proto.transport.aborted
+    assert len(server.wheel) == 0
+
+
+def test_activity_postpones_ping(monkeypatch):
+    monkeypatch.setitem(settings, 'PING_INTERVAL', 3)
+    monkeypatch.setitem(settings, 'IDLE_TIMEOUT', 10)
+    server = idle_server()
+    proto = Proto(server.loop.now)
+    server.users.add('alice', proto)
+    server.wheel.add(proto, 3)
+    drive(server, 2)
+    proto.last_seen = server.loop.now
+    drive(server, 1)
+    assert proto.sent == []
+    drive(server, 2)
+    assert proto.sent == [b'ping']
+
+
+def test_unauthenticated_reaped(monkeypatch):
+    monkeypatch.setitem(settings, 'AUTH_TIMEOUT', 2)
+    server = idle_server()
+    proto = Proto(server.loop.now)
+    server.wheel.add(proto, 2)
+    drive(server, 1)
+    proto.last_seen = server.loop.now
+    assert not proto.transport.aborted
+    drive(server, 1)
+    assert proto.transport.aborted
@@ -0,0 +1,67 @@
+import pytest
+
+from talkative_server.writer import BatchWriter
+
+
+def test_batches_and_flush_on_close():
+    batches = []
+    writer = BatchWriter(batches.append, batch=3, delay=60)
+    for i in range(7):
+        writer.put(i)
+    writer.close(timeout=5)
+    assert batches == [[0, 1, 2], [3, 4, 5], [6]]
+    assert writer.stats() == {'pending': 0, 'written': 7, 'failed': 0}
+
+
+def test_write_error_counted():
+    def write(items):
+        raise RuntimeError('db down')
+
+    writer = BatchWriter(write, batch=10, delay=0)
+    writer.put(1)
+    writer.put(2)
+    writer.close(timeout=5)
+    assert writer.written + writer.failed == 2
+    assert writer.failed == 2
+
+
+def test_failed_batch_does_not_block_next():
+    batches = []
+
+    def write(items):
+        if not batches:
+            batches.append(None)
+            raise RuntimeError('db down')
+        batches.append(items)
+
+    writer = BatchWriter(write, batch=2, delay=60)
+    for i in range(4):
+        writer.put(i)
+    writer.close(timeout=5)
+    assert batches == [None, [2, 3]]
+    assert (writer.written, writer.failed) == (2, 2)
+
+
+@pytest.mark.filterwarnings('error::sqlalchemy.exc.SAWarning')
+def test_sqlite_history_after_failed_commit(monkeypatch):
+    from talkative_server.async_core import db
+
+    user = db.User.by_name('history_user') or db.User.create(username='history_user', password='secret')
+    add = db.MessageCounter.add
+
+    def fail_once(session, counters):
+        # строки истории уже в транзакции, коммит не состоится
+        session.flush()
+        monkeypatch.setattr(db.MessageCounter, 'add', add)
+        raise RuntimeError('db down')
+
+    monkeypatch.setattr(db.MessageCounter, 'add', fail_once)
+    row = {'oper_id': user.id, 'type_row': db.TypeHistory.mes_sent}
+    with pytest.raises(RuntimeError):
+        db.UserHistory.write_many([dict(row, note='lost')])
+    db.UserHistory.write_many([dict(row, note='saved')])
+    session = db.UserHistory.sessions()
+    session.expire_all()
+    notes = [h.note for h in session.query(db.UserHistory).filter_by(oper_id=user.id)]
+    assert notes == ['saved']
+    assert session.query(db.MessageCounter).filter_by(oper_id=user.id).one().sent == 1